@@ -25,38 +25,112 @@ following flow:
 """
 import argparse
 
-from multivac.src.data.glove import glove_main
-from multivac.src.data.make import collect_main
-from multivac.src.data.parsing import nlp_parse_main
-from multivac.src.data.qgnet import qgnet_main
-from multivac.pymln.pymln import mln_main
+from multivac import settings
+from multivac.src import instrument
+from multivac.src.pipeline import Pipeline, Stage
 
 
-def conduct(args_dict):
-    # step 1: collect data
-    collect_main()
+def parse_files(args_dict):
+    return [settings.data_dir / ('*.' + ext) for ext in ['dep', 'input',
+                                                         'morph']]
+
+
+def glove_outputs(args_dict):
+    return [settings.models_dir / 'da_embeddings.txt',
+            settings.models_dir / 'DA_glove_embeddings_100.pkl']
 
-    # step 2:
-    nlp_parse_main(args_dict)
+
+# each stage's module is imported only when the stage runs, since they pull
+# in spaCy, stanfordnlp, CoreNLP and torch
+STAGES = [
+    # step 1: collect data; the sources change without any input here
+    # changing, so it has no outputs to check and runs whenever it is a target
+    # (including the default of all stages), but not when only a later stage
+    # is asked for; articles already stored aren't fetched again
+    Stage('collect', 'multivac.src.data.make', 'collect_main',
+          inputs=lambda a: [settings.cfgDIR / settings.config_file_name],
+          args=lambda a: ()),
+
+    # step 2: parse data
+    Stage('parse', 'multivac.src.data.parsing', 'nlp_parse_main',
+          deps=['collect'],
+          inputs=lambda a: [settings.processed_dir / 'data' / 'data.jsonl'],
+          outputs=lambda a: parse_files(a) + (
+              [settings.data_dir / 'articles-with-equations.json']
+              if a['nlp_newjson'] else []),
+          params=lambda a: {'nlp_newjson': a['nlp_newjson']}),
 
     # step 3: run glove models
-    glove_main()
+    Stage('glove', 'multivac.src.data.glove', 'glove_main', deps=['parse'],
+          inputs=lambda a: [settings.data_dir / 'articles-with-equations.json',
+                            settings.data_dir / 'glove.42B.300d.txt'],
+          outputs=glove_outputs,
+          params=lambda a: {'cca_method': a['cca_method']},
+          args=lambda a: (a['cca_method'],)),
 
-    # step 4: build qg network
-    qgnet_main(args_dict)
+    # step 4: build qg network; its outputs are made by the qgnet scripts, so
+    # it always runs
+    Stage('qgnet', 'multivac.src.data.qgnet', 'qgnet_main', deps=['glove'],
+          inputs=glove_outputs),
 
     # step 5: build mln
-    mln_main(args_dict)
+    Stage('mln', 'multivac.pymln.pymln', 'mln_main', deps=['parse'],
+          inputs=parse_files,
+          outputs=lambda a: [settings.mln_dir / 'mln.pkl'],
+          params=lambda a: {k: a.get(k) for k in ['subset', 'prior_num_conj',
+                                                  'prior_num_param',
+                                                  'agenda_batch']}),
+]
+
+
+def conduct(args_dict):
+    """Run the requested stages (default: all) and the stages they depend on,
+    skipping those whose outputs are up to date. Collect has no outputs to
+    check, so it only queries the sources when it is requested. GloVe and the
+    MLN both only need the parse outputs, so they run concurrently."""
+    force = list(args_dict.get('force') or [])
+
+    if args_dict.get('trace'):
+        instrument.enable(args_dict['trace'])
+
+    pipeline = Pipeline(STAGES, settings.interim_dir / 'pipeline')
+    report = pipeline.run(args_dict, targets=args_dict.get('stages'),
+                          force=force, jobs=args_dict.get('jobs') or 2)
+
+    if instrument.enabled():
+        instrument.print_summary()
+    return all(row['status'] in ('ran', 'skipped') for row in report)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Orchestrate pipeline for '
                                      'MULTIVAC processing and modeling.')
-    parser.add_argument('-bp', '--nlp_bp', required=False, type=int,
-                        help='Which document to start parsing with.')
+    parser.add_argument('-st', '--stages', nargs='+',
+                        choices=[stage.name for stage in STAGES],
+                        help='Pipeline stages to run, with the stages they '
+                        'depend on that are out of date; defaults to all '
+                        'of them. collect only runs when listed.')
+    parser.add_argument('-f', '--force', nargs='+', default=[],
+                        choices=[stage.name for stage in STAGES],
+                        help='Stages to run even if their outputs are up to '
+                        'date.')
+    parser.add_argument('-j', '--jobs', default=2, type=int, help='Number of '
+                        'independent stages to run at once.')
+    parser.add_argument('-tr', '--trace', help='Write a JSONL trace of '
+                        'stage timings, counters and memory use to this file '
+                        'and print a summary at the end.')
     parser.add_argument('-js', '--nlp_newjson', action='store_true',
                         help='Boolean; indicates whether to create new JSON '
                         'file for glove embedding.')
+    parser.add_argument('-nw', '--nlp_workers', type=int, help='Number of '
+                        'parser processes; defaults to the number of CPUs.')
+    parser.add_argument('-nt', '--nlp_timeout', default=300, type=int,
+                        help='Seconds allowed to parse one document before '
+                        'its worker is restarted.')
+    parser.add_argument('-cm', '--cca_method', default='sklearn',
+                        choices=['sklearn', 'randomized'], help='CCA used to '
+                        'align domain-general and domain-specific embeddings; '
+                        'randomized scales to large vocabularies.')
     parser.add_argument('-an', '--subset', type=int, help='Number of articles '
                         'for MLN run.')
     parser.add_argument('-pc', '--prior_num_conj', default=10, type=int,
@@ -65,11 +139,19 @@ if __name__ == '__main__':
     parser.add_argument('-pp', '--prior_num_param', default=5, type=int,
                         help='Prior on number of parameters for cluster '
                         'merges.')
-    parser.add_argument('-qp', '--qgnet_path', required=True, help='The '
-                        'top-level qgnet directory to create folders for '
-                        'models and data.')
+    parser.add_argument('-ab', '--agenda_batch', default=1, type=int,
+                        help='Number of non-overlapping agenda operations to '
+                        'execute per round in MLN induction; 1 runs the '
+                        'serial search.')
+    parser.add_argument('-qp', '--qgnet_path', help='The top-level qgnet '
+                        'directory to create folders for models and data; '
+                        'required to run the qgnet stage.')
     parser.add_argument('-v', "--verbose", action='store_true', help='Give '
                         'verbose output during MLN modeling.')
     args_dict = vars(parser.parse_args())
+    if args_dict['qgnet_path'] is None and \
+            'qgnet' in (args_dict['stages'] or ['qgnet']):
+        parser.error('the qgnet stage requires -qp/--qgnet_path')
 
-    conduct(args_dict)
+    if not conduct(args_dict):
+        raise SystemExit(1)
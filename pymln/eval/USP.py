@@ -3,8 +3,6 @@ import argparse
 import os
 import re
 
-import corenlp
-
 from sortedcontainers import SortedDict, SortedSet
 
 from multivac import settings
@@ -54,13 +52,16 @@ class stanford_token():
 
 
 class stanford_parse():
-    nlp_client = corenlp.CoreNLPClient(annotators="tokenize ssplit pos lemma ner depparse", 
-                                       output_format='json', 
-                                       properties={'timeout': '50000'})
-    try:
-        _ = stanford_parse.nlp_client.annotate("The quick brown fox jumped over the lazy dog.")
-    except:
-        pass
+    nlp_client = None
+
+    def get_client():
+        # started on first use rather than when multivac.pymln is imported
+        if stanford_parse.nlp_client is None:
+            import corenlp
+            stanford_parse.nlp_client = corenlp.CoreNLPClient(annotators="tokenize ssplit pos lemma ner depparse",
+                                                              output_format='json',
+                                                              properties={'timeout': '50000'})
+        return stanford_parse.nlp_client
 
     def __init__(self, sentence, deptype='basicDependencies'):
         self.tokens = []
@@ -95,7 +96,7 @@ class stanford_parse():
         return self.tokens[self.root]
 
     def get_parse(sentence):
-        ann = stanford_parse.nlp_client.annotate(sentence)
+        ann = stanford_parse.get_client().annotate(sentence)
         return ann['sentences'][0]
 
     def get_deps(sentence, deptype='basicDependencies', ret='asis'):
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Long-running HTTP query service over one or more induced MLN models.
+
+All models are loaded and indexed once in the parent process, which then
+forks a fixed pool of worker processes sharing the listening socket. The
+workers inherit the loaded models copy-on-write, so each additional worker
+costs very little memory and starts serving immediately.
+
+The semantic parsing classes keep their state in class attributes, so each
+worker handles one request at a time and swaps the requested model's state
+in before answering; concurrency comes from the worker pool.
+
+Endpoints (GET, JSON responses):
+    /models                                  loaded models
+    /clusters?model=M&lemma=L                clusters whose relation types
+                                             contain lemma L
+    /neighbors?model=M&clust=C               argument clusters of cluster C
+                                             and the clusters using C as an
+                                             argument
+    /match?model=M&rel=R&arg=A[&dep=nsubj]   USP-style question matching
+    /metrics                                 request counts and latencies
+
+Usage: python -m multivac.pymln.eval.server -m name=path/to/mln.pkl [...]
+'''
+import argparse
+import gc
+import json
+import multiprocessing as mp
+import os
+import signal
+import sys
+import time
+import traceback
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from multivac import settings
+from multivac.pymln.eval import Question, USP
+from multivac.pymln.semantic import Clust, MLN, Part
+from multivac.pymln.syntax.Relations import ArgType, RelType
+
+
+class MLNModel(object):
+    '''
+        A loaded MLN plus the USP lookup tables derived from it. The global
+        class state belonging to the model is captured on load and restored
+        by activate().
+    '''
+    STATE = [(Clust, 'clusts'),
+             (Clust, 'relTypeIdx_clustIdx'),
+             (RelType, 'relTypes'),
+             (RelType, 'relTypeStr_idx'),
+             (ArgType, 'argTypes'),
+             (ArgType, 'argTypeStr_idx'),
+             (Part, 'rootNodeId_part'),
+             (Part, 'clustIdx_partRootNodeIds'),
+             (Part, 'pairClustIdxs_pairPartRootNodeIds'),
+             (USP, 'clustIdx_depArgClustIdx'),
+             (USP, 'lemma_clustIdxs'),
+             (USP, 'headDep_clustIdxs'),
+             (USP, 'ptId_clustIdxStr'),
+             (USP, 'ptId_aciChdIds'),
+             (USP, 'ptId_parDep')]
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = str(path)
+
+        MLN.load_mln(self.path)
+
+        USP.lemma_clustIdxs = dict()
+        USP.headDep_clustIdxs = dict()
+        USP.ptId_aciChdIds = dict()
+        USP.ptId_parDep = dict()
+        USP.readClust()
+        USP.readPart()
+
+        # Relation lemma -> cluster for verbal relation types; USP.readClust
+        # only records the relations named in the questions at hand.
+        self.rel_clustIdx = dict()
+        # Cluster -> {(parent cluster, argument cluster): count}
+        self.clustIdx_parArgClusts = dict()
+
+        for cid, clust in Clust.clusts.items():
+            for relType in clust._relTypeIdx_cnt:
+                rel_str = RelType.getRelType(relType).toString()
+                POS = rel_str[rel_str.index('(')+1:rel_str.index(':')]
+                rel = rel_str[rel_str.index(':')+1:rel_str.rfind(")")]
+
+                if POS.startswith('V') and ' (' not in rel:
+                    self.rel_clustIdx[rel] = cid
+
+            for aci, ac in clust._argClusts.items():
+                for chd, cnt in ac._chdClustIdx_cnt.items():
+                    if chd not in self.clustIdx_parArgClusts:
+                        self.clustIdx_parArgClusts[chd] = dict()
+
+                    self.clustIdx_parArgClusts[chd][(cid, aci)] = cnt
+
+        self.num_clusts = len(Clust.clusts)
+        self.num_parts = len(Part.rootNodeId_part)
+        self._state = [(cls, attr, getattr(cls, attr))
+                       for cls, attr in MLNModel.STATE]
+
+    def activate(self):
+        for cls, attr, value in self._state:
+            setattr(cls, attr, value)
+
+        return None
+
+    def summary(self):
+        return {'name': self.name,
+                'path': self.path,
+                'clusters': self.num_clusts,
+                'parts': self.num_parts}
+
+    def describe_clust(self, cid):
+        clust = Clust.getClust(cid)
+
+        return {'clust': cid,
+                'type': clust.getType(),
+                'relations': clust.toString(),
+                'parts': len(Part.getPartRootNodeIds(cid) or ()),
+                'arg_clusts': {aci: ac.toString()
+                               for aci, ac in clust._argClusts.items()}}
+
+    def clusters(self, lemma):
+        self.activate()
+        cids = USP.lemma_clustIdxs.get(lemma, set())
+
+        return [self.describe_clust(cid) for cid in sorted(cids)
+                if Clust.getClust(cid) is not None]
+
+    def neighbors(self, cid):
+        self.activate()
+        clust = Clust.getClust(cid)
+
+        if clust is None:
+            return None
+
+        args = []
+
+        for aci, ac in clust._argClusts.items():
+            args.append({'arg_clust': aci,
+                         'count': ac._ttlArgCnt,
+                         'arg_types': {ArgType.getArgType(k).toString(): v
+                                       for k, v in ac._argTypeIdx_cnt.items()},
+                         'children': {str(Clust.getClust(k)): v
+                                      for k, v in ac._chdClustIdx_cnt.items()
+                                      if v > 0 and Clust.getClust(k) is not None}})
+
+        parents = [{'clust': par,
+                    'relations': str(Clust.getClust(par)),
+                    'arg_clust': aci,
+                    'count': cnt}
+                   for (par, aci), cnt
+                   in self.clustIdx_parArgClusts.get(cid, {}).items()
+                   if cnt > 0 and Clust.getClust(par) is not None]
+
+        result = self.describe_clust(cid)
+        result['args'] = args
+        result['parents'] = sorted(parents, key=lambda k: -k['count'])
+
+        return result
+
+    def argClustIdx(self, cid, dep):
+        dep_aci = USP.clustIdx_depArgClustIdx[cid]
+
+        if dep in dep_aci:
+            return dep_aci[dep]
+        elif dep.startswith('nsubj'):
+            candidates = ('nsubj', 'nsubjpass')
+        elif 'obj' in dep:
+            candidates = ('dobj', 'obj')
+        else:
+            candidates = ()
+
+        for d in candidates:
+            if d in dep_aci:
+                return dep_aci[d]
+
+        return None
+
+    def match(self, rel, arg, dep='nsubj'):
+        '''
+            Answer a question given as (relation lemma, known argument,
+            dependency of the known argument), following USP.match: find
+            parts of the relation's cluster whose known argument matches and
+            return the fillers of the other core argument.
+        '''
+        self.activate()
+        q = Question(rel, arg, dep)
+        USP.rel_qs = {rel: [q]}
+        USP.arg_cis = dict()
+        USP.form_lemma = {f: set([f, f.lower()]) for f in arg.split()}
+        USP.preprocArgs()
+
+        if rel not in self.rel_clustIdx or arg not in USP.arg_cis:
+            return []
+
+        cid = self.rel_clustIdx[rel]
+        aci = self.argClustIdx(cid, dep)
+        aci2 = self.argClustIdx(cid, 'dobj' if 'nsubj' in dep else 'nsubj')
+
+        if aci is None or aci2 is None:
+            return []
+
+        answers = []
+
+        for pid in Part.getPartRootNodeIds(cid) or ():
+            aci_chds = USP.ptId_aciChdIds.get(pid, {})
+
+            if aci not in aci_chds or aci2 not in aci_chds:
+                continue
+
+            if any(USP.ptId_parDep[c] == 'neg'
+                   for x, cids in aci_chds.items() if x not in (aci, aci2)
+                   for c in cids):
+                continue
+
+            if not any(USP.isMatch(c, arg) for c in aci_chds[aci]):
+                continue
+
+            for c in aci_chds[aci2]:
+                answers.append({'part': pid,
+                                'sentence': USP.getSentId(c),
+                                'answer': USP.ptId_clustIdxStr[c][1]})
+
+        return answers
+
+
+class LatencyStats(object):
+    '''
+        Request counts and latency histograms kept in shared memory so that
+        every worker process records into the same table.
+    '''
+    BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+
+    def __init__(self, endpoints):
+        self.endpoints = list(endpoints)
+        self.width = len(LatencyStats.BUCKETS) + 5
+        # Per endpoint: count, errors, total secs, max secs, buckets...
+        self._data = mp.Array('d', self.width * len(self.endpoints))
+
+    def record(self, endpoint, elapsed, error=False):
+        if endpoint not in self.endpoints:
+            return None
+
+        base = self.endpoints.index(endpoint) * self.width
+        bucket = bisect_left(LatencyStats.BUCKETS, elapsed)
+
+        with self._data.get_lock():
+            self._data[base] += 1
+            self._data[base+1] += int(error)
+            self._data[base+2] += elapsed
+            self._data[base+3] = max(self._data[base+3], elapsed)
+            self._data[base+4+bucket] += 1
+
+        return None
+
+    def quantile(self, counts, q):
+        target = q * sum(counts)
+        seen = 0
+
+        for i, cnt in enumerate(counts):
+            seen += cnt
+
+            if cnt and seen >= target:
+                if i < len(LatencyStats.BUCKETS):
+                    return LatencyStats.BUCKETS[i]
+
+                break
+
+        return None
+
+    def report(self):
+        with self._data.get_lock():
+            data = list(self._data)
+
+        result = {}
+
+        for i, endpoint in enumerate(self.endpoints):
+            row = data[i*self.width:(i+1)*self.width]
+            count = int(row[0])
+
+            if count == 0:
+                continue
+
+            result[endpoint] = {'count': count,
+                                'errors': int(row[1]),
+                                'mean_ms': 1000 * row[2] / count,
+                                'max_ms': 1000 * row[3],
+                                'p50_le_ms': self.ms(self.quantile(row[4:], .5)),
+                                'p95_le_ms': self.ms(self.quantile(row[4:], .95)),
+                                'p99_le_ms': self.ms(self.quantile(row[4:], .99))}
+
+        return result
+
+    def ms(self, secs):
+        return None if secs is None else 1000 * secs
+
+
+class MLNRequestHandler(BaseHTTPRequestHandler):
+    models = {}
+    stats = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        start = time.perf_counter()
+        status = 200
+
+        try:
+            body = self.route(url.path, params)
+
+            if body is None:
+                status, body = 404, {'error': 'not found'}
+        except (KeyError, ValueError) as e:
+            status, body = 400, {'error': 'bad request: {}'.format(e)}
+        except Exception as e:
+            status, body = 500, {'error': repr(e)}
+
+        self.send_json(status, body)
+        self.stats.record(url.path, time.perf_counter() - start, status >= 400)
+
+        return None
+
+    def route(self, path, params):
+        if path == '/models':
+            return [m.summary() for m in self.models.values()]
+        elif path == '/metrics':
+            return self.stats.report()
+        elif path == '/clusters':
+            return self.get_model(params).clusters(params['lemma'])
+        elif path == '/neighbors':
+            return self.get_model(params).neighbors(int(params['clust']))
+        elif path == '/match':
+            return self.get_model(params).match(params['rel'],
+                                                params['arg'],
+                                                params.get('dep', 'nsubj'))
+        else:
+            return None
+
+    def get_model(self, params):
+        if 'model' not in params and len(self.models) == 1:
+            return next(iter(self.models.values()))
+
+        return self.models[params['model']]
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+        return None
+
+    def log_message(self, format, *args):
+        return None
+
+
+def load_models(specs, verbose=False):
+    models = {}
+
+    for spec in specs:
+        if '=' in spec:
+            name, path = spec.split('=', 1)
+        else:
+            name, path = os.path.basename(os.path.dirname(spec)) or spec, spec
+
+        if os.path.isdir(path):
+            path = os.path.join(path, 'mln.pkl')
+
+        start = time.perf_counter()
+        models[name] = MLNModel(name, path)
+
+        if verbose:
+            print("Loaded model {} from {} in {:.1f}s."
+                  .format(name, path, time.perf_counter() - start))
+
+    return models
+
+
+def serve(models, host='127.0.0.1', port=8642, workers=4, verbose=False):
+    '''
+        Serve the loaded models with a pre-forked pool of worker processes,
+        replacing any worker that exits until interrupted. Workers that
+        die soon after starting are reported and replaced after a growing
+        delay, so a worker that can't start doesn't fork in a tight loop.
+    '''
+    MLNRequestHandler.models = models
+    MLNRequestHandler.stats = LatencyStats(['/models', '/clusters',
+                                            '/neighbors', '/match',
+                                            '/metrics'])
+    httpd = HTTPServer((host, port), MLNRequestHandler)
+
+    # Keep the loaded models out of the collector so that worker processes
+    # don't dirty (and so copy) their pages when collecting.
+    gc.collect()
+    gc.freeze()
+
+    def spawn():
+        pid = os.fork()
+
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+            status = 0
+
+            try:
+                httpd.serve_forever()
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+
+        return pid
+
+    children = {spawn(): time.monotonic() for _ in range(workers)}
+    delay = 0
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if verbose:
+        print("Serving {} model(s) on http://{}:{} with {} workers."
+              .format(len(models), host, port, workers))
+
+    try:
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+
+            if started is None:
+                continue
+
+            if os.WIFSIGNALED(status):
+                print("Worker {} killed by signal {}."
+                      .format(pid, os.WTERMSIG(status)), file=sys.stderr)
+            elif os.WEXITSTATUS(status):
+                print("Worker {} exited with status {}."
+                      .format(pid, os.WEXITSTATUS(status)), file=sys.stderr)
+
+            # Back off while workers keep dying within a few seconds of
+            # starting, up to a minute between restarts.
+            if time.monotonic() - started < 5:
+                delay = min(max(2 * delay, 0.5), 60)
+                print("Worker {} died after {:.1f}s; restarting in {:.1f}s."
+                      .format(pid, time.monotonic() - started, delay),
+                      file=sys.stderr)
+                time.sleep(delay)
+            else:
+                delay = 0
+
+            children[spawn()] = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        httpd.server_close()
+
+    return None
+
+
+if __name__ == '__main__':
+    prs = argparse.ArgumentParser(description='Serve queries against one or '
+                                  'more induced MLN models. \n'
+                                  'Usage: python -m server.py [-m name=path] '
+                                  '[-p port] [-w workers]')
+    prs.add_argument('-m', '--model', action='append',
+                     help='Model to load, as name=path; path may be an '
+                     'mln.pkl file or a directory containing one. Repeat '
+                     'for several models. Defaults to settings.mln_dir.')
+    prs.add_argument('-H', '--host', default='127.0.0.1',
+                     help='Interface to listen on.')
+    prs.add_argument('-p', '--port', default=8642, type=int,
+                     help='Port to listen on.')
+    prs.add_argument('-w', '--workers', default=4, type=int,
+                     help='Number of worker processes.')
+    prs.add_argument('-v', '--verbose', action='store_true',
+                     help='Report model loading and startup.')
+
+    args = vars(prs.parse_args())
+    specs = args['model'] or ['mln={}'.format(settings.mln_dir)]
+
+    serve(load_models(specs, args['verbose']),
+          host=args['host'],
+          port=args['port'],
+          workers=args['workers'],
+          verbose=args['verbose'])
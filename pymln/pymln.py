@@ -5,11 +5,13 @@
 #   Hoifung Poon and Pedro Domingos (2009). "Unsupervised Semantic Parsing",
 #   in Proceedings of the Conference on Empirical Methods in Natural Language
 #   Processing (EMNLP), 2009. http://alchemy.cs.washington.edu/usp.
+import json
 import os
 
 from datetime import datetime
 
 from multivac import settings
+from multivac.src import instrument
 from multivac.pymln.semantic import Parse, MLN, Clust
 from multivac.pymln.syntax.StanfordParseReader import StanfordParseReader
 
@@ -41,25 +43,30 @@ def mln_main(args_dict):
         subset = len(input_files)
 
     articles = []
-    for i, fileName in enumerate(input_files):
-        try:
-            a = StanfordParseReader.readParse(fileName, data_dir)
-        except:
-            print("Error on {}, {}".format(i, fileName))
-            raise Exception
+    with instrument.span('mln.read_parses'):
+        for i, fileName in enumerate(input_files):
+            try:
+                a = StanfordParseReader.readParse(fileName, data_dir)
+            except:
+                print("Error on {}, {}".format(i, fileName))
+                raise Exception
 
-        if i%100 == 0:
-            print("{} articles parsed.".format(i))
+            if i%100 == 0:
+                print("{} articles parsed.".format(i))
 
-        if i >= subset:
-            break
+            if i >= subset:
+                break
 
-        articles.append(a)
+            articles.append(a)
 
 
     if verbose:
         print("{} Initializing...".format(datetime.now()))
-    parser.initialize(articles, verbose)
+    with instrument.span('mln.initialize'):
+        parser.initialize(articles, verbose)
+    instrument.count('mln.articles', len(articles))
+    instrument.count('mln.sentences', parser.numSents)
+    instrument.count('mln.tokens', parser.numTkns)
 
     if verbose:
         print("{}: {} articles parsed, of {} sentences and {} total tokens."
@@ -73,14 +80,16 @@ def mln_main(args_dict):
         print("{}: {} initial clusters, with {} argument clusters."
               .format(datetime.now(), len(Clust.clusts), num_arg_clusts))
         print("{} Merging arguments...".format(datetime.now()))
-    parser.mergeArgs()
+    with instrument.span('mln.merge_args'):
+        parser.mergeArgs()
     num_arg_clusts = sum([len(x._argClusts) for x in Clust.clusts.values()])
 
     if verbose:
         print("Now with {} initial clusters, {} argument clusters."
               .format(len(Clust.clusts), num_arg_clusts))
         print("{} Creating agenda...".format(datetime.now()))
-    parser.agenda.createAgenda(verbose)
+    with instrument.span('mln.create_agenda'):
+        parser.agenda.createAgenda(verbose)
 
     if verbose:
         print("{}: {} possible operations in queue, {} merges and {} composes."
@@ -89,16 +98,41 @@ def mln_main(args_dict):
                       len(parser.agenda._mc_neighs),
                       len(parser.agenda._compose_cnt)))
         print("{} Processing agenda...".format(datetime.now()))
-    parser.agenda.procAgenda(verbose)
+    batch_size = args_dict.get('agenda_batch') or 1
+    start = datetime.now()
+    with instrument.span('mln.process_agenda', batch_size=batch_size):
+        stats = parser.agenda.procAgenda(verbose, batch_size=batch_size)
+    instrument.count('mln.merges', stats['exec_merge_clust'])
+    instrument.count('mln.composes', stats['exec_compose'])
+
+    elapsed = datetime.now() - start
 
     num_arg_clusts = sum([len(x._argClusts) for x in Clust.clusts.values()])
 
+    # saved on every run, so batched and serial runs can be compared
+    with open(results_dir / "agenda_stats.json", 'w') as f:
+        json.dump({'stats': stats,
+                   'seconds': elapsed.total_seconds(),
+                   'articles': len(articles),
+                   'clusters': len(Clust.clusts),
+                   'arg_clusters': num_arg_clusts}, f, indent=2)
+
     if verbose:
         print("{}: {} final clusters, with {} argument clusters."
               .format(datetime.now(), len(Clust.clusts), num_arg_clusts))
-
-    MLN.save_mln(results_dir / "mln.pkl")
-    MLN.printModel(results_dir)
+        print("{}: agenda batch size {}: {} rounds in {}, {} merges and {} "
+              "composes executed, log-likelihood gain {:.2f}."
+              .format(datetime.now(),
+                      stats['batch_size'],
+                      stats['rounds'],
+                      elapsed,
+                      stats['exec_merge_clust'],
+                      stats['exec_compose'],
+                      stats['score_gain']))
+
+    with instrument.span('mln.save'):
+        MLN.save_mln(results_dir / "mln.pkl")
+        MLN.printModel(results_dir)
 
     if verbose:
         print("{} Induced MLN saved.".format(datetime.now()))
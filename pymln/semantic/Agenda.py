@@ -208,10 +208,25 @@ class Agenda(object):
 
         return False
 
-    def procAgenda(self, verbose=False):
+    def procAgenda(self, verbose=False, batch_size=1):
+        '''
+            Score pending operations and execute the best one, repeating
+            until no active operations remain.
+
+            With batch_size > 1, each round instead executes up to batch_size
+            of the highest-scoring operations whose clusters don't overlap,
+            and rescores the affected operations once for the whole round.
+            This trades some search quality for far fewer rounds.
+
+            Returns a dict of run statistics (rounds, executed operations and
+            the summed score of executed operations, i.e. the log-likelihood
+            gain) so batched and serial runs can be compared.
+        '''
         if verbose:
             print("Processing agenda with {} operations in queue.".format(len(self._agendaToScore)))
         ttlAgendaScored, ttlExecMC, ttlExecAbs = (0, 0, 0)
+        ttlGain = 0
+        ttlHeldBack = 0
         i = 1
 
         while True:
@@ -231,21 +246,42 @@ class Agenda(object):
                 self.addAgenda(op, score)
 
             self._agendaToScore.clear()
-            ttlAgendaScored = As + 1
+            ttlAgendaScored += As
 
             if len(self._scoreActiveAgenda) == 0:
                 break
 
-            score, op = next(reversed(self._scoreActiveAgenda))
-            if verbose:
-                print("Executing: {}, score={}".format(op, score))
-            newClustIdx = self._parse.executor.executeOp(op)
-            self.updateAgendaAfterExec(op, newClustIdx, verbose)
+            for n, (score, op) in enumerate(self.nextOps(batch_size)):
+                # An earlier op in this round may have sent this one back
+                # for rescoring; it will be reconsidered next round.
+                if op not in self._activeAgenda_score:
+                    continue
+
+                # Later ops in a round were scored before the earlier ones
+                # ran, so rescore them: the gain counted is then the one
+                # actually realized, and ops that no longer pass the cutoff
+                # go back to be rescored next round.
+                if n > 0:
+                    score = self._parse.scorer.scoreOp(op)
+
+                    if score < ParseParams.priorCutOff:
+                        self.removeAgenda(op)
+                        self.addAgendaToScore(op)
+                        ttlHeldBack += 1
+                        continue
+
+                if verbose:
+                    print("Executing: {}, score={}".format(op, score))
+                newClustIdx = self._parse.executor.executeOp(op)
+                self.updateAgendaAfterExec(op, newClustIdx, verbose)
+
+                if newClustIdx >= 0:
+                    ttlGain += score
 
-            if op._op == SearchOp.OP_COMPOSE:
-                ttlExecAbs += 1
-            elif op._op == SearchOp.OP_MERGE_CLUST:
-                ttlExecMC += 1
+                if op._op == SearchOp.OP_COMPOSE:
+                    ttlExecAbs += 1
+                elif op._op == SearchOp.OP_MERGE_CLUST:
+                    ttlExecMC += 1
 
             if verbose:
                 print("Total op_compose: {}, Total op_merge_clust: {}".format(ttlExecAbs, ttlExecMC))
@@ -254,7 +290,42 @@ class Agenda(object):
             if verbose and i%10==0:
                 print("{} Processing agenda: {} loops".format(datetime.now(), i))
 
-        return None
+        # i counts from 1 and the last pass stops before incrementing it
+        return {'batch_size': batch_size,
+                'rounds': i - 1,
+                'scored': ttlAgendaScored,
+                'exec_compose': ttlExecAbs,
+                'exec_merge_clust': ttlExecMC,
+                'held_back': ttlHeldBack,
+                'score_gain': ttlGain}
+
+    def nextOps(self, batch_size=1):
+        '''
+            Return up to batch_size (score, op) pairs from the active agenda,
+            best first, such that no two operations touch the same cluster.
+        '''
+        ops = []
+        used = set()
+
+        for score, op in reversed(self._scoreActiveAgenda):
+            clustIdxs = Agenda.opClustIdxs(op)
+
+            if used.isdisjoint(clustIdxs):
+                ops.append((score, op))
+                used.update(clustIdxs)
+
+                if len(ops) >= batch_size:
+                    break
+
+        return ops
+
+    def opClustIdxs(op):
+        if op._op == SearchOp.OP_MERGE_CLUST:
+            return (op._clustIdx1, op._clustIdx2)
+        elif op._op == SearchOp.OP_COMPOSE:
+            return (op._parClustIdx, op._chdClustIdx)
+        else:
+            return ()
 
     def addAgenda(self, op, score):
         ci1, ci2 = (-1, -1)
@@ -310,6 +381,10 @@ class Agenda(object):
         while len(self._clustIdx_agenda[oldClustIdx]) > 0:
             oop = next(iter(self._clustIdx_agenda[oldClustIdx]))
             self.removeAgenda(oop)
+            # In a batched round, oop may already be waiting to be scored;
+            # take it out before changing its clusters, as its hash changes
+            # with them.
+            self._agendaToScore.discard(oop)
 
             if oop._op == SearchOp.OP_MERGE_CLUST:
                 ci1 = oop._clustIdx1
@@ -344,6 +419,7 @@ class Agenda(object):
                 self.addAgendaToScore(nop)
 
         del self._clustIdx_agenda[oldClustIdx]
+        self.remapAgendaToScore(oldClustIdx, newClustIdx)
 
         num_parts_old = len(Part.getClustPartRootNodeIds()[oldClustIdx])
         num_parts_new = len(Part.getClustPartRootNodeIds()[newClustIdx])
@@ -360,6 +436,36 @@ class Agenda(object):
 
         return None
 
+    def remapAgendaToScore(self, oldClustIdx, newClustIdx):
+        '''
+            Point operations still waiting to be scored at the merged cluster.
+            Only batched rounds execute ops while others are pending.
+        '''
+        stale = [op for op in self._agendaToScore
+                 if oldClustIdx in Agenda.opClustIdxs(op)]
+
+        for op in stale:
+            self._agendaToScore.discard(op)
+
+            if op._op == SearchOp.OP_MERGE_CLUST:
+                ci1, ci2 = [newClustIdx if x == oldClustIdx else x
+                            for x in (op._clustIdx1, op._clustIdx2)]
+
+                if ci1 == ci2:
+                    continue
+
+                op._clustIdx1 = min((ci1, ci2))
+                op._clustIdx2 = max((ci1, ci2))
+            elif op._op == SearchOp.OP_COMPOSE:
+                op._parClustIdx, op._chdClustIdx = \
+                    [newClustIdx if x == oldClustIdx else x
+                     for x in (op._parClustIdx, op._chdClustIdx)]
+
+            op.genString()
+            self.addAgendaToScore(op)
+
+        return None
+
     def updateAgendaAfterExecAbs(self, op, newClustIdx, oop=None, verbose=False):
         if op._op == SearchOp.OP_COMPOSE:
             parClustIdx = op._parClustIdx
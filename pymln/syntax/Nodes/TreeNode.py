@@ -1,17 +1,21 @@
 
-# from collections import OrderedDict
-from sortedcontainers import SortedDict, SortedSet
 from multivac.pymln.syntax.Nodes import Token
 
 class TreeNode(object):
     # map {str: TreeNode}
     id_treeNodes = {}
+    nxtNodeIdx = 0
 
     def __init__(self, tree_node_id, token):
         self._id = tree_node_id
+        self._idx = TreeNode.nxtNodeIdx
+        TreeNode.nxtNodeIdx += 1
         self._tkn = token
-        # map {str: set(TreeNodes)}
-        self._children = SortedDict()
+        # map {str: {int: TreeNode}}, both levels kept in insertion order;
+        # canonical ordering is only applied in getChildren()
+        self._children = {}
+        self._parent = None
+        self._typeStr = None
         TreeNode.id_treeNodes[tree_node_id] = self
 
     def __hash__(self):
@@ -29,22 +33,79 @@ class TreeNode(object):
     def __repr__(self):
         return self.toString()
 
+    def __setstate__(self, state):
+        # Models saved before children were keyed by node index held
+        # {dep: SortedSet(TreeNode)}, and their nodes had no parent links.
+        self.__dict__.update(state)
+        # Nodes from before node indices were kept get fresh ones; either
+        # way, nodes created after loading must not reuse a loaded index.
+        if '_idx' not in state:
+            self._idx = TreeNode.nxtNodeIdx
+        TreeNode.nxtNodeIdx = max(TreeNode.nxtNodeIdx, self._idx + 1)
+        self.__dict__.setdefault('_parent', None)
+        self.__dict__.setdefault('_typeStr', None)
+
+        # Children are unpickled before their parent, so they already have
+        # their indices; key them as addChild does, and link them back so
+        # adding a child later clears their ancestors' cached type strings.
+        if any(not isinstance(v, dict) for v in self._children.values()):
+            self._children = {dep: {node._idx: node for node in nodes}
+                              for dep, nodes in self._children.items()}
+
+        for nodes in self._children.values():
+            for node in nodes.values():
+                node._parent = self
+
+        return None
+
     def addChild(self, dep, child):
         if dep not in self._children:
-            self._children[dep] = SortedSet()
+            self._children[dep] = {}
+
+        self._children[dep][child._idx] = child
+        child._parent = self
 
-        self._children[dep].add(child)
+        node = self
+
+        while node is not None and node._typeStr is not None:
+            node._typeStr = None
+            node = node._parent
 
         return None
 
     def getId(self):
         return self._id
 
+    def getIdx(self):
+        return self._idx
+
     def getToken(self):
         return self._tkn
 
     def getChildren(self):
-        return self._children
+        '''
+            Return the children in canonical order: dependencies sorted by
+            name, and under each dependency the distinct child nodes sorted
+            by token.
+        '''
+        children = {}
+
+        for dep in sorted(self._children):
+            nodes = {}
+
+            for node in self._children[dep].values():
+                nodes.setdefault(node.toString(), node)
+
+            children[dep] = sorted(nodes.values())
+
+        return children
+
+    def getTypeStr(self):
+        return self._typeStr
+
+    def setTypeStr(self, type_str):
+        self._typeStr = type_str
+        return None
 
     def compareTo(self, z):
         if not isinstance(z, TreeNode):
@@ -59,10 +120,10 @@ class TreeNode(object):
         return TreeNode.id_treeNodes[tree_node_id]
 
     def getTreeStr(self):
-        id_str = SortedDict()
+        id_str = {}
 
         if (len(self._children) > 0):
-            for dep, nodes in self._children.items():
+            for dep, nodes in self.getChildren().items():
                 s = ''
 
                 for node in nodes:
@@ -72,7 +133,7 @@ class TreeNode(object):
                     id_str[node.getId()] = s
 
         id_str[self._id] = self._tkn.getLemma()
-        result = ' '.join(id_str.values())
+        result = ' '.join([id_str[k] for k in sorted(id_str)])
 
         return result
 
@@ -43,6 +43,11 @@ class RelType(object):
         return result
 
     def genTypeStr(tn):
+        type_str = tn.getTypeStr()
+
+        if type_str is not None:
+            return type_str
+
         type_str = '('
         type_str += tn.toString()
         children = tn.getChildren()
@@ -58,6 +63,7 @@ class RelType(object):
                 type_str += ')'
 
         type_str += ')'
+        tn.setTypeStr(type_str)
 
         return type_str
 
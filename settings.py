@@ -1,48 +1,103 @@
+"""
+MULTIVAC settings, read from multivac.cfg the first time one is used.
+
+Module attributes (settings.data_dir, settings.sources, ...) are looked up on
+a lazily loaded Settings object, so importing this module reads no files and
+creates no directories. A directory setting is created the first time it is
+used, and the search terms, sources, filters and CoreNLP endpoints are parsed
+as Python literals.
+"""
+import ast
 import configparser
-import os
 from pathlib import Path
 
-from dotenv import load_dotenv
 from multivac.src import utilities
 
-cfg = configparser.ConfigParser()
 cfgDIR = Path(__file__).resolve().parent
+config_file_name = 'multivac.cfg'
 
-try:
-    cfg.read(cfgDIR / config_file_name)
-except NameError:
-    cfg.read(cfgDIR / 'multivac.cfg')
-
-root_dir = cfg['PATHS'].get('root_dir', cfgDIR)
-qgnet_dir = cfg['PATHS'].get('qgnet_dir', root_dir / '..' / 'qgnet')
-
-sys_dir = cfg['PATHS'].get('sys_dir', root_dir/'sys')
-data_dir = cfg['PATHS'].get('data_dir', sys_dir/'data')
-raw_dir = cfg['PATHS'].get('raw_dir', data_dir/'raw')
-interim_dir = cfg['PATHS'].get('interim_dir', data_dir/'interim')
-processed_dir = cfg['PATHS'].get('processed_dir', data_dir/'processed')
-metadata_dir = cfg['PATHS'].get('metadata_dir', processed_dir/'metadata')
-models_dir = cfg['PATHS'].get('models_dir', sys_dir/'models')
-stanf_nlp_dir = cfg['PATHS'].get('stanf_nlp_dir',
-                                 root_dir/'stanford_nlp_models')
-mln_dir = cfg['PATHS'].get('mln_dir', root_dir/'mln_models')
-
-# Get search and filter settings; default to empty lists
-terms = eval(cfg['SEARCH'].get('terms', '[]'))
-sources = eval(cfg['SEARCH'].get('sources', '[]'))
-arxiv_drops = eval(cfg['FILTER'].get('drops', '[]'))
-
-# make data directories if they don't already exist
-dirs = [
-    data_dir,
-    raw_dir,
-    interim_dir,
-    processed_dir,
-    metadata_dir,
-    models_dir,
-    stanf_nlp_dir,
-    mln_dir,
+# directory settings and their defaults, relative to other settings
+DIRS = [
+    ('root_dir', lambda s: cfgDIR),
+    ('qgnet_dir', lambda s: s.root_dir / '..' / 'qgnet'),
+    ('sys_dir', lambda s: s.root_dir / 'sys'),
+    ('data_dir', lambda s: s.sys_dir / 'data'),
+    ('raw_dir', lambda s: s.data_dir / 'raw'),
+    ('interim_dir', lambda s: s.data_dir / 'interim'),
+    ('processed_dir', lambda s: s.data_dir / 'processed'),
+    ('metadata_dir', lambda s: s.processed_dir / 'metadata'),
+    ('models_dir', lambda s: s.sys_dir / 'models'),
+    ('stanf_nlp_dir', lambda s: s.root_dir / 'stanford_nlp_models'),
+    ('mln_dir', lambda s: s.root_dir / 'mln_models'),
 ]
-dirs += [raw_dir / x for x in sources]
-for _dir in dirs:
-    utilities.mkdir(_dir)
+
+# directories made on first use, as they were on import before
+MADE_DIRS = ['data_dir', 'raw_dir', 'interim_dir', 'processed_dir',
+             'metadata_dir', 'models_dir', 'stanf_nlp_dir', 'mln_dir']
+
+# list settings: (name, config section, option)
+LISTS = [
+    ('terms', 'SEARCH', 'terms'),
+    ('sources', 'SEARCH', 'sources'),
+    ('arxiv_drops', 'FILTER', 'drops'),
+    ('corenlp_endpoints', 'CORENLP', 'endpoints'),
+]
+
+
+class Settings(object):
+    """Settings read from a config file on first access, each computed once."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._cfg = None
+        self._values = {}
+
+    @property
+    def cfg(self):
+        if self._cfg is None:
+            self._cfg = configparser.ConfigParser()
+            self._cfg.read(self.path or cfgDIR / config_file_name)
+        return self._cfg
+
+    def override(self, **values):
+        """Use values in place of the config's settings, e.g. to point a
+        benchmark at directories of its own."""
+        self._values.update(values)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._values:
+            self._values[name] = self._load(name)
+        return self._values[name]
+
+    def _load(self, name):
+        defaults = dict(DIRS)
+        if name in defaults:
+            value = self._option('PATHS', name)
+            value = Path(value) if value else defaults[name](self)
+            if name in MADE_DIRS:
+                utilities.mkdir(value)
+            if name == 'raw_dir':
+                for source in self.sources:
+                    utilities.mkdir(value / source)
+            return value
+
+        for list_name, section, option in LISTS:
+            if name == list_name:
+                # default to empty lists
+                return ast.literal_eval(self._option(section, option) or '[]')
+
+        raise AttributeError('No setting named {}'.format(name))
+
+    def _option(self, section, option):
+        if not self.cfg.has_section(section):
+            return None
+        return self.cfg[section].get(option)
+
+
+settings = Settings()
+
+
+def __getattr__(name):
+    return getattr(settings, name)
@@ -0,0 +1,712 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixture corpora for the benchmark harness.
+
+The corpora are synthetic: sentences of an epidemiology-flavoured vocabulary
+built from a fixed seed, so the same size always produces the same files and
+runs on different commits measure the same work. Document i is the same in
+every size, so the small corpus is a prefix of the medium and large ones.
+Each corpus directory holds
+
+    raw/springer/*.html     Springer-like article pages
+    raw/pubmed/*.xml        PubMed Central (JATS) article XML
+    raw/springer.json       the metadata of the Springer articles
+    parses/*.dep|input|morph
+                            dependency, POS and lemma files for the MLN
+    texts.json              {id: {'meta', 'text'}} as RDFGraph loads them
+    corenlp.jsonl           canned CoreNLP annotations of each text and
+                            its sentences
+    kg/*.txt                an OpenKE entity2id/relation2id/train2id graph
+    embeddings.txt          GloVe-format vectors of the vocabulary
+    queries.json            subject/relation/object queries of the graph
+
+and a manifest.json; corpora are written on first use and rewritten only
+when FIXTURE_VERSION changes. FakeCoreNLPServer serves the canned annotations
+over HTTP in place of a CoreNLP server, and FakeSourceServer serves canned
+arXiv, Springer and PubMed feeds of the corpus in place of their APIs.
+FakeGrobidServer answers PDFs posted to it with placeholder TEI in place of
+a GROBID service.
+"""
+import ast
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from multivac import settings
+
+FIXTURE_VERSION = 2
+
+# number of documents in each corpus
+SIZES = {'small': 25, 'medium': 100, 'large': 400}
+SENTENCES_PER_DOC = 20
+SENTENCES_PER_PARAGRAPH = 5
+EMBEDDING_DIM = 50
+
+SUBJECTS = [('virus', 'NN'), ('disease', 'NN'), ('population', 'NN'),
+            ('model', 'NN'), ('patient', 'NN'), ('vaccine', 'NN'),
+            ('pathogen', 'NN'), ('outbreak', 'NN'), ('epidemic', 'NN'),
+            ('treatment', 'NN'), ('parameter', 'NN'), ('simulation', 'NN')]
+VERBS = [('infects', 'VBZ', 'infect'), ('spreads', 'VBZ', 'spread'),
+         ('reduces', 'VBZ', 'reduce'), ('affects', 'VBZ', 'affect'),
+         ('increases', 'VBZ', 'increase'), ('predicts', 'VBZ', 'predict'),
+         ('controls', 'VBZ', 'control'), ('estimates', 'VBZ', 'estimate'),
+         ('transmits', 'VBZ', 'transmit'), ('limits', 'VBZ', 'limit')]
+OBJECTS = [('host', 'NN', 'host'), ('rate', 'NN', 'rate'),
+           ('people', 'NNS', 'people'), ('cells', 'NNS', 'cell'),
+           ('immunity', 'NN', 'immunity'), ('incidence', 'NN', 'incidence'),
+           ('contacts', 'NNS', 'contact'), ('mortality', 'NN', 'mortality'),
+           ('susceptibles', 'NNS', 'susceptible'), ('growth', 'NN', 'growth'),
+           ('risk', 'NN', 'risk'), ('spread', 'NN', 'spread'),
+           ('population', 'NN', 'population'), ('patients', 'NNS', 'patient'),
+           ('virus', 'NN', 'virus')]
+ADJECTIVES = [('rapid', 'JJ'), ('large', 'JJ'), ('new', 'JJ'),
+              ('seasonal', 'JJ'), ('stochastic', 'JJ'), ('infectious', 'JJ'),
+              ('endemic', 'JJ'), ('simple', 'JJ')]
+PLACES = [('region', 'NN'), ('city', 'NN'), ('community', 'NN'),
+          ('hospital', 'NN'), ('network', 'NN'), ('household', 'NN')]
+
+
+def corpus_dir(size, root=None):
+    return os.path.join(str(root or default_root()), size)
+
+
+def default_root():
+    return os.path.join(str(settings.interim_dir), 'benchmark', 'fixtures')
+
+
+def build(size, root=None, force=False):
+    """Write the corpus of a size under root (by default the interim data
+    directory) unless it is already there, and return its directory."""
+    if size not in SIZES:
+        raise ValueError('Fixture size must be one of {}'.format(
+            ', '.join(SIZES)))
+    path = corpus_dir(size, root)
+    manifest = load_manifest(path)
+    if manifest is not None and not force and \
+            manifest['version'] == FIXTURE_VERSION:
+        return path
+
+    print('Writing {} fixture corpus to {}'.format(size, path))
+    part = path + '.part'
+    shutil.rmtree(part, ignore_errors=True)
+    for sub in ['raw/springer', 'raw/pubmed', 'parses', 'kg']:
+        os.makedirs(os.path.join(part, sub))
+
+    docs = [make_document(i) for i in range(SIZES[size])]
+    write_raw(docs, part)
+    write_parses(docs, part)
+    write_texts(docs, part)
+    write_annotations(docs, part)
+    write_graph(docs, part)
+    write_embeddings(part)
+    write_queries(docs, part)
+
+    counts = {'documents': len(docs),
+              'sentences': sum(len(doc['sentences']) for doc in docs),
+              'tokens': sum(len(s['tokens']) for doc in docs
+                            for s in doc['sentences'])}
+    with open(os.path.join(part, 'manifest.json'), 'w') as f:
+        json.dump({'version': FIXTURE_VERSION, 'size': size,
+                   'counts': counts}, f, indent=2)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(part, path)
+    return path
+
+
+def load_manifest(path):
+    try:
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def make_document(i):
+    """Return document i: {'id', 'title', 'sentences'}, where each sentence
+    has its tokens as (word, POS, lemma), its dependencies as (relation,
+    governor, dependent) with 1-based token numbers, and its triple as token
+    spans of the subject, relation and object."""
+    rng = random.Random(i)
+    sentences = [make_sentence(rng) for _ in range(SENTENCES_PER_DOC)]
+    subj, verb, obj = (sentences[0]['triple'][0], sentences[0]['triple'][1],
+                       sentences[0]['triple'][2])
+    words = [t[0] for t in sentences[0]['tokens']]
+    title = 'On how the {} {} the {}'.format(
+        ' '.join(words[subj[0]:subj[1]]), words[verb[0]],
+        ' '.join(words[obj[0]:obj[1]]))
+    return {'id': 'bench{:05d}'.format(i), 'title': title,
+            'sentences': sentences}
+
+
+def make_sentence(rng):
+    adj, subj = rng.choice(ADJECTIVES), rng.choice(SUBJECTS)
+    verb, obj = rng.choice(VERBS), rng.choice(OBJECTS)
+    tokens = [('The', 'DT', 'the'), (adj[0], adj[1], adj[0]),
+              (subj[0], subj[1], subj[0]), verb,
+              ('the', 'DT', 'the'), obj]
+    deps = [('root', 0, 4), ('det', 3, 1), ('amod', 3, 2), ('nsubj', 4, 3),
+            ('det', 6, 5), ('dobj', 4, 6)]
+    # some subjects are bare nouns that are also objects, so the graph
+    # isn't bipartite
+    triple = [(1 if rng.random() < 0.5 else 2, 3), (3, 4), (5, 6)]
+    if rng.random() < 0.5:
+        place = rng.choice(PLACES)
+        tokens += [('in', 'IN', 'in'), ('the', 'DT', 'the'),
+                   (place[0], place[1], place[0])]
+        deps += [('case', 9, 7), ('det', 9, 8), ('nmod', 4, 9)]
+    tokens.append(('.', '.', '.'))
+    deps.append(('punct', 4, len(tokens)))
+    return {'tokens': tokens, 'deps': deps, 'triple': triple}
+
+
+def sentence_text(sentence):
+    return ' '.join(t[0] for t in sentence['tokens'][:-1]) + '.'
+
+
+def paragraphs(doc):
+    sents = [sentence_text(s) for s in doc['sentences']]
+    return [' '.join(sents[i:i + SENTENCES_PER_PARAGRAPH])
+            for i in range(0, len(sents), SENTENCES_PER_PARAGRAPH)]
+
+
+def document_text(doc):
+    return ' '.join(paragraphs(doc))
+
+
+def write_raw(docs, path):
+    """Even documents become Springer HTML pages, odd ones PubMed XML."""
+    metadata = []
+    for i, doc in enumerate(docs):
+        if i % 2 == 0:
+            fn = doc['id'] + '.html'
+            body = ''.join('<p>{}</p>'.format(escape(p))
+                           for p in paragraphs(doc))
+            page = ('<html><head><title>{0}</title></head><body>'
+                    '<nav>Journal home</nav><article><h1>{0}</h1>{1}'
+                    '</article></body></html>').format(escape(doc['title']),
+                                                       body)
+            with open(os.path.join(path, 'raw', 'springer', fn), 'w',
+                      encoding='utf-8') as f:
+                f.write(page)
+            metadata.append({'fn': fn, 'doi': '10.0000/' + doc['id'],
+                             'title': doc['title']})
+        else:
+            with open(os.path.join(path, 'raw', 'pubmed', doc['id'] + '.xml'),
+                      'w', encoding='utf-8') as f:
+                f.write(pubmed_xml(doc))
+    with open(os.path.join(path, 'raw', 'springer.json'), 'w') as f:
+        json.dump(metadata, f, indent=1)
+
+
+def pubmed_xml(doc):
+    body = ''.join('<p>{}</p>'.format(escape(p)) for p in paragraphs(doc))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<article article-type="research-article"><front>'
+        '<journal-meta><journal-title-group><journal-title>Benchmark Journal'
+        '</journal-title></journal-title-group></journal-meta>'
+        '<article-meta>'
+        '<article-id pub-id-type="pmc">{id}</article-id>'
+        '<article-id pub-id-type="doi">10.0000/{id}</article-id>'
+        '<title-group><article-title>{title}</article-title></title-group>'
+        '<pub-date pub-type="ppub"><day>1</day><month>1</month>'
+        '<year>2019</year></pub-date>'
+        '<pub-date pub-type="epub"><day>1</day><month>1</month>'
+        '<year>2019</year></pub-date>'
+        '<abstract><p>{abstract}</p></abstract>'
+        '</article-meta></front><body><sec><title>Results</title>{body}'
+        '</sec></body></article>\n').format(
+            id=doc['id'], title=escape(doc['title']),
+            abstract=escape(sentence_text(doc['sentences'][0])), body=body)
+
+
+def write_parses(docs, path):
+    """The .dep, .input and .morph files the MLN reads."""
+    for doc in docs:
+        stem = os.path.join(path, 'parses', doc['id'])
+        with open(stem + '.dep', 'w') as dep, \
+                open(stem + '.input', 'w') as inp, \
+                open(stem + '.morph', 'w') as mor:
+            for s in doc['sentences']:
+                words = ['ROOT'] + [t[0] for t in s['tokens']]
+                for word, pos, lemma in s['tokens']:
+                    inp.write('{}_{}\n'.format(word, pos))
+                    mor.write(lemma + '\n')
+                for rel, gov, dependent in s['deps']:
+                    dep.write('{}({}-{}, {}-{})\n'.format(
+                        rel, words[gov], gov, words[dependent], dependent))
+                inp.write('\n')
+                mor.write('\n')
+                dep.write('\n')
+
+
+def write_texts(docs, path):
+    texts = {doc['id']: {'meta': {'title': doc['title']},
+                         'text': document_text(doc)} for doc in docs}
+    with open(os.path.join(path, 'texts.json'), 'w') as f:
+        json.dump(texts, f)
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def write_annotations(docs, path):
+    """One line per text: {'hash', 'sentences', 'annotation'}, where
+    annotation is the JSON CoreNLP returns for the annotators RDFGraph asks
+    for and sentences are the hashes of the text's sentences."""
+    with open(os.path.join(path, 'corenlp.jsonl'), 'w') as f:
+        for doc in docs:
+            text = document_text(doc)
+            f.write(json.dumps({
+                'hash': text_hash(text),
+                'sentences': [text_hash(sentence_text(s))
+                              for s in doc['sentences']],
+                'annotation': annotate(doc)}) + '\n')
+
+
+def annotate(doc):
+    sentences = []
+    offset = 0
+    for n, s in enumerate(doc['sentences']):
+        tokens = []
+        for i, (word, pos, lemma) in enumerate(s['tokens']):
+            if word == '.':
+                offset -= 1
+            tokens.append({'index': i + 1, 'word': word, 'originalText': word,
+                           'lemma': lemma, 'pos': pos, 'ner': 'O',
+                           'characterOffsetBegin': offset,
+                           'characterOffsetEnd': offset + len(word)})
+            offset += len(word) + 1
+        words = ['ROOT'] + [t[0] for t in s['tokens']]
+        deps = [{'dep': rel.upper() if rel == 'root' else rel,
+                 'governor': gov, 'governorGloss': words[gov],
+                 'dependent': dependent, 'dependentGloss': words[dependent]}
+                for rel, gov, dependent in s['deps']]
+        triple = {}
+        for part, (start, end) in zip(['subject', 'relation', 'object'],
+                                      s['triple']):
+            triple[part] = ' '.join(words[start + 1:end + 1])
+            triple[part + 'Span'] = [start, end]
+        sentences.append({'index': n, 'tokens': tokens,
+                          'basicDependencies': deps, 'openie': [triple]})
+    return {'sentences': sentences}
+
+
+def triples(docs):
+    for doc in docs:
+        for s in doc['sentences']:
+            lemmas = [t[2] for t in s['tokens']]
+            yield tuple(' '.join(lemmas[start:end])
+                        for start, end in s['triple'])
+
+
+def write_graph(docs, path):
+    """The graph of the lemmatized triples, in the format output_to_openke
+    writes."""
+    entities, relations, edges = {}, {}, set()
+    for subj, rel, obj in triples(docs):
+        for entity in (subj, obj):
+            entities.setdefault(entity, len(entities))
+        relations.setdefault(rel, len(relations))
+        edges.add((entities[subj], entities[obj], relations[rel]))
+
+    for name, ids in [('entity2id', entities), ('relation2id', relations)]:
+        with open(os.path.join(path, 'kg', name + '.txt'), 'w') as f:
+            f.write('{}\n'.format(len(ids)))
+            for key, i in ids.items():
+                f.write('{}\t{} \n'.format(key, i))
+    with open(os.path.join(path, 'kg', 'train2id.txt'), 'w') as f:
+        f.write('{}\n'.format(len(edges)))
+        for h, t, r in sorted(edges):
+            f.write('{}\t{}\t{} \n'.format(h, t, r))
+
+
+def vocabulary():
+    words = {'the', 'in'}
+    for group in (SUBJECTS, VERBS, OBJECTS, ADJECTIVES, PLACES):
+        for entry in group:
+            words.update(entry[:1] + entry[2:])
+    return sorted(words)
+
+
+def write_embeddings(path):
+    rng = np.random.RandomState(0)
+    with open(os.path.join(path, 'embeddings.txt'), 'w') as f:
+        for word in vocabulary():
+            f.write(word + ' ' + ' '.join(
+                '{:.6f}'.format(v) for v in rng.randn(EMBEDDING_DIM)) + '\n')
+
+
+def write_queries(docs, path, per_doc=2):
+    """Queries with one part of a triple left out, as the GAN asks them."""
+    rng = random.Random(len(docs))
+    queries = []
+    for doc in docs:
+        for subj, rel, obj in rng.sample(list(triples([doc])), per_doc):
+            query = {'subject': subj, 'relation': rel, 'object': obj}
+            del query[rng.choice(['subject', 'relation', 'object'])]
+            queries.append(query)
+    with open(os.path.join(path, 'queries.json'), 'w') as f:
+        json.dump(queries, f)
+
+
+class FakeCoreNLPClient(object):
+    """Stand-in for corenlp.CoreNLPClient that answers annotate() with the
+    canned annotations of a corpus, read from disk as they are asked for.
+    With ssplit.eolonly each line is a sentence, answered on its own.
+    Texts without an annotation get a whitespace tokenization."""
+
+    def __init__(self, canned, annotators=None, output_format='json',
+                 **kwargs):
+        self.annotators = annotators
+        self.default_properties = {}
+        self.calls = 0
+        self._file = open(canned, 'rb')
+        self._lock = threading.Lock()
+        self._texts, self._sentences = {}, {}
+        offset = 0
+        for line in self._file:
+            entry = json.loads(line)
+            self._texts[entry['hash']] = offset
+            for n, h in enumerate(entry['sentences']):
+                self._sentences[h] = (offset, n)
+            offset += len(line)
+
+    def annotate(self, text, annotators=None, output_format=None,
+                 properties=None):
+        self.calls += 1
+        if (properties or {}).get('ssplit.eolonly') == 'true':
+            sentences = []
+            for i, line in enumerate(text.split('\n')):
+                found = self._sentences.get(text_hash(line))
+                if found is None:
+                    sentence = self._tokenize(line)['sentences'][0]
+                else:
+                    sentence = self._read(found[0])['sentences'][found[1]]
+                sentence['index'] = i
+                sentences.append(sentence)
+            return {'sentences': sentences}
+
+        offset = self._texts.get(text_hash(text))
+        if offset is None:
+            return self._tokenize(text)
+        return self._read(offset)
+
+    def _read(self, offset):
+        with self._lock:
+            self._file.seek(offset)
+            return json.loads(self._file.readline())['annotation']
+
+    @staticmethod
+    def _tokenize(text):
+        tokens = [{'index': i + 1, 'word': w, 'originalText': w, 'lemma': w,
+                   'pos': 'NN', 'ner': 'O'}
+                  for i, w in enumerate(text.split())]
+        return {'sentences': [{'index': 0, 'tokens': tokens}]}
+
+    def close(self):
+        self._file.close()
+
+
+TIMEOUT_MESSAGE = 'CoreNLP request timed out. Your document may be too long.'
+
+
+class FakeCoreNLPServer(ThreadingHTTPServer):
+    """A local HTTP server speaking the CoreNLP server's protocol, answering
+    from a FakeCoreNLPClient, so CoreNLPClient and CoreNLPPool can be run
+    against it. Requests of more than max_sentences lines answer as a timed
+    out CoreNLP server does, and each sentence takes delay seconds.
+
+        server = FakeCoreNLPServer(canned)      # port 0: any free port
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        CoreNLPClient(start_server=False, endpoint=server.endpoint)
+    """
+    daemon_threads = True
+
+    def __init__(self, canned, port=0, max_sentences=None, delay=0.0):
+        super().__init__(('localhost', port), _FakeCoreNLPHandler)
+        self.client = FakeCoreNLPClient(canned)
+        self.max_sentences = max_sentences
+        self.delay = delay
+        self.endpoint = 'http://localhost:{}'.format(self.server_address[1])
+
+
+class _FakeCoreNLPHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        # CoreNLPClient checks the server is up with /ping
+        self._reply(200, b'pong', 'text/plain')
+
+    def do_POST(self):
+        server = self.server
+        query = parse_qs(urlparse(self.path).query)
+        # CoreNLPClient sends the properties as a Python dict's repr
+        properties = ast.literal_eval(query.get('properties', ['{}'])[0])
+        length = int(self.headers.get('Content-Length', 0))
+        text = self.rfile.read(length).decode('utf-8')
+
+        lines = text.count('\n') + 1
+        if server.max_sentences and lines > server.max_sentences:
+            self._reply(500, TIMEOUT_MESSAGE.encode(), 'text/plain')
+            return
+        if server.delay:
+            time.sleep(server.delay * lines)
+        doc = server.client.annotate(text, properties=properties)
+        self._reply(200, json.dumps(doc).encode(), 'application/json')
+
+    def _reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSourceServer(ThreadingHTTPServer):
+    """A local HTTP server standing in for the arXiv, Springer and PubMed
+    APIs, with canned feeds of a corpus, so the fetcher in get.py can be run
+    against it. Every document is an arXiv entry with a placeholder PDF, the
+    Springer pages are the corpus's HTML, answered conditionally on their
+    ETags, and the PubMed articles are its XML. With fail_every=n, every nth
+    request answers 503, as an overloaded API does.
+
+        server = FakeSourceServer(corpus)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        sources = server.sources(get.SOURCES)
+    """
+    daemon_threads = True
+
+    # api path of each source under the server's endpoint
+    APIS = {'arxiv': '/arxiv/api/query', 'springer': '/springer/api',
+            'pubmed': '/pubmed'}
+
+    def __init__(self, corpus, port=0, fail_every=None):
+        super().__init__(('localhost', port), _FakeSourceHandler)
+        self.corpus = corpus
+        self.fail_every = fail_every
+        self.endpoint = 'http://localhost:{}'.format(self.server_address[1])
+        self.requests = 0
+        self.failures = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+
+        with open(os.path.join(corpus, 'raw', 'springer.json'), 'r') as f:
+            self.springer = json.load(f)
+        self.pubmed = sorted(fn[:-len('.xml')] for fn in os.listdir(
+            os.path.join(corpus, 'raw', 'pubmed')))
+        with open(os.path.join(corpus, 'texts.json'), 'r') as f:
+            self.arxiv = sorted(json.load(f))
+
+    def sources(self, sources):
+        """A copy of get.SOURCES pointed at this server, without rate
+        limits."""
+        return {name: dict(source, api=self.endpoint + self.APIS[name],
+                           rate=0)
+                for name, source in sources.items()}
+
+    def count(self):
+        """Count a request; returns True if it should fail."""
+        with self._lock:
+            self.requests += 1
+            fail = bool(self.fail_every) and \
+                self.requests % self.fail_every == 0
+            self.failures += fail
+            return fail
+
+    def arxiv_feed(self, start, max_results):
+        entries = ''.join(
+            '<entry><id>{0}/arxiv/abs/{1}v1</id>'
+            '<updated>2019-01-01T00:00:00Z</updated>'
+            '<title>{1}</title><summary>{1}</summary>'
+            '<category term="q-bio.PE"/></entry>'.format(self.endpoint, i)
+            for i in self.arxiv[start:start + max_results])
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch='
+                '"http://a9.com/-/spec/opensearch/1.1/">'
+                '<opensearch:totalResults>{}</opensearch:totalResults>{}'
+                '</feed>').format(len(self.arxiv), entries)
+
+    def springer_page(self, s, p):
+        records = [{'doi': md['doi'], 'identifier': md['fn'],
+                    'title': md['title'],
+                    'url': [{'format': 'html', 'value': '{}/springer/html/{}'
+                             .format(self.endpoint, md['fn'])}]}
+                   for md in self.springer[s - 1:s - 1 + p]]
+        return {'result': [{'total': str(len(self.springer))}],
+                'records': records}
+
+
+class _FakeSourceHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if server.count():
+            self._reply(503, b'Service unavailable', 'text/plain')
+            return
+
+        if url.path == server.APIS['arxiv']:
+            feed = server.arxiv_feed(int(query.get('start', 0)),
+                                     int(query.get('max_results', 10)))
+            self._reply(200, feed.encode(), 'application/atom+xml')
+        elif url.path.startswith('/arxiv/pdf/'):
+            name = url.path[len('/arxiv/pdf/'):]
+            self._reply(200, b'%PDF-1.4 placeholder ' + name.encode(),
+                        'application/pdf')
+        elif url.path == server.APIS['springer']:
+            page = server.springer_page(int(query.get('s', 1)),
+                                        int(query.get('p', 10)))
+            self._reply(200, json.dumps(page).encode(), 'application/json')
+        elif url.path.startswith('/springer/html/'):
+            self._file('springer', url.path[len('/springer/html/'):],
+                       'text/html')
+        elif url.path == server.APIS['pubmed'] + '/esearch.fcgi':
+            ids = ''.join('<Id>{}</Id>'.format(i) for i in server.pubmed)
+            self._reply(200, ('<eSearchResult><IdList>{}</IdList>'
+                              '</eSearchResult>').format(ids).encode(),
+                        'text/xml')
+        elif url.path == server.APIS['pubmed'] + '/efetch.fcgi':
+            self._file('pubmed', query.get('id', '') + '.xml', 'text/xml')
+        else:
+            self._reply(404, b'Not found', 'text/plain')
+
+    def _file(self, source, fn, content_type):
+        """Answer with a raw file of the corpus, or 304 if the client's copy
+        has the same ETag."""
+        path = os.path.join(self.server.corpus, 'raw', source,
+                            os.path.basename(fn))
+        if not os.path.exists(path):
+            self._reply(404, b'Not found', 'text/plain')
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            with self.server._lock:
+                self.server.not_modified += 1
+            self._reply(304, b'', content_type, {'ETag': etag})
+            return
+        self._reply(200, body, content_type, {'ETag': etag})
+
+    def _reply(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGrobidServer(ThreadingHTTPServer):
+    """A local HTTP server standing in for a GROBID service, so
+    extract_text.grobid_client can be run against it. /api/isalive answers
+    200, and every PDF posted to another /api/ service gets a small TEI
+    document naming it back. With fail_every=n, every nth PDF posted answers
+    503, as a busy GROBID does, and each PDF takes delay seconds.
+
+        server = FakeGrobidServer(fail_every=10)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        server.write_config('config.json', sleep_time=0.01)
+        grobid_client('config.json')
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, fail_every=None, delay=0.0):
+        super().__init__(('localhost', port), _FakeGrobidHandler)
+        self.fail_every = fail_every
+        self.delay = delay
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def write_config(self, path, **options):
+        """Write a grobid_client config file pointing at this server; options
+        (e.g. sleep_time, max_retries, batch_size) are added to it."""
+        config = dict(grobid_server='localhost',
+                      grobid_port=str(self.server_address[1]),
+                      coordinates=['persName', 'figure', 'ref'], **options)
+        with open(path, 'w') as f:
+            json.dump(config, f)
+        return path
+
+    def count(self):
+        """Count a request; returns True if it should fail."""
+        with self._lock:
+            self.requests += 1
+            fail = bool(self.fail_every) and \
+                self.requests % self.fail_every == 0
+            self.failures += fail
+            return fail
+
+
+class _FakeGrobidHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/api/isalive':
+            self._reply(200, b'true', 'text/plain')
+        else:
+            self._reply(404, b'Not found', 'text/plain')
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if not urlparse(self.path).path.startswith('/api/'):
+            self._reply(404, b'Not found', 'text/plain')
+            return
+        if server.count():
+            self._reply(503, b'Service unavailable', 'text/plain')
+            return
+        if server.delay:
+            time.sleep(server.delay)
+
+        # the file name of the multipart 'input' part
+        match = re.search(rb'filename="([^"]*)"', body)
+        name = os.path.basename(match.group(1).decode('utf-8')) \
+            if match else ''
+        tei = ('<?xml version="1.0" encoding="UTF-8"?>'
+               '<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader>'
+               '<fileDesc><titleStmt><title>{}</title></titleStmt>'
+               '</fileDesc></teiHeader><text><body/></text></TEI>').format(
+                   escape(name))
+        self._reply(200, tei.encode(), 'application/xml')
+
+    def _reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(canned, port=0, max_sentences=None, delay=0.0):
+    """Run a FakeCoreNLPServer until killed."""
+    server = FakeCoreNLPServer(canned, port, max_sentences, delay)
+    print('Fake CoreNLP server at {}'.format(server.endpoint))
+    server.serve_forever()
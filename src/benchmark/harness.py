@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the pipeline stages on the fixture corpora.
+
+    python -m multivac.src.benchmark.harness --size medium
+    python -m multivac.src.benchmark.harness --compare old.json new.json
+
+Each stage runs in a forked process of its own, so its peak memory is its own
+and the class-level state of the MLN starts empty, and CoreNLP is replaced by
+local fake servers answering from the corpus's canned annotations, as the
+source APIs and GROBID are by fake servers of their own. Nothing is
+fetched from the network. The report records, per stage, the items processed, the
+seconds taken, the throughput and the peak resident memory, along with the
+commit it was run on, and is written as JSON so that reports of two commits
+can be compared.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+
+from multivac import settings
+from multivac.src import instrument
+from multivac.src.benchmark import fixtures
+
+RDF_GRAPH_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'rdf_graph')
+
+# the conductor's defaults, with a single worker so results don't depend on
+# the machine's core count, and two fake CoreNLP servers
+DEFAULT_OPTIONS = {'workers': 1, 'prior_num_param': 5, 'prior_num_conj': 10,
+                   'agenda_batch': 1, 'corenlp_servers': 2,
+                   'corenlp_concurrency': 2, 'fail_every': 10,
+                   'grobid_concurrency': 4}
+
+
+class Measure(object):
+    """Passed to each benchmark: time the part to measure with `with
+    measure.timed():` (by default the whole benchmark is timed) and record
+    counts with measure.extra."""
+
+    def __init__(self):
+        self.seconds = None
+        self.extra = OrderedDict()
+
+    def timed(self):
+        return _Timer(self)
+
+
+class _Timer(object):
+
+    def __init__(self, measure):
+        self.measure = measure
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.measure.seconds = (self.measure.seconds or 0.0) + \
+            time.perf_counter() - self.start
+        return False
+
+
+def bench_collection(corpus, workdir, options, measure):
+    """Download the corpus with get.py's collectors from a fake server
+    standing in for the arXiv, Springer and PubMed APIs, with every
+    fail_every-th request answering 503, then collect again, when only
+    conditional requests and skips are left."""
+    from multivac.src.data import get
+
+    server = fixtures.FakeSourceServer(corpus,
+                                       fail_every=options['fail_every'])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # this process is forked for the benchmark, so the settings it changes
+    # are its own
+    raw_dir = os.path.join(workdir, 'raw')
+    for source in fixtures.FakeSourceServer.APIS:
+        os.makedirs(os.path.join(raw_dir, source))
+    os.makedirs(os.path.join(workdir, 'metadata'))
+    settings.override(raw_dir=Path(raw_dir),
+                      metadata_dir=Path(workdir) / 'metadata',
+                      terms=['epidemic model'])
+    sources = server.sources(get.SOURCES)
+
+    try:
+        with measure.timed():
+            get.collect_get_main(verbose=False, sources=sources,
+                                 backoff=0.01)
+        requests = server.requests
+        start = time.perf_counter()
+        get.collect_get_main(verbose=False, sources=sources, backoff=0.01)
+        measure.extra['recollect_seconds'] = round(
+            time.perf_counter() - start, 4)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    files = sum(len(os.listdir(os.path.join(raw_dir, source)))
+                for source in fixtures.FakeSourceServer.APIS)
+    failed = 0
+    for source in fixtures.FakeSourceServer.APIS:
+        with open(os.path.join(workdir, 'metadata',
+                               source + '_failed.txt'), 'r') as f:
+            failed += len(f.read().split())
+    measure.extra.update({'requests': requests,
+                          'recollect_requests': server.requests - requests,
+                          'served_503': server.failures,
+                          'not_modified': server.not_modified,
+                          'failed': failed})
+    return files, 'documents'
+
+
+def bench_pdf_extraction(corpus, workdir, options, measure):
+    """Send a placeholder PDF of each document to a fake GROBID service with
+    extract_text.grobid_client, with every fail_every-th PDF answering 503 so
+    the client backs off and retries, then run again, when every TEI file is
+    there and each PDF is skipped."""
+    from multivac.src.data import extract_text
+
+    with open(os.path.join(corpus, 'texts.json'), 'r') as f:
+        names = sorted(json.load(f))
+    pdf_dir = os.path.join(workdir, 'pdf')
+    tei_dir = os.path.join(workdir, 'tei')
+    os.makedirs(pdf_dir)
+    os.makedirs(tei_dir)
+    for name in names:
+        with open(os.path.join(pdf_dir, name + '.pdf'), 'wb') as f:
+            f.write(b'%PDF-1.4 placeholder ' + name.encode())
+
+    server = fixtures.FakeGrobidServer(fail_every=options['fail_every'])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = server.write_config(os.path.join(workdir, 'config.json'),
+                                 sleep_time=0.01)
+    n = options['grobid_concurrency']
+    try:
+        client = extract_text.grobid_client(config_path=config)
+        with measure.timed():
+            results = client.process(pdf_dir, tei_dir, n,
+                                     'processFulltextDocument', False, False,
+                                     False, False, False)
+        start = time.perf_counter()
+        rerun = client.process(pdf_dir, tei_dir, n,
+                               'processFulltextDocument', False, False,
+                               False, False, False)
+        measure.extra['rerun_seconds'] = round(time.perf_counter() - start, 4)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    for status in ['processed', 'skipped', 'failed']:
+        measure.extra[status] = sum(1 for _, s, _ in results if s == status)
+    measure.extra.update({'requests': server.requests,
+                          'served_503': server.failures,
+                          'rerun_skipped': sum(1 for _, s, _ in rerun
+                                               if s == 'skipped')})
+    return len(names), 'documents'
+
+
+def bench_processing(corpus, workdir, options, measure):
+    """Parse the raw Springer HTML and PubMed XML into JSONL records."""
+    from multivac.src.data.process import process_documents
+
+    with open(os.path.join(corpus, 'raw', 'springer.json'), 'r') as f:
+        springer = json.load(f)
+    tasks = [('springer', md['fn'], None,
+              os.path.join(corpus, 'raw', 'springer', md['fn']), md)
+             for md in springer]
+    pubmed_dir = os.path.join(corpus, 'raw', 'pubmed')
+    tasks += [('pubmed', fn, None, os.path.join(pubmed_dir, fn), None)
+              for fn in sorted(os.listdir(pubmed_dir))]
+
+    with measure.timed():
+        counts = process_documents(tasks, os.path.join(workdir, 'data.jsonl'),
+                                   workers=options['workers'])
+    measure.extra.update(counts)
+    return len(tasks), 'documents'
+
+
+def bench_parse_reading(corpus, workdir, options, measure):
+    """Read the .dep/.input/.morph files into MLN articles."""
+    from multivac.pymln.syntax.StanfordParseReader import StanfordParseReader
+
+    parse_dir = os.path.join(corpus, 'parses')
+    files = sorted(f for f in os.listdir(parse_dir) if f.endswith('.dep'))
+    with measure.timed():
+        articles = [StanfordParseReader.readParse(f, parse_dir)
+                    for f in files]
+    measure.extra['sentences'] = sum(len(a.sentences) for a in articles)
+    return len(files), 'documents'
+
+
+def bench_rdf_extraction(corpus, workdir, options, measure):
+    """Extract and preprocess triples with RDFGraph, parsing with fake
+    CoreNLP servers that answer from the canned annotations."""
+    # rdf_graph imports rdf_parse as a top-level module
+    sys.path.insert(0, RDF_GRAPH_DIR)
+    from multivac.src.rdf_graph.rdf_graph import RDFGraph
+
+    servers = start_servers(os.path.join(corpus, 'corenlp.jsonl'),
+                            options['corenlp_servers'])
+    try:
+        graph = RDFGraph(openke_output_folder=workdir,
+                         endpoints=[endpoint for endpoint, _ in servers],
+                         concurrency=options['corenlp_concurrency'])
+        graph.load_texts(os.path.join(corpus, 'texts.json'))
+        n_docs = len(graph.all_texts)
+        # extract_raw_tuples pickles its tuples to the working directory
+        os.chdir(workdir)
+        with measure.timed():
+            graph.extract_raw_tuples()
+            graph.preprocess_raw_tuples()
+        measure.extra.update(graph.parser.nlp_client.stats)
+        measure.extra['tuples'] = len(graph.tuples_preprocessed)
+    finally:
+        for _, process in servers:
+            process.terminate()
+            process.join()
+    return n_docs, 'documents'
+
+
+def start_servers(canned, n):
+    """Start n FakeCoreNLPServers in processes of their own; returns their
+    (endpoint, process)."""
+    servers = []
+    for _ in range(n):
+        server = fixtures.FakeCoreNLPServer(canned)
+        process = mp.get_context('fork').Process(target=server.serve_forever,
+                                                 daemon=True)
+        process.start()
+        server.server_close()
+        servers.append((server.endpoint, process))
+    return servers
+
+
+def bench_mln(corpus, workdir, options, measure):
+    """Induce an MLN from the parses, as mln_main does."""
+    from multivac.pymln.semantic import Parse
+    from multivac.pymln.syntax.StanfordParseReader import StanfordParseReader
+
+    parse_dir = os.path.join(corpus, 'parses')
+    files = sorted(f for f in os.listdir(parse_dir) if f.endswith('.dep'))
+    articles = [StanfordParseReader.readParse(f, parse_dir) for f in files]
+    parser = Parse(options['prior_num_param'], options['prior_num_conj'])
+
+    with measure.timed():
+        parser.initialize(articles)
+        parser.mergeArgs()
+        parser.agenda.createAgenda()
+        stats = parser.agenda.procAgenda(batch_size=options['agenda_batch'])
+    measure.extra['sentences'] = parser.numSents
+    measure.extra['merges'] = stats['exec_merge_clust']
+    measure.extra['composes'] = stats['exec_compose']
+    return parser.numSents, 'sentences'
+
+
+def bench_kg_query(corpus, workdir, options, measure):
+    """Rank the graph's entities by centrality, as get_kg_query_params does,
+    and match each query to its nearest entities and relations by mean word
+    embedding, as map_queries does before asking the OpenKE model."""
+    import numpy as np
+    from multivac import get_kg_query_params as kg
+    from multivac.src.data.embeddings import EmbeddingStore
+
+    kg_dir = os.path.join(corpus, 'kg')
+    with open(os.path.join(corpus, 'queries.json'), 'r') as f:
+        queries = json.load(f)
+    # converting the embeddings is a one-off cost, not part of a query
+    embeddings = os.path.join(workdir, 'embeddings.txt')
+    shutil.copy(os.path.join(corpus, 'embeddings.txt'), embeddings)
+    store = EmbeddingStore.open(embeddings)
+
+    with measure.timed():
+        entities = kg.read_txt(os.path.join(kg_dir, 'entity2id.txt'))
+        relations = kg.read_txt(os.path.join(kg_dir, 'relation2id.txt'))
+        net = kg.build_network(kg.read_txt(os.path.join(kg_dir,
+                                                        'train2id.txt')))
+        for measure_name in ['degree', 'eigenvector']:
+            kg.analyze_network(net, {'measure': measure_name,
+                                     'num_results': 10})
+
+        names = {}
+        for kind, rows in [('entity', entities), ('relation', relations)]:
+            vectors = store.mean_vectors([row[0] for row in rows])
+            keys = list(vectors)
+            matrix = np.array([vectors[k] for k in keys])
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+            names[kind] = (keys, matrix)
+
+        matches = []
+        for query in queries:
+            for part, kind in [('subject', 'entity'), ('object', 'entity'),
+                               ('relation', 'relation')]:
+                vector = store.mean_vectors([query.get(part, '')])
+                if not vector:
+                    continue
+                vector = next(iter(vector.values()))
+                keys, matrix = names[kind]
+                scores = matrix @ (vector / np.linalg.norm(vector))
+                matches.append(keys[int(np.argmax(scores))])
+    measure.extra['matches'] = len(matches)
+    measure.extra['entities'] = len(entities)
+    measure.extra['edges'] = net.number_of_edges()
+    return len(queries), 'queries'
+
+
+STAGES = OrderedDict([
+    ('collection', bench_collection),
+    ('pdf_extraction', bench_pdf_extraction),
+    ('processing', bench_processing),
+    ('parse_reading', bench_parse_reading),
+    ('rdf_extraction', bench_rdf_extraction),
+    ('mln', bench_mln),
+    ('kg_query', bench_kg_query),
+])
+
+
+def _run_child(bench, corpus, workdir, options, conn):
+    rss_start = instrument.rss_mb()
+    measure = Measure()
+    result = {'rss_start_mb': rss_start}
+    start = time.perf_counter()
+    try:
+        with instrument.span('benchmark.' + bench.__name__[len('bench_'):]):
+            items, unit = bench(corpus, workdir, options, measure)
+        seconds = measure.seconds
+        if seconds is None:
+            seconds = time.perf_counter() - start
+        result.update({'status': 'ok', 'items': items, 'unit': unit,
+                       'seconds': round(seconds, 4),
+                       'throughput': round(items / seconds, 2)
+                       if seconds else None})
+    except Exception as e:
+        traceback.print_exc()
+        result.update({'status': 'error',
+                       'error': '{}: {}'.format(type(e).__name__, e)})
+    # pools the stage started count towards its peak
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    children /= 2**20 if sys.platform == 'darwin' else 2**10
+    result['peak_rss_mb'] = max(instrument.peak_rss_mb(),
+                                round(children, 1))
+    result['extra'] = measure.extra
+    conn.send(result)
+    conn.close()
+
+
+def run_stage(name, corpus, workdir, options):
+    """Run one benchmark in a forked process and return its result."""
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    ctx = mp.get_context('fork')
+    receive, send = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_child, name='benchmark-' + name,
+                          args=(STAGES[name], corpus, workdir, options, send))
+    process.start()
+    send.close()
+    try:
+        result = receive.recv()
+    except EOFError:
+        result = {'status': 'error',
+                  'error': 'benchmark process died'}
+    process.join()
+    if process.exitcode and result['status'] == 'ok':
+        result = {'status': 'error',
+                  'error': 'exit code {}'.format(process.exitcode)}
+    return result
+
+
+def run(size, stages=None, repeat=1, options=None, root=None):
+    """Benchmark the stages on the corpus of a size, keeping the fastest of
+    repeat runs of each, and return the report."""
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    corpus = fixtures.build(size, root)
+    base = os.path.join(os.path.dirname(os.path.dirname(corpus)), 'work')
+    report = OrderedDict([
+        ('commit', git_commit()),
+        ('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('size', size),
+        ('fixture_version', fixtures.FIXTURE_VERSION),
+        ('corpus', fixtures.load_manifest(corpus)['counts']),
+        ('options', options),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpus', os.cpu_count()),
+        ('stages', OrderedDict()),
+    ])
+
+    for name in [s for s in STAGES if stages is None or s in stages]:
+        print('Benchmarking {} ({})'.format(name, size))
+        runs = [run_stage(name, corpus, os.path.join(base, name), options)
+                for _ in range(repeat)]
+        ok = [r for r in runs if r['status'] == 'ok']
+        best = min(ok, key=lambda r: r['seconds']) if ok else runs[-1]
+        if len(ok) > 1:
+            best['runs'] = [r['seconds'] for r in ok]
+        report['stages'][name] = best
+    shutil.rmtree(base, ignore_errors=True)
+    return report
+
+
+def git_commit():
+    """The commit checked out, marked -dirty if the tree has changes."""
+    root = os.path.dirname(os.path.abspath(settings.__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=root, stderr=subprocess.DEVNULL)
+        status = subprocess.check_output(['git', 'status', '--porcelain',
+                                          '--untracked-files=no'],
+                                         cwd=root, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode().strip() + ('-dirty' if status.strip() else '')
+
+
+def save_report(report, results_dir=None):
+    results_dir = str(results_dir or default_results_dir())
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, '{}-{}-{}.json'.format(
+        report['size'], (report['commit'] or 'unknown')[:12],
+        report['created'].replace(':', '')))
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def default_results_dir():
+    return os.path.join(str(settings.interim_dir), 'benchmark', 'results')
+
+
+def print_report(report):
+    print('{} corpus, commit {}'.format(report['size'], report['commit']))
+    print('{:<15} {:<6} {:>8} {:<10} {:>9} {:>11} {:>9}'.format(
+        'stage', 'status', 'items', 'unit', 'seconds', 'items/s',
+        'peak MB'))
+    for name, row in report['stages'].items():
+        if row['status'] != 'ok':
+            print('{:<15} {:<6} {}'.format(name, row['status'],
+                                           row.get('error', '')))
+            continue
+        print('{:<15} {:<6} {:>8} {:<10} {:>9.2f} {:>11.1f} {:>9.1f}'.format(
+            name, row['status'], row['items'], row['unit'], row['seconds'],
+            row['throughput'] or 0.0, row['peak_rss_mb']))
+
+
+def compare(old, new, tolerance=0.1):
+    """Print the throughput and peak memory of two reports side by side and
+    return the stages that got slower or bigger by more than tolerance."""
+    if old['size'] != new['size'] or \
+            old['fixture_version'] != new['fixture_version']:
+        print('Warning: the reports are of different corpora')
+    print('{} -> {}'.format(old['commit'], new['commit']))
+    print('{:<15} {:>11} {:>11} {:>7} {:>9} {:>9} {:>7}'.format(
+        'stage', 'old items/s', 'new items/s', 'speed', 'old MB', 'new MB',
+        'memory'))
+    regressions = []
+    for name in new['stages']:
+        a, b = old['stages'].get(name), new['stages'][name]
+        if a is None or a['status'] != 'ok' or b['status'] != 'ok':
+            print('{:<15} {}'.format(name, 'not comparable: {} -> {}'.format(
+                a['status'] if a else 'missing', b['status'])))
+            continue
+        speed = b['throughput'] / a['throughput']
+        memory = b['peak_rss_mb'] / a['peak_rss_mb']
+        flag = ''
+        if speed < 1 - tolerance or memory > 1 + tolerance:
+            regressions.append(name)
+            flag = '  !'
+        print('{:<15} {:>11.1f} {:>11.1f} {:>6.2f}x {:>9.1f} {:>9.1f} '
+              '{:>6.2f}x{}'.format(name, a['throughput'], b['throughput'],
+                                   speed, a['peak_rss_mb'], b['peak_rss_mb'],
+                                   memory, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MULTIVAC '
+                                     'pipeline stages offline on synthetic '
+                                     'fixture corpora.')
+    parser.add_argument('-s', '--size', default='small',
+                        choices=list(fixtures.SIZES),
+                        help='Fixture corpus to run on.')
+    parser.add_argument('-st', '--stages', nargs='+', choices=list(STAGES),
+                        help='Stages to benchmark (default: all).')
+    parser.add_argument('-r', '--repeat', default=1, type=int,
+                        help='Runs of each stage; the fastest is reported.')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help='Worker processes for the processing stage.')
+    parser.add_argument('-ab', '--agenda_batch', default=1, type=int,
+                        help='MLN agenda batch size.')
+    parser.add_argument('-cs', '--corenlp_servers', default=2, type=int,
+                        help='Fake CoreNLP servers for RDF extraction.')
+    parser.add_argument('-cc', '--corenlp_concurrency', default=2, type=int,
+                        help='Requests in flight per CoreNLP server.')
+    parser.add_argument('-fe', '--fail_every', default=10, type=int,
+                        help='Every nth request to the fake source and '
+                        'GROBID servers answers 503 (0: none).')
+    parser.add_argument('-gc', '--grobid_concurrency', default=4, type=int,
+                        help='PDFs in flight to the fake GROBID server.')
+    parser.add_argument('-fd', '--fixtures_dir', help='Where to write the '
+                        'fixture corpora (default: interim data directory).')
+    parser.add_argument('-o', '--output', help='Report file (default: a '
+                        'file named after the size and commit in the '
+                        'interim data directory).')
+    parser.add_argument('-c', '--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two reports instead of running.')
+    parser.add_argument('-t', '--tolerance', default=0.1, type=float,
+                        help='Relative slowdown or memory growth that counts '
+                        'as a regression when comparing.')
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path, 'r') as f:
+                reports.append(json.load(f))
+        regressions = compare(reports[0], reports[1], args.tolerance)
+        if regressions:
+            print('Regressions: {}'.format(', '.join(regressions)))
+            raise SystemExit(1)
+        return
+
+    report = run(args.size, args.stages, args.repeat,
+                 {'workers': args.workers,
+                  'agenda_batch': args.agenda_batch,
+                  'corenlp_servers': args.corenlp_servers,
+                  'corenlp_concurrency': args.corenlp_concurrency,
+                  'fail_every': args.fail_every,
+                  'grobid_concurrency': args.grobid_concurrency},
+                 args.fixtures_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        path = args.output
+    else:
+        path = save_report(report)
+    print_report(report)
+    print('Report written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
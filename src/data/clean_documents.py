@@ -4,8 +4,10 @@ Do the actual docuemnt cleaning, given source document directories.
 """
 import argparse
 import json
+import os
 import re
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from os import getcwd, listdir
 from os.path import abspath, exists, join
 
@@ -15,6 +17,7 @@ from tqdm import tqdm
 
 import pubmed_parser as pp
 from pubmed_parser.utils import remove_namespace
+from multivac.src import utilities
 
 PUNCT = frozenset([',', '.', ';', ':'])
 
@@ -184,12 +187,38 @@ def do_processing(path, source):
     return {'text': cleaned, 'file': path, 'source': source}
 
 
+def process_file(task):
+    """
+    Worker for clean_documents: process one file, never raising.
+
+    Parameters
+    ----------
+    task : tuple of (str, str)
+        The source and the path to the file.
+
+    Returns
+    -------
+    tuple of (dict, str or None)
+        The record, with text None if processing failed,
+        and the error message, if any.
+    """
+    source, path = task
+    try:
+        return do_processing(path, source), None
+    except Exception as error:
+        return ({'text': None, 'file': path, 'source': source},
+                '{}: {}'.format(type(error).__name__, error))
+
+
 def clean_documents(arxiv_dir=None,
                     pubmed_dir=None,
                     springer_dir=None,
-                    output_file=None):
+                    output_file=None,
+                    n_workers=None):
     """
-    Clean all the documents.
+    Clean all the documents in a pool of worker processes, streaming the
+    records to a JSON lines file in a deterministic order: by source, then
+    by file name. A summary of the errors by source is written beside it.
 
     Parameters
     ----------
@@ -200,7 +229,14 @@ def clean_documents(arxiv_dir=None,
     springer_dir : str
         The directory where Springer files live.
     output_file : str
-        The path to an output JSON file.
+        The path to an output JSON lines file.
+    n_workers : int
+        The number of worker processes; defaults to the number of CPUs.
+
+    Returns
+    -------
+    dict
+        The error summary, keyed by source.
     """
 
     directories_dict = {'arxiv': arxiv_dir,
@@ -208,33 +244,55 @@ def clean_documents(arxiv_dir=None,
                         'springer': springer_dir,
                         }
 
-    directories_dict = {k: v for k, v in directories_dict.items() if v is not None}
+    directories_dict = {k: abspath(v) for k, v in directories_dict.items() if v is not None}
 
     for directory in directories_dict.values():
-        directory = abspath(directory)
         if not exists(directory):
             raise FileNotFoundError('The directory {} cannot be located.'.format(directory))
 
     docs_dict = defaultdict(list)
     for name, directory in directories_dict.items():
-        for file in listdir(directory):
+        for file in sorted(listdir(directory)):
             if any(file.lower().endswith(ext) for ext in EXPECTED_EXTENSIONS[name]):
-                docs_dict[name].append(file)
-
-    final_docs_list = []
-    for source, paths in docs_dict.items():
-        print('Processing {}...'.format(source))
-        for path in tqdm(paths):
-            try:
-                final_docs_list.append(do_processing(path))
-            except Exception as error:
-                print('Problem with {}: {}'.format(path, str(error)))
-                final_docs_list.append({'text': None, 'file': path, 'source': source})
-                continue
+                docs_dict[name].append(join(directory, file))
+
+    tasks = ((source, path) for source, paths in docs_dict.items() for path in paths)
+    total = sum(len(paths) for paths in docs_dict.values())
+    print('Processing {} files from {}...'.format(total, ', '.join(docs_dict)))
+
+    n_workers = n_workers or os.cpu_count()
+    counts = Counter()
+    errors = defaultdict(list)
+    out = open(output_file, 'w') if output_file is not None else None
+    try:
+        with ProcessPoolExecutor(n_workers) as executor:
+            results = utilities.bounded_map(executor, process_file, tasks,
+                                            4 * n_workers)
+            for record, error in tqdm(results, total=total):
+                counts[record['source']] += 1
+                if error is not None:
+                    print('Problem with {}: {}'.format(record['file'], error))
+                    errors[record['source']].append({'file': record['file'],
+                                                     'error': error})
+                if out is not None:
+                    out.write(json.dumps(record) + '\n')
+    finally:
+        if out is not None:
+            out.close()
+
+    summary = {source: {'files': counts[source],
+                        'failed': len(errors[source]),
+                        'errors': errors[source]}
+               for source in docs_dict}
+    for source, result in summary.items():
+        print('{}: {} files, {} failed'.format(source, result['files'],
+                                               result['failed']))
 
     if output_file is not None:
-        with open(output_file, 'w') as fb:
-            json.dump(final_docs_list, fb)
+        with open(os.path.splitext(output_file)[0] + '_errors.json', 'w') as fb:
+            json.dump(summary, fb, indent=2)
+
+    return summary
 
 
 if __name__ == '__main__':
@@ -247,11 +305,14 @@ if __name__ == '__main__':
 
     parser.add_argument('path_to_arxiv', default=join(getcwd(), 'arxiv'))
 
-    parser.add_argument('-o', '--output_file', default=join(getcwd(), 'docs.json'))
+    parser.add_argument('-o', '--output_file', default=join(getcwd(), 'docs.jsonl'))
+
+    parser.add_argument('-n', '--n_workers', type=int, default=None)
 
     args = parser.parse_args()
 
     clean_documents(args.path_to_arxiv,
                     args.path_to_pubmed,
                     args.path_to_springer,
-                    args.output_file)
+                    args.output_file,
+                    args.n_workers)
@@ -9,8 +9,11 @@ A script to perform post-processing and clean-up of questions.
 """
 
 import argparse
+import multiprocessing as mp
 import re
 import sys
+import time
+from functools import partial
 from pathlib import Path
 
 import pandas as pd
@@ -58,6 +61,8 @@ def clean_text(text,
           - If n_tokens / n_words < 0.2, remove the text altogether
         * Try to grab the last "sentence", given the sentence tokenizer and some regex rules.
 
+    This cleans a single text; use `clean_texts()` for many.
+
     Parameters
     ----------
     text : str
@@ -83,60 +88,155 @@ def clean_text(text,
     cleaned_text : str
         The cleaned text.
     """
+    return clean_texts([text],
+                       min_char_len=min_char_len,
+                       min_word_threshold=min_word_threshold,
+                       max_word_len=max_word_len,
+                       removed_token=removed_token,
+                       verbose=False)[0]
+
+
+def clean_texts(texts,
+                min_char_len=2,
+                min_word_threshold=0.20,
+                max_word_len=100,
+                removed_token="<REMOVED>",
+                batch_size=1000,
+                n_process=1,
+                verbose=True):
+    """
+    Clean many texts, as in `clean_text()`.
 
-    # before we do anything, make sure the text is UTF-8
-    cleaned_text = text.encode('utf-8', 'replace')
-    cleaned_text = cleaned_text.decode('utf-8')
-
-    # remove everything in the `REGEXES_LIST`
-    for regex in REGEXES_LIST:
-        cleaned_text = re.sub(regex, '', cleaned_text)
-
-    # remove everything in the `REGEXES_DICT`
-    for update, regex in REGEXES_DICT.items():
-        cleaned_text = re.sub(regex, update, cleaned_text)
+    Only the tokenizer is needed to count words, so the full spaCy pipeline
+    is run, with the tagger and entity recognizer disabled, just for the
+    texts long enough to need sentence boundaries. Texts are cleaned in
+    batches of `batch_size`, spread over `n_process` worker processes.
 
-    # we tokenize the text, and then check the number of words
-    # in the vocabulary that are greater than `min_char_len`;
-    # if this percentage is larger than `min_word_threshold`,
-    # we keep the text; otherwise, we remove it
-    tokens = NLP(cleaned_text)
-    n_tokens = len(tokens)
-    words = [token.text for token in tokens
-             if token.is_alpha
-             and len(token) > min_char_len
-             and token.text.lower() in NLP.vocab]
-
-    n_words = len(words)
-    if (n_words / n_tokens) < min_word_threshold:
-        return removed_token
-
-    # if the number of tokens is larger than `max_word_len`,
-    # we only take the last sentence from spaCy; otherwise, we find the
-    # punctuation and take the last sentence using a regular expression
-    if n_tokens >= max_word_len:
-        cleaned_text = list(tokens.sents)[-1].text
+    Parameters
+    ----------
+    texts : list of str
+        The texts to clean.
+    batch_size : int, optional
+        The number of texts per batch.
+        Defaults to 1000.
+    n_process : int, optional
+        The number of worker processes.
+        Defaults to 1.
+    verbose : bool, optional
+        Whether to report the cleaning rate.
+        Defaults to True.
+
+    The other parameters are as in `clean_text()`.
 
+    Returns
+    -------
+    cleaned_texts : list of str
+        The cleaned texts, in order.
+    """
+    start = time.time()
+    options = dict(min_char_len=min_char_len,
+                   min_word_threshold=min_word_threshold,
+                   max_word_len=max_word_len,
+                   removed_token=removed_token,
+                   batch_size=batch_size)
+    batches = [texts[i:i + batch_size]
+               for i in range(0, len(texts), batch_size)]
+
+    if n_process > 1 and len(batches) > 1:
+        with mp.Pool(n_process) as pool:
+            results = pool.imap(partial(_clean_batch, **options), batches)
+            cleaned_texts = [text for batch in tqdm(results, total=len(batches))
+                             for text in batch]
     else:
-        sents = re.findall(REGEX_SENTENCES, cleaned_text)
-        if sents:
-            cleaned_text = sents[-1].strip()
+        cleaned_texts = [text for batch in batches
+                         for text in _clean_batch(batch, **options)]
+
+    if verbose:
+        elapsed = max(time.time() - start, 1e-9)
+        print('Cleaned {} texts in {:.1f}s ({:.1f} docs/s)'.format(
+            len(texts), elapsed, len(texts) / elapsed))
+    return cleaned_texts
+
+
+def _clean_batch(texts,
+                 min_char_len,
+                 min_word_threshold,
+                 max_word_len,
+                 removed_token,
+                 batch_size):
+    """
+    Clean one batch of texts for `clean_texts()`.
+    """
+    cleaned_texts = []
+    for text in texts:
 
-    # remove everything in the `REGEXES_LIST_FINAL`
-    for regex in REGEXES_LIST_FINAL:
-        cleaned_text = re.sub(regex, '', cleaned_text)
+        # before we do anything, make sure the text is UTF-8
+        cleaned_text = text.encode('utf-8', 'replace')
+        cleaned_text = cleaned_text.decode('utf-8')
 
-    # check one last time, to make sure the sentence isn't too short
-    tokens = NLP(cleaned_text)
-    if len(tokens) <= min_char_len:
-        return removed_token
+        # remove everything in the `REGEXES_LIST`
+        for regex in REGEXES_LIST:
+            cleaned_text = regex.sub('', cleaned_text)
 
-    # finally, we strip off any leading or ending white space and make
-    # sure that the first letter is capitalized
-    cleaned_text = cleaned_text.strip()
-    cleaned_text = cleaned_text[0].upper() + cleaned_text[1:]
+        # remove everything in the `REGEXES_DICT`
+        for update, regex in REGEXES_DICT.items():
+            cleaned_text = regex.sub(update, cleaned_text)
 
-    return cleaned_text
+        cleaned_texts.append(cleaned_text)
+
+    # we tokenize the text, and then check the number of words
+    # in the vocabulary that are greater than `min_char_len`;
+    # if this percentage is larger than `min_word_threshold`,
+    # we keep the text; otherwise, we remove it
+    long_texts = []
+    for i, tokens in enumerate(NLP.tokenizer.pipe(cleaned_texts,
+                                                  batch_size=batch_size)):
+        n_tokens = len(tokens)
+        words = [token.text for token in tokens
+                 if token.is_alpha
+                 and len(token) > min_char_len
+                 and token.text.lower() in NLP.vocab]
+
+        n_words = len(words)
+        if (n_words / n_tokens) < min_word_threshold:
+            cleaned_texts[i] = None
+
+        # if the number of tokens is larger than `max_word_len`,
+        # we only take the last sentence from spaCy; otherwise, we find the
+        # punctuation and take the last sentence using a regular expression
+        elif n_tokens >= max_word_len:
+            long_texts.append(i)
+
+        else:
+            sents = REGEX_SENTENCES.findall(cleaned_texts[i])
+            if sents:
+                cleaned_texts[i] = sents[-1].strip()
+
+    parsed = NLP.pipe([cleaned_texts[i] for i in long_texts],
+                      batch_size=batch_size, disable=['tagger', 'ner'])
+    for i, tokens in zip(long_texts, parsed):
+        cleaned_texts[i] = list(tokens.sents)[-1].text
+
+    for i, cleaned_text in enumerate(cleaned_texts):
+        if cleaned_text is None:
+            cleaned_texts[i] = removed_token
+            continue
+
+        # remove everything in the `REGEXES_LIST_FINAL`
+        for regex in REGEXES_LIST_FINAL:
+            cleaned_text = regex.sub('', cleaned_text)
+
+        # check one last time, to make sure the sentence isn't too short
+        if len(NLP.tokenizer(cleaned_text)) <= min_char_len:
+            cleaned_texts[i] = removed_token
+            continue
+
+        # finally, we strip off any leading or ending white space and make
+        # sure that the first letter is capitalized
+        cleaned_text = cleaned_text.strip()
+        cleaned_texts[i] = cleaned_text[0].upper() + cleaned_text[1:]
+
+    return cleaned_texts
 
 
 def main():
@@ -180,6 +280,14 @@ def main():
                         default="<REMOVED>",
                         help="A token to use in place of removed text.")
 
+    parser.add_argument('-b', '--batch_size', dest='batch_size',
+                        type=int, default=1000,
+                        help="The number of questions to clean per batch.")
+
+    parser.add_argument('-n', '--n_process', dest='n_process',
+                        type=int, default=1,
+                        help="The number of processes to clean with.")
+
     args = parser.parse_args()
 
     path_to_questions = Path(args.input_file)
@@ -190,14 +298,14 @@ def main():
     with open(path_to_questions) as fb:
         questions = [line.strip() for line in fb.readlines()]
 
-    # loop through all of the questions and perform cleaning
-    cleaned_questions = []
-    for question in tqdm(questions):
-        cleaned_questions.append(clean_text(question,
-                                            min_char_len=args.min_char_len,
-                                            min_word_threshold=args.min_word_threshold,
-                                            max_word_len=args.max_word_len,
-                                            removed_token=args.removed_token))
+    # clean all of the questions in batches
+    cleaned_questions = clean_texts(questions,
+                                    min_char_len=args.min_char_len,
+                                    min_word_threshold=args.min_word_threshold,
+                                    max_word_len=args.max_word_len,
+                                    removed_token=args.removed_token,
+                                    batch_size=args.batch_size,
+                                    n_process=args.n_process)
 
     # if the output file is Excel, then write out a formatted file
     # with both the original and cleaned questions in separate columns
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped word-embedding store.
+
+Word vectors arrive as GloVe text files, pickled {'vocab', 'embeddings'}
+dicts, or the .pth/.vocab pairs cached by the GAN utilities. Each source is
+converted once into a directory beside it, reached through the symlink
+`<source>.emb`, holding:
+
+    vectors.npy   float32 matrix, one row per word, opened as a memory map
+    vocab.txt     the words, one per line, in row order
+    offsets.npy   byte offset of each word in vocab.txt
+    hashes.npy    sorted 64-bit hashes of the words
+    rows.npy      the row of each hash in hashes.npy
+    meta.json     the source's size and mtime, to notice when it changes
+
+Opening a store then takes seconds however large the vocabulary is, and every
+process using it shares the same pages of the page cache. A changed source is
+converted into a new directory and published by replacing the symlink, so a
+process opening the store sees either the old or the new one in full.
+"""
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def word_hash(word):
+    """Return the 64-bit hash used to index a word."""
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'),
+                                          digest_size=8).digest(), 'little')
+
+
+class EmbeddingStore(Mapping):
+    """A read-only mapping of words to float32 vectors backed by a converted
+    store directory. Use `EmbeddingStore.open()` to convert a source as
+    needed."""
+
+    def __init__(self, path):
+        # resolve the symlink once, so every file comes from the same version
+        self.path = os.path.realpath(str(path))
+        self.vocab_file = os.path.join(self.path, 'vocab.txt')
+
+        # copy-on-write, so callers (e.g. torch.from_numpy) get a writable
+        # array while the pages on disk stay shared and unchanged
+        self.vectors = np.load(os.path.join(self.path, 'vectors.npy'),
+                               mmap_mode='c')
+        self._offsets = np.load(os.path.join(self.path, 'offsets.npy'),
+                                mmap_mode='r')
+        self._hashes = np.load(os.path.join(self.path, 'hashes.npy'),
+                               mmap_mode='r')
+        self._rows = np.load(os.path.join(self.path, 'rows.npy'),
+                             mmap_mode='r')
+        with open(self.vocab_file, 'rb') as f:
+            self._vocab = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                           if os.fstat(f.fileno()).st_size else b'')
+
+    @classmethod
+    def open(cls, source, verbose=False):
+        """Return the store for a source file, converting it first if it has
+        not been converted or has changed since."""
+        source = str(source)
+        path = source + '.emb'
+        if not cls._is_current(path, source):
+            convert(source, path, verbose)
+        try:
+            return cls(path)
+        except FileNotFoundError:
+            # a concurrent conversion replaced and removed the version
+            # between resolving the link and loading its files
+            return cls(path)
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def __iter__(self):
+        return iter(self.words())
+
+    def __getitem__(self, word):
+        row = self.index(word)
+        if row is None:
+            raise KeyError(word)
+        return self.vectors[row]
+
+    def __contains__(self, word):
+        return self.index(word) is not None
+
+    def word(self, row):
+        """Return the word of a row."""
+        start = self._offsets[row]
+        end = (self._offsets[row + 1] - 1 if row + 1 < len(self)
+               else len(self._vocab) - 1)
+        return self._vocab[start:end].decode('utf-8')
+
+    def words(self):
+        """Return all words in row order."""
+        with open(self.vocab_file, 'r', encoding='utf-8') as f:
+            return [line.rstrip('\n') for line in f]
+
+    def index(self, word, default=None):
+        """Return the row of a word, or default."""
+        h = np.uint64(word_hash(word))
+        i = np.searchsorted(self._hashes, h)
+        while i < len(self._hashes) and self._hashes[i] == h:
+            if self.word(self._rows[i]) == word:
+                return int(self._rows[i])
+            i += 1
+        return default
+
+    def indices(self, words):
+        """Return the rows of a list of words as an array, with -1 for words
+        that aren't in the store."""
+        return np.array([self.index(word, -1) for word in words],
+                        dtype=np.int64)
+
+    def to_dict(self, vocab=None):
+        """Return {word: vector} for the words of vocab (or all words) that
+        are in the store."""
+        if vocab is None:
+            vocab = self.words()
+        rows = self.indices(vocab)
+        return {word: self.vectors[row]
+                for word, row in zip(vocab, rows) if row >= 0}
+
+    def mean_vectors(self, phrases):
+        """Return {phrase: mean vector of its whitespace-separated words} for
+        the phrases with at least one word in the store."""
+        result = {}
+        for phrase in phrases:
+            rows = self.indices(phrase.split())
+            rows = rows[rows >= 0]
+            if len(rows) == 1:
+                result[phrase] = np.array(self.vectors[rows[0]])
+            elif len(rows) > 1:
+                result[phrase] = self.vectors[rows].mean(axis=0)
+        return result
+
+    @staticmethod
+    def _is_current(path, source):
+        try:
+            with open(os.path.join(path, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        stat = os.stat(source)
+        return meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime
+
+
+def convert(source, path, verbose=False):
+    """Convert a GloVe .txt, pickled .pkl or .pth (with a sibling .vocab)
+    source into a new store directory and point the symlink at path to it."""
+    parent = os.path.dirname(os.path.abspath(path))
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=parent)
+    try:
+        if verbose:
+            print('Converting {} to {}'.format(source, path))
+        if source.endswith('.pkl'):
+            with open(source, 'rb') as f:
+                embed = pickle.load(f)
+            words = list(embed['vocab'])
+            _save_vectors(tmp, np.asarray(embed['embeddings'],
+                                          dtype=np.float32))
+        elif source.endswith('.pth'):
+            import torch
+            with open(source[:-len('.pth')] + '.vocab', 'r',
+                      encoding='utf8', errors='ignore') as f:
+                words = [line.rstrip('\n') for line in f]
+            _save_vectors(tmp, torch.load(source).numpy().astype(np.float32))
+        else:
+            words = _convert_text(source, tmp)
+
+        _save_vocab(tmp, words)
+        stat = os.stat(source)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'source': os.path.abspath(source),
+                       'size': stat.st_size, 'mtime': stat.st_mtime,
+                       'rows': len(words)}, f)
+
+        _publish(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def _publish(version, path):
+    """Atomically point the symlink at path to the store directory version,
+    then remove the version it pointed to. A concurrent conversion of the
+    same source produces the same result, so losing the race is harmless."""
+    parent = os.path.dirname(os.path.abspath(path))
+    old = None
+    if os.path.islink(path):
+        old = os.path.join(parent, os.readlink(path))
+    elif os.path.isdir(path):
+        # a store converted before stores were versioned; moving it aside
+        # is the one step that can't be atomic
+        old = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=parent)
+        os.replace(path, old)
+
+    link = os.path.join(parent, '.{}.{}.link'.format(os.path.basename(path),
+                                                     os.getpid()))
+    os.symlink(os.path.basename(version), link)
+    os.replace(link, path)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def _convert_text(source, dst):
+    """Stream a GloVe text file into dst/vectors.npy; return its words."""
+    with open(source, 'r', encoding='utf8', errors='ignore') as f:
+        count = 0
+        dim = None
+        for line in f:
+            if dim is None:
+                dim = len(line.rstrip('\n').split(' ')) - 1
+            count += 1
+
+    vectors = np.lib.format.open_memmap(os.path.join(dst, 'vectors.npy'),
+                                        mode='w+', dtype=np.float32,
+                                        shape=(count, dim or 0))
+    words = [None] * count
+    with open(source, 'r', encoding='utf8', errors='ignore') as f:
+        for i, line in enumerate(f):
+            # some GloVe files have words containing spaces, so split the
+            # vector off the end
+            parts = line.rstrip('\n').split(' ')
+            words[i] = ' '.join(parts[:-dim])
+            vectors[i] = np.array(parts[-dim:], dtype=np.float32)
+    vectors.flush()
+    del vectors
+    return words
+
+
+def _save_vectors(dst, vectors):
+    np.save(os.path.join(dst, 'vectors.npy'), vectors)
+
+
+def _save_vocab(dst, words):
+    encoded = [word.encode('utf-8') + b'\n' for word in words]
+    lengths = np.array([len(w) for w in encoded], dtype=np.int64)
+    offsets = np.zeros(len(words), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    with open(os.path.join(dst, 'vocab.txt'), 'wb') as f:
+        f.writelines(encoded)
+
+    hashes = np.array([word_hash(word) for word in words], dtype=np.uint64)
+    order = np.argsort(hashes, kind='stable')
+    np.save(os.path.join(dst, 'offsets.npy'), offsets)
+    np.save(os.path.join(dst, 'hashes.npy'), hashes[order])
+    np.save(os.path.join(dst, 'rows.npy'), order.astype(np.int64))
@@ -1,25 +1,36 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import random
+import hashlib
+import os
 import re as reg
-import string
+import signal
+import sqlite3
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
+import sympy
 from sympy import SympifyError, srepr
 from sympy.parsing.latex import parse_latex
 from sympy.parsing.latex.errors import LaTeXParsingError
 
-# Use this to store LateX code
-LATEXMAP = {}
-LATEXMAPTOKENS = {}
+# LateX identifiers
+LATEX_BLOCK = reg.compile(r'\$\$.*?\$\$')
+LATEX_INLINE = reg.compile(r'\\\\.*?\\\\\)')
+LATEX_ENVS = reg.compile(r'\\begin{array}{.*?}|\\end{array}|\\begin{aligned}|\\end{aligned}')
+
+# letters for equation tags; no vowels, so tags never spell words
+TAG_LETTERS = 'bcdfghjklmnpqrstvwxyz'
+
+# how parse_equation parses normalized LateX; change it whenever either
+# changes, so memoized parses made the old way aren't reused
+PARSER_SETTINGS = 'parse_latex-strip_parens-collapse_whitespace-1'
 
 
 def cleaned_latex(s):
     '''LateX requires some cleaning from original file format
     '''
     s = s.replace('$$', '')
-    s = reg.sub(r'\\begin{array}{.*?}|\\end{array}|\\begin{aligned}|\\end{aligned}',
-                '', s)
+    s = LATEX_ENVS.sub('', s)
     s = s.replace('&=&', '=')
     s = s.replace(r'\(', '(')
     s = s.replace(r'\)', ')')
@@ -30,16 +41,19 @@ def cleaned_latex(s):
 
 def extract_and_replace_latex(doc):
     '''
-    Find and extract LateX, start with blockquote and then do inline
+    Find and extract LateX, start with blockquote and then do inline.
+    Returns the document with equations replaced by tags, and a dict mapping
+    each tag to its LateX code.
     '''
-    # LateX identifiers
-    latexBlock = reg.compile(r'\$\$.*?\$\$')
-    latexInline = reg.compile(r'\\\\.*?\\\\\)')
+    latexMap = {}
+
+    def replace(m):
+        return replace_latex(m, latexMap)
 
-    doc = reg.sub(latexBlock, replace_latex, doc)
-    doc = reg.sub(latexInline, replace_latex, doc)
+    doc = LATEX_BLOCK.sub(replace, doc)
+    doc = LATEX_INLINE.sub(replace, doc)
 
-    return doc
+    return doc, latexMap
 
 
 def find_parens(s):
@@ -63,18 +77,15 @@ def find_parens(s):
     return OrderedDict(sorted(toret.items()))
 
 
-def generate_random_tag():
+def generate_tag(latex):
     '''
-    Generate a random tag that begins with Ltxqtn
+    Generate a tag that begins with Ltxqtn, derived from the normalized LateX
+    so the same equation gets the same tag in every document and run
     '''
-    while True:
-        tag = ''.join(random.choices(string.ascii_lowercase, k=8))
-        tag = reg.sub('a|e|i|o|u', 'z', tag)
-        tag = ' Ltxqtn' + tag
-        if tag.replace(' ', '') not in LATEXMAP:
-            break
+    digest = hashlib.sha256(normalize_latex(latex).encode('utf-8')).digest()
+    tag = ''.join(TAG_LETTERS[b % len(TAG_LETTERS)] for b in digest[:8])
 
-    return tag
+    return ' Ltxqtn' + tag
 
 
 def get_rel(gov):
@@ -198,9 +209,152 @@ def gov_dep(s, i=1):
     return results
 
 
-def latexParsing(token, tokenPos):
+def normalize_latex(s):
+    '''
+    Collapse whitespace so trivially different copies of an equation share
+    one parse
+    '''
+    return ' '.join(s.split())
+
+
+def parse_equation(latex):
+    '''
+    Return the sympy string representation of a LateX equation, or '' if it
+    can't be parsed
+    '''
+    # Try parsing the latex code as is
+    try:
+        return srepr(parse_latex(latex))
+
+    except (LaTeXParsingError, SympifyError, TypeError):
+        # Good chance the problem is the leading and trailing parens -
+        # remove them and try again
+        try:
+            return srepr(parse_latex(latex.lstrip('(').rstrip(')')))
+        except(LaTeXParsingError, ValueError, TypeError):
+            return ''
+
+
+class EquationTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise EquationTimeout()
+
+
+def parse_equation_timed(task):
     '''
-    LateX parsing function for DIM files
+    Worker for parse_equations: parse one equation, giving up after the
+    timeout. Returns (latex, string representation, timed out).
+    '''
+    latex, seconds = task
+    handler = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        return latex, parse_equation(latex), False
+    except EquationTimeout:
+        return latex, '', True
+    except Exception:
+        return latex, '', False
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, handler)
+
+
+def parser_version():
+    '''
+    Identify the sympy release and parser settings an equation's parse
+    depends on
+    '''
+    return 'sympy-{}-{}'.format(sympy.__version__, PARSER_SETTINGS)
+
+
+class EquationMemo(object):
+    '''
+    Persistent memo of sympy string representations keyed by parser version
+    and normalized LateX, in SQLite so it can be shared by concurrent runs.
+    Parses made by another sympy release or with other parser settings are
+    not reused
+    '''
+
+    def __init__(self, path, version=None):
+        self.version = version or parser_version()
+        self._db = sqlite3.connect(str(path))
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # the first memos weren't keyed by parser version, so their parses
+        # can't be told apart and are dropped
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(equations)')]
+        if columns and 'version' not in columns:
+            self._db.execute('DROP TABLE equations')
+        self._db.execute('CREATE TABLE IF NOT EXISTS equations '
+                         '(version TEXT NOT NULL, latex TEXT NOT NULL, '
+                         'srepr TEXT NOT NULL, PRIMARY KEY (version, latex))')
+
+    def close(self):
+        self._db.close()
+
+    def get_many(self, latexes):
+        found = {}
+        latexes = list(latexes)
+        for i in range(0, len(latexes), 500):
+            chunk = latexes[i:i + 500]
+            found.update(self._db.execute(
+                'SELECT latex, srepr FROM equations '
+                'WHERE version = ? AND latex IN ({})'.format(
+                    ', '.join('?' * len(chunk))),
+                [self.version] + chunk).fetchall())
+        return found
+
+    def put_many(self, items):
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO equations VALUES (?, ?, ?)',
+                [(self.version, latex, rep) for latex, rep in items])
+
+
+def parse_equations(latexMap, memo=None, workers=None, timeout=10):
+    '''
+    Parse the equations of a tag -> LateX map, as returned by
+    extract_and_replace_latex, and return a tag -> sympy string
+    representation map for latexParsing.
+
+    Each distinct equation is parsed once, in a pool of worker processes with
+    `timeout` seconds allowed per equation, and looked up in the memo first
+    when one is given. Equations that time out are not memoized.
+    '''
+    normalized = {tag: normalize_latex(latex)
+                  for tag, latex in latexMap.items()}
+    distinct = set(normalized.values())
+    reprs = memo.get_many(distinct) if memo is not None else {}
+    todo = [(latex, timeout) for latex in distinct if latex not in reprs]
+
+    if todo:
+        timedOut = 0
+        parsed = []
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(workers) as pool:
+            chunksize = max(1, len(todo) // (4 * workers))
+            for latex, rep, late in pool.map(parse_equation_timed, todo,
+                                             chunksize=chunksize):
+                reprs[latex] = rep
+                if late:
+                    timedOut += 1
+                else:
+                    parsed.append((latex, rep))
+        if memo is not None:
+            memo.put_many(parsed)
+        print('Parsed {} new equations ({} timed out), {} from memo'.format(
+            len(todo), timedOut, len(distinct) - len(todo)))
+
+    return {tag: reprs[latex] for tag, latex in normalized.items()}
+
+
+def latexParsing(token, tokenPos, equations=None):
+    '''
+    LateX parsing function for DIM files. equations maps equation tags to
+    their sympy string representations, as returned by parse_equations.
     '''
     lastPos = 0
 
@@ -210,20 +364,8 @@ def latexParsing(token, tokenPos):
     l_morTokens = []
     stringRep = ''
 
-    # Try parsing the latex code as is
-    if len(token) == 14:
-        try:
-            expr = parse_latex(LATEXMAP[token])
-            stringRep = srepr(expr)
-
-        except (LaTeXParsingError, SympifyError, TypeError):
-            # Good chance the problem is the leading and trailing parens -
-            # remove them and try again
-            try:
-                expr = parse_latex(LATEXMAP[token].lstrip('(').rstrip(')'))
-                stringRep = srepr(expr)
-            except(LaTeXParsingError, ValueError, TypeError):
-                pass
+    if len(token) == 14 and equations is not None:
+        stringRep = equations.get(token, '')
 
     # If we have a sympy string representation...
     if stringRep != '':
@@ -295,21 +437,22 @@ def latexParsing(token, tokenPos):
     return l_depTokens, l_posTokens, l_morTokens
 
 
-def put_equation_tokens_in_text(m):
+def put_equation_tokens_in_text(m, equations):
     """ This is a scaled down version of create_parse_files(), to be used for
         GloVe embeddings. Instead of creating DIM files, it maps equation
         tokens to the latexEquation## for recreating the text files.
     """
     token = m.group()
     l_depTokens_latex_sub_tuples, l_posTokens_latex_sub, \
-        l_morTokens_latex_sub = latexParsing(token, 0)
+        l_morTokens_latex_sub = latexParsing(token, 0, equations)
 
     return ' '.join(l_morTokens_latex_sub)
 
 
-def replace_latex(m):
+def replace_latex(m, latexMap):
     '''
-    Replace LateX equations with placeholder token, with format LateXEquation
+    Replace LateX equations with placeholder token, with format LateXEquation,
+    adding the equations to latexMap
     '''
     latexStr = m.group()
     latexStr = cleaned_latex(latexStr)
@@ -320,8 +463,8 @@ def replace_latex(m):
         # here
         latexArray = latexStr.split(', \\\\')
         for latexItem in latexArray:
-            thisMapKey = generate_random_tag()
+            thisMapKey = generate_tag(latexItem)
             # in this case, 'key' is the latex code
-            LATEXMAP[thisMapKey.replace(' ', '')] = latexItem
+            latexMap[thisMapKey.replace(' ', '')] = latexItem
 
         return (thisMapKey)
@@ -1,29 +1,32 @@
 """"
-This version uses the standard ProcessPoolExecutor for parallelizing the concurrent calls to the GROBID services.
-Given the limits of ThreadPoolExecutor (input stored in memory, blocking Executor.map until the whole input
-is acquired), it works with batches of PDF of a size indicated in the config.json file (default is 1000 entries).
-We are moving from first batch to the second one only when the first is entirely processed - which means it is
-slightly sub-optimal, but should scale better. However acquiring a list of million of files in directories would
-require something scalable too, which is not implemented for the moment.
+This version streams the PDF files found under the input directory to the
+GROBID service from a thread pool: the calls are blocking HTTP requests, so
+threads sharing a pooled session are enough, and at most a bounded window of
+files is in flight at any time, however many PDFs there are. A 503 (service
+busy) is retried with exponential backoff, and the status of every file is
+collected into a summary at the end.
 """
 
 import argparse
-import concurrent.futures
 import io
 import json
 import os
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
 import ntpath
 from grobid.client import ApiClient
+from multivac.src import utilities
 
 
 class grobid_client(ApiClient):
 
     def __init__(self, config_path='./config.json'):
         self.config = None
+        self.session = requests.Session()
         self._load_config(config_path)
 
     def _load_config(self, path='./config.json'):
@@ -34,18 +37,22 @@ class grobid_client(ApiClient):
         self.config = json.loads(config_json)
 
         # test if the server is up and running...
-        the_url = 'http://' + self.config['grobid_server']
-        if len(self.config['grobid_port']) > 0:
-            the_url += ":" + self.config['grobid_port']
-        the_url += "/api/isalive"
-        r = requests.get(the_url)
-        status = r.status_code
+        try:
+            status = self.session.get(self._url('isalive')).status_code
+        except requests.RequestException as e:
+            status = e
 
         if status != 200:
             print('GROBID server does not appear up and running ' + str(status))
         else:
             print("GROBID server is up and running")
 
+    def _url(self, service):
+        the_url = 'http://' + self.config['grobid_server']
+        if len(self.config['grobid_port']) > 0:
+            the_url += ":" + self.config['grobid_port']
+        return the_url + "/api/" + service
+
     def process(
             self,
             input,
@@ -57,39 +64,24 @@ class grobid_client(ApiClient):
             consolidate_citations,
             force,
             teiCoordinates):
-        batch_size_pdf = self.config['batch_size']
-        pdf_files = []
-
-        for (dirpath, dirnames, filenames) in os.walk(input):
-            for filename in filenames:
-                if filename.endswith('.pdf') or filename.endswith('.PDF'):
-                    pdf_files.append(os.sep.join([dirpath, filename]))
-
-                    if len(pdf_files) == batch_size_pdf:
-                        self.process_batch(
-                            pdf_files,
-                            output,
-                            n,
-                            service,
-                            generateIDs,
-                            consolidate_header,
-                            consolidate_citations,
-                            force,
-                            teiCoordinates)
-                        pdf_files = []
-
-        # last batch
-        if len(pdf_files) > 0:
-            self.process_batch(
-                pdf_files,
-                output,
-                n,
-                service,
-                generateIDs,
-                consolidate_header,
-                consolidate_citations,
-                force,
-                teiCoordinates)
+        """Process every PDF under input, and return the list of per-file
+        (pdf file, status, detail) results."""
+        def pdf_files():
+            for (dirpath, dirnames, filenames) in os.walk(input):
+                for filename in filenames:
+                    if filename.endswith('.pdf') or filename.endswith('.PDF'):
+                        yield os.sep.join([dirpath, filename])
+
+        return self.process_batch(
+            pdf_files(),
+            output,
+            n,
+            service,
+            generateIDs,
+            consolidate_header,
+            consolidate_citations,
+            force,
+            teiCoordinates)
 
     def process_batch(
             self,
@@ -102,20 +94,34 @@ class grobid_client(ApiClient):
             consolidate_citations,
             force,
             teiCoordinates):
-        print(len(pdf_files), "PDF files to process")
+        """Send pdf_files (any iterable) to the service with n concurrent
+        requests, keeping at most config['batch_size'] files in flight, and
+        return the per-file results."""
+        # one pooled connection per worker thread
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=n)
+        self.session.mount('http://', adapter)
+
+        def process_pdf(pdf_file):
+            return self.process_pdf(
+                pdf_file,
+                output,
+                service,
+                generateIDs,
+                consolidate_header,
+                consolidate_citations,
+                force,
+                teiCoordinates)
+
+        window = max(n, self.config.get('batch_size', 2 * n))
         results = []
-        with concurrent.futures.ProcessPoolExecutor(max_workers=n) as executor:
-            for pdf_file in pdf_files:
-                executor.submit(
-                    self.process_pdf,
-                    pdf_file,
-                    output,
-                    service,
-                    generateIDs,
-                    consolidate_header,
-                    consolidate_citations,
-                    force,
-                    teiCoordinates)
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            for result in utilities.bounded_imap(executor, process_pdf,
+                                                 pdf_files, window):
+                results.append(result)
+
+        print_summary(results)
+        return results
 
     def process_pdf(
             self,
@@ -127,6 +133,8 @@ class grobid_client(ApiClient):
             consolidate_citations,
             force,
             teiCoordinates):
+        """Process one PDF, returning (pdf file, status, detail) with a status
+        of 'processed', 'skipped' or 'failed'."""
         # check if TEI file is already produced
         # we use ntpath here to be sure it will work on Windows too
         pdf_file_name = ntpath.basename(pdf_file)
@@ -141,22 +149,9 @@ class grobid_client(ApiClient):
             print(
                 filename,
                 "already exist, skipping... (use --force to reprocess pdf input files)")
-            return
+            return pdf_file, 'skipped', 'TEI file exists'
 
         print(pdf_file)
-        files = {
-            'input': (
-                pdf_file,
-                open(pdf_file, 'rb'),
-                'application/pdf',
-                {'Expires': '0'}
-            )
-        }
-
-        the_url = 'http://' + self.config['grobid_server']
-        if len(self.config['grobid_port']) > 0:
-            the_url += ":" + self.config['grobid_port']
-        the_url += "/api/" + service
 
         # set the GROBID parameters
         the_data = {}
@@ -169,26 +164,65 @@ class grobid_client(ApiClient):
         if teiCoordinates:
             the_data['teiCoordinates'] = self.config['coordinates']
 
-        res, status = self.post(
-            url=the_url,
-            files=files,
-            data=the_data,
-            headers={'Accept': 'text/plain'}
-        )
-
-        if status == 503:
-            time.sleep(self.config['sleep_time'])
-            return self.process_pdf(pdf_file, output)
-        elif status != 200:
+        try:
+            res, status = self.post_pdf(self._url(service), pdf_file,
+                                        the_data)
+        except (OSError, requests.RequestException) as e:
+            print('Processing %s failed: %s' % (pdf_file, e))
+            return pdf_file, 'failed', str(e)
+
+        if status != 200:
             print('Processing failed with error ' + str(status))
-        else:
-            # writing TEI file
+            return pdf_file, 'failed', 'HTTP %s' % status
+
+        # writing TEI file
+        try:
+            with io.open(filename, 'w', encoding='utf8') as tei_file:
+                tei_file.write(res.text)
+        except OSError:
+            print("Writing resulting TEI XML file %s failed" % filename)
+            return pdf_file, 'failed', 'could not write %s' % filename
+        return pdf_file, 'processed', filename
+
+    def post_pdf(self, url, pdf_file, data):
+        """POST a PDF to the service through the pooled session, retrying
+        with exponential backoff while the service answers 503 or the
+        connection fails. Returns (response, status)."""
+        sleep_time = self.config.get('sleep_time', 5)
+        max_retries = self.config.get('max_retries', 5)
+        timeout = self.config.get('timeout', 600)
+
+        for attempt in range(max_retries + 1):
             try:
-                with io.open(filename, 'w', encoding='utf8') as tei_file:
-                    tei_file.write(res.text)
-            except OSError:
-                print("Writing resulting TEI XML file %s failed" % filename)
-                pass
+                with open(pdf_file, 'rb') as f:
+                    files = {
+                        'input': (
+                            pdf_file,
+                            f,
+                            'application/pdf',
+                            {'Expires': '0'}
+                        )
+                    }
+                    res = self.session.post(url, files=files, data=data,
+                                            headers={'Accept': 'text/plain'},
+                                            timeout=timeout)
+                if res.status_code != 503 or attempt == max_retries:
+                    return res, res.status_code
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == max_retries:
+                    raise
+            time.sleep(sleep_time * 2 ** attempt)
+
+
+def print_summary(results):
+    """Print the number of files with each status, and the failures."""
+    counts = Counter(status for _, status, _ in results)
+    print('{} PDF files: {} processed, {} skipped, {} failed'.format(
+        len(results), counts['processed'], counts['skipped'],
+        counts['failed']))
+    for pdf_file, status, detail in results:
+        if status == 'failed':
+            print('  failed: %s (%s)' % (pdf_file, detail))
 
 
 def run(args_dict):
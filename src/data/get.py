@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
 import copy
+import json
 import os
 import pickle
-import time
+import random
 from pathlib import Path
 
+import aiohttp
 import feedparser
 import requests
 from bs4 import BeautifulSoup as bs
 from dotenv import load_dotenv
 
 from multivac import settings
+from multivac.src import instrument
+from multivac.src.data.store import DocumentStore
 
 env_path = Path('.') / '.env'
 load_dotenv(env_path)
@@ -22,22 +27,234 @@ user_email = os.environ.get('USER_EMAIL')  # courtesy to NIH to include your ema
 
 wait_time = 3
 
+# api endpoints and per-source politeness limits; concurrency is the number of
+# requests in flight and rate the number of requests started per second.
+# endpoints can be pointed at a local stand-in server for testing.
+SOURCES = {
+    'arxiv': {
+        'api': 'http://export.arxiv.org/api/query',
+        'concurrency': 4,
+        'rate': 3,
+    },
+    'springer': {
+        'api': 'http://api.springernature.com/openaccess/json',
+        'concurrency': 8,
+        'rate': 5,
+    },
+    'pubmed': {
+        'api': 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils',
+        'concurrency': 3,
+        'rate': 3,
+    },
+}
+
+# http statuses worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RetryableStatus(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__('HTTP %s' % status)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RateLimiter(object):
+    """Space the start of successive requests at least 1/rate seconds apart."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Fetcher(object):
+    """Asynchronous HTTP client shared by all sources.
+
+    Connections are pooled and kept alive across requests. Each source gets
+    its own concurrency and rate limits, and failed requests (connection
+    errors, timeouts, 429 and 5xx responses) are retried with exponential
+    backoff.
+    """
+
+    def __init__(self, sources=None, retries=5, backoff=1, timeout=120):
+        self.sources = sources or SOURCES
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = None
+        self._sems = {}
+        self._limiters = {}
+
+    async def __aenter__(self):
+        for name, source in self.sources.items():
+            self._sems[name] = asyncio.Semaphore(source['concurrency'])
+            self._limiters[name] = RateLimiter(source['rate'])
+
+        connector = aiohttp.TCPConnector(
+            limit=sum(s['concurrency'] for s in self.sources.values()),
+            keepalive_timeout=60,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def get(self, source, url, params=None, binary=False):
+        """GET url under the limits of source; return text (or bytes)."""
+        content, _ = await self.fetch(source, url, params, binary)
+        return content
+
+    async def fetch(self, source, url, params=None, binary=False,
+                    validators=None):
+        """GET url under the limits of source; return (content, validators),
+        the response's ETag and Last-Modified headers. Given the validators of
+        a copy already held, the request is conditional, and content is None
+        if the server reports the copy is still current."""
+        if params is not None:
+            # like requests, leave out parameters that aren't set
+            params = {k: v for k, v in params.items() if v is not None}
+        validators = validators or {}
+        headers = {header: validators[name]
+                   for name, header in [('ETag', 'If-None-Match'),
+                                        ('Last-Modified', 'If-Modified-Since')]
+                   if validators.get(name)}
+
+        for attempt in range(self.retries + 1):
+            async with self._sems[source]:
+                await self._limiters[source].wait()
+                instrument.count('get.requests.' + source)
+                try:
+                    async with self.session.get(url, params=params,
+                                                headers=headers) as r:
+                        if r.status in RETRY_STATUSES:
+                            raise RetryableStatus(
+                                r.status, r.headers.get('Retry-After'))
+                        r.raise_for_status()
+                        if r.status == 304:
+                            return None, validators
+                        content = await (r.read() if binary else r.text())
+                        instrument.count('get.bytes.' + source,
+                                         len(content))
+                        return content, {
+                            name: r.headers[name]
+                            for name in ('ETag', 'Last-Modified')
+                            if name in r.headers}
+                except aiohttp.ClientResponseError:
+                    # any other error status won't change on a retry
+                    raise
+                except (aiohttp.ClientError, asyncio.TimeoutError,
+                        RetryableStatus) as e:
+                    if attempt == self.retries:
+                        raise
+                    instrument.count('get.retries.' + source)
+                    delay = self.backoff * 2**attempt * (1 + random.random())
+                    retry_after = getattr(e, 'retry_after', None)
+                    if retry_after and retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+
+            # back off outside the semaphore so other requests can proceed
+            await asyncio.sleep(delay)
+
+
+async def download_all(fetcher, store, source, items, verbose=False):
+    """Download (url, params, dst, binary, transform, version) items for a
+    source.
+
+    Documents are saved to the content-addressed store under their file name
+    and linked into place at dst. version is the revision the source's
+    metadata reports for the document, e.g. arXiv's updated date, or None if
+    it reports none. A stored document is skipped if it was stored from the
+    same version; without a version, it is requested again conditionally on
+    the ETag and Last-Modified headers it was served with, and skipped if the
+    server reports it unchanged (servers that send neither header serve it
+    again in full). So an interrupted or repeated run only fetches what is new
+    or revised; files downloaded before the store existed are imported and
+    then checked the same way. Returns (downloaded, unchanged, failed) counts
+    and writes failures to <source>_failed.txt in the metadata directory.
+    """
+    todo = []
+    current = 0
+    for x in items:
+        dst, version = x[2], x[5]
+        fn = os.path.basename(dst)
+        if not store.has(source, fn) and os.path.exists(dst):
+            store.put_file(source, fn, dst)
+        stored, validators = store.revision(source, fn)
+        if version is not None and stored == version:
+            if not os.path.exists(dst):
+                store.link(store.lookup(source, fn), dst)
+            current += 1
+        elif version is None and store.has(source, fn):
+            todo.append(x + (validators,))
+        else:
+            todo.append(x + ({},))
+    failed = []
+    unmodified = []
+
+    async def one(url, params, dst, binary, transform, version, validators):
+        # any failure, in the transform or storing as well as the request,
+        # is recorded and leaves the other downloads running
+        fn = os.path.basename(dst)
+        try:
+            content, validators = await fetcher.fetch(source, url, params,
+                                                      binary, validators)
+            if content is None:
+                if not os.path.exists(dst):
+                    store.link(store.lookup(source, fn), dst)
+                unmodified.append(dst)
+                return
+            if transform is not None:
+                loop = asyncio.get_running_loop()
+                content = await loop.run_in_executor(None, transform,
+                                                     content)
+            store.put(source, fn, content, link=dst, version=version,
+                      validators=validators)
+        except Exception as e:
+            failed.append('%s\t%s' % (url, e))
+
+    with instrument.span('get.download', source=source, files=len(todo)):
+        await asyncio.gather(*[one(*x) for x in todo])
+
+    with open(settings.metadata_dir / (source + '_failed.txt'), 'w') as f:
+        f.write('\n'.join(failed))
+
+    counts = (len(todo) - len(failed) - len(unmodified),
+              current + len(unmodified), len(failed))
+    for name, n in zip(['downloaded', 'unchanged', 'failed'], counts):
+        instrument.count('get.{}.{}'.format(name, source), n)
+    if verbose:
+        print('%s: %s downloaded, %s unchanged, %s failed' %
+              ((source,) + counts))
+    return counts
 
-def collect_get_main():
-    # ------------------------------------------------------------------------
-    # arxiv
 
+async def collect_arxiv(fetcher, store, verbose=False):
     # build query and get metadata of articles matching our search criteria
     params = {'start': 0, 'max_results': 100, 'sortBy': 'relevance',
               'sortOrder': 'descending'}
     li = [x.replace('-', ' ').split(' ') for x in settings.terms]
     q = 'OR'.join(['%28' + prep_terms(x) + '%29' for x in li])
-    url = 'http://export.arxiv.org/api/query?search_query=' + q
-    arxiv_metadata = query_api(url, q, params, wait_time=1, verbose=True)
+    url = fetcher.sources['arxiv']['api'] + '?search_query=' + q
+    arxiv_metadata = await query_api_async(fetcher, url, params, verbose)
 
     # save pdfs of articles that matched our search criteria
     # we use doi as the filename when that id is present; otherwise we use the
     # arxiv id
+    items = []
     for ix, md in enumerate(arxiv_metadata):
         url = md['id']
         pdf_url = url.replace('/abs/', '/pdf/')
@@ -47,49 +264,64 @@ def collect_get_main():
         # the road
         arxiv_metadata[ix]['fn'] = article_fn
         dst = settings.raw_dir / 'arxiv' / article_fn
-        if not os.path.exists(dst):
-            r = requests.get(pdf_url)
-            with open(dst, 'wb') as f:
-                f.write(r.content)
-            time.sleep(0.3)
+        # a revised article has a new updated date
+        items.append((pdf_url, None, dst, True, None, md.get('updated')))
+
+    await download_all(fetcher, store, 'arxiv', items, verbose)
 
     # save arxiv metadata
-    fn = 'arxiv' + '.pkl'
-    dst = settings.metadata_dir / fn
-    with open(dst, 'wb') as f:
+    with open(settings.metadata_dir / 'arxiv.pkl', 'wb') as f:
         pickle.dump(arxiv_metadata, f)
 
-    # ------------------------------------------------------------------------
-    # springer
+    return arxiv_metadata
+
 
+async def collect_springer(fetcher, store, verbose=False):
     # build query to retrieve metadata
     def make_q(li):
         return '(' + ' OR '.join(['"' + s + '"' for s in li]) + ')'
 
-    q = make_q(settings.terms)
-    base = 'http://api.springernature.com/openaccess/json?q='
-    url = base + q
+    url = fetcher.sources['springer']['api']
     params = {
+        'q': make_q(settings.terms),
         'source': 'springer',
         'openaccess': 'true',
         'api_key': springer_api_key, 'p': 20, 's': 1
     }
-    params_ = copy.deepcopy(params)
-
-    # retrieve metadata
-    springer_metadata = []
-    while True:
-        r = requests.get(url, params_)
-        if len(r.json()['records']) == 0:
-            break
-        params_['s'] = params_['s'] + params_['p']
-        springer_metadata += r.json()['records']
-        time.sleep(wait_time)
-    print('%s total Springer articles' % len(springer_metadata))
-
-    # iterate over springer metadata and download html for each article
-    # we use a generator to increase wait times with each connection error
-    waits = (2**x for x in range(0, 6))
+
+    # the first page reports the total, so the rest can be fetched at once
+    first = await fetcher.get('springer', url, params)
+    first = json.loads(first)
+    springer_metadata = first['records']
+    try:
+        total = int(first['result'][0]['total'])
+    except (KeyError, IndexError, ValueError):
+        total = None
+
+    if total is not None:
+        starts = range(1 + params['p'], total + 1, params['p'])
+        pages = await asyncio.gather(*[
+            fetcher.get('springer', url, dict(params, s=s)) for s in starts])
+        for page in pages:
+            springer_metadata += json.loads(page)['records']
+    elif len(springer_metadata) > 0:
+        # no total reported; page until an empty page comes back
+        params_ = copy.deepcopy(params)
+        while True:
+            params_['s'] = params_['s'] + params_['p']
+            records = json.loads(await fetcher.get('springer', url,
+                                                params_))['records']
+            if len(records) == 0:
+                break
+            springer_metadata += records
+    if verbose:
+        print('%s total Springer articles' % len(springer_metadata))
+
+    # download html for each article
+    def clean_html(text):
+        return bs(text).encode('utf-8').decode('utf-8')
+
+    items = []
     for ix, md in enumerate(springer_metadata):
         fn = md['doi'].replace('/', '-')
         if len(fn) == 0:
@@ -97,25 +329,20 @@ def collect_get_main():
         fn = fn + '.html'
         springer_metadata[ix]['fn'] = fn
         dst = settings.raw_dir / 'springer' / fn
-        if not os.path.exists(dst):
-            try:
-                r = requests.get(md['url'][0]['value'])
-            except ConnectionError:
-                time.sleep(waits.__next__)
-                r = requests.get(md['url'][0]['value'])
-            html = bs(r.text).encode('utf-8').decode('utf-8')
-            with open(dst, 'w', encoding='utf-8') as f:
-                f.write(html)
-            time.sleep(3)
+        # springer reports no revision date, so these are revalidated
+        items.append((md['url'][0]['value'], None, dst, False, clean_html,
+                      None))
+
+    await download_all(fetcher, store, 'springer', items, verbose)
 
     # save springer metadata
-    dst = settings.metadata_dir / 'springer.pkl'
-    with open(dst, 'wb') as f:
+    with open(settings.metadata_dir / 'springer.pkl', 'wb') as f:
         pickle.dump(springer_metadata, f)
 
-    # ------------------------------------------------------------------------
-    # pubmed
+    return springer_metadata
+
 
+async def collect_pubmed(fetcher, store, verbose=False):
     # search pubmed central for free full text articles containing selected
     # query
     # get the ids which we then use to get the xml text data
@@ -123,26 +350,53 @@ def collect_get_main():
     term = 'term=' + '%28' + '+OR+'.join(terms) + '%29'
     fulltext = 'free+fulltext%5bfilter%5d'
     retmax = 'retmax=2000'
-    base = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pmc'
-    params = {'retmax': 5000, 'email': user_email}
-    url = base + '&' + term + '+' + fulltext + '&' + retmax
-    r = requests.get(url)
-    ids = [x.contents[0] for x in bs(r.text).find_all('id')]
+    base = fetcher.sources['pubmed']['api']
+    url = base + '/esearch.fcgi?db=pmc&' + term + '+' + fulltext + '&' + retmax
+    r = await fetcher.get('pubmed', url)
+    ids = [x.contents[0] for x in bs(r, 'html.parser').find_all('id')]
 
-    print('%s Pubmed Central (PMC) articles' % ids)
+    if verbose:
+        print('%s Pubmed Central (PMC) articles' % len(ids))
 
     # get xml text data and save to disk
+    items = []
     for i in ids:
-        pmc_id = 'pmc' + str(i)
-        fn = (pmc_id + '.xml')
-        dst = settings.raw_dir / 'pubmed' / fn
-        if not os.path.exists(dst):
-            url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pmc&id=' + str(i)
-            r = requests.get(url, params={'id': i})
-            xml = r.text
-            with open(dst, 'w') as f:
-                f.write(xml)
-            time.sleep(0.5)
+        dst = settings.raw_dir / 'pubmed' / ('pmc' + str(i) + '.xml')
+        url = base + '/efetch.fcgi?db=pmc&id=' + str(i)
+        params = {'id': i}
+        if user_email:
+            params['email'] = user_email
+        items.append((url, params, dst, False, None, None))
+
+    await download_all(fetcher, store, 'pubmed', items, verbose)
+
+    return ids
+
+
+async def collect_get_async(verbose=True, **fetcher_args):
+    """Collect all sources concurrently over one pooled client."""
+    store = DocumentStore()
+    try:
+        async with Fetcher(**fetcher_args) as fetcher:
+            return await asyncio.gather(*[
+                traced(collect(fetcher, store, verbose), 'get.collect',
+                       source=source)
+                for source, collect in [('arxiv', collect_arxiv),
+                                        ('springer', collect_springer),
+                                        ('pubmed', collect_pubmed)]])
+    finally:
+        store.close()
+
+
+async def traced(coro, name, **attrs):
+    """Await coro in an instrument span; gather runs each in its own task, so
+    the spans of concurrent sources stay separate."""
+    with instrument.span(name, **attrs):
+        return await coro
+
+
+def collect_get_main(verbose=True, **fetcher_args):
+    return asyncio.run(collect_get_async(verbose, **fetcher_args))
 
 
 def get_total_number_of_results(url, params):
@@ -156,42 +410,39 @@ def prep_terms(terms):
     return '+AND+'.join(['all:' + term for term in terms])
 
 
-def query_api(url, terms, params, wait_time=3, verbose=False):
-    """Query Arxiv API to obtain metadata and lookup URLs of queried articles."""
-    # get total number of results
-    n_results = get_total_number_of_results(url, {'start': 0, 'max_results': 1})
+async def query_api_async(fetcher, url, params, verbose=False):
+    """Query Arxiv API for all result pages concurrently, within the limits of
+    the fetcher, and return the combined metadata in page order."""
+    xml_text = await fetcher.get('arxiv', url,
+                                 {'start': 0, 'max_results': 1})
+    n_results = int(bs(xml_text, 'lxml').find('opensearch:totalresults')
+                    .contents[0])
     if verbose:
-        print('%s total arXiv results, %s second wait time between each call' %
-              (str(n_results), str(wait_time)))
+        print('%s total arXiv results' % n_results)
 
-    # build list to iterate over
-    # start, stop, step
-    starts = list(range(0, n_results, params['max_results']))
+    starts = range(0, n_results, params['max_results'])
+    pages = await asyncio.gather(*[
+        fetcher.get('arxiv', url, dict(params, start=start))
+        for start in starts])
 
     metadata = []
+    for xml_text in pages:
+        metadata.extend(feedparser.parse(xml_text)['entries'])
+    return metadata
 
-    # iterate over list to get all results
-    for ix, start in enumerate(starts):
-        if verbose:
-            print('*', end='')
-        params_ = copy.deepcopy(params)
-        params_['start'] = start
 
-        # ping api and retrieve xml for all articles in page
-        xml_text = requests.get(url, params=params_).text
+def query_api(url, terms, params, wait_time=3, verbose=False):
+    """Query Arxiv API to obtain metadata and lookup URLs of queried articles.
 
-        # process xml page feed
-        page_feed = feedparser.parse(xml_text)
-        entries = page_feed['entries']
+    Synchronous wrapper around query_api_async; wait_time sets the minimum
+    spacing between requests."""
+    async def run():
+        sources = copy.deepcopy(SOURCES)
+        sources['arxiv']['rate'] = 1 / wait_time if wait_time else 0
+        async with Fetcher(sources) as fetcher:
+            return await query_api_async(fetcher, url, params, verbose)
 
-        if ix == 0:
-            metadata = entries
-        else:
-            metadata.extend(entries)
-        time.sleep(wait_time)
-    if verbose:
-        print('')
-    return metadata
+    return asyncio.run(run())
 
 
 if __name__ == '__main__':
@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import json
+import pickle
 
 import numpy as np
-import pandas as pd
 from scipy.stats import zscore
 from sklearn.cross_decomposition import CCA
+from sklearn.utils.extmath import randomized_svd
 from unidecode import unidecode
 
 from multivac import settings
-from rpy2.robjects import numpy2ri, pandas2ri, r
+from multivac.src.data.embeddings import EmbeddingStore
+from multivac.src.data.glove_train import train_embeddings
 
 
 def domain_adapted_CCA(DG_embed, DS_embed, NC=100):
@@ -26,7 +28,84 @@ def domain_adapted_CCA(DG_embed, DS_embed, NC=100):
     return cca, DA_embeddings
 
 
-def glove_main():
+class DomainAdapter(object):
+    """Projection of domain-general (X) and domain-specific (Y) embeddings
+    into a shared CCA space.
+
+    method='sklearn' fits sklearn's iterative CCA on z-scores, as
+    domain_adapted_CCA does.
+    method='randomized' accumulates the covariances in chunks, so X and Y can
+    be memory maps of 1M-word vocabularies, and takes a randomized SVD of the
+    whitened cross-covariance.
+    """
+
+    def __init__(self, NC=100, method='sklearn', chunk_size=100000):
+        self.NC = NC
+        self.method = method
+        self.chunk_size = chunk_size
+
+    def fit(self, X, Y):
+        """Fit on the paired rows of X and Y."""
+        if self.method == 'sklearn':
+            self.x_mean, self.x_std = X.mean(axis=0), X.std(axis=0)
+            self.y_mean, self.y_std = Y.mean(axis=0), Y.std(axis=0)
+            cca = CCA(n_components=self.NC)
+            cca.fit(zscore(X), zscore(Y))
+            self.x_proj, self.y_proj = cca.x_rotations_, cca.y_rotations_
+        elif self.method == 'randomized':
+            self._fit_randomized(X, Y)
+        else:
+            raise ValueError('Only "sklearn" and "randomized" CCA supported.')
+        return self
+
+    def _fit_randomized(self, X, Y, reg=1e-6):
+        n, p = X.shape
+        sx, sy = np.zeros(p), np.zeros(Y.shape[1])
+        sxx = np.zeros((p, p))
+        syy = np.zeros((Y.shape[1], Y.shape[1]))
+        sxy = np.zeros((p, Y.shape[1]))
+        for i in range(0, n, self.chunk_size):
+            x = np.asarray(X[i:i + self.chunk_size], dtype=np.float64)
+            y = np.asarray(Y[i:i + self.chunk_size], dtype=np.float64)
+            sx += x.sum(axis=0)
+            sy += y.sum(axis=0)
+            sxx += x.T @ x
+            syy += y.T @ y
+            sxy += x.T @ y
+
+        self.x_mean, self.y_mean = sx / n, sy / n
+        Cxx = sxx / n - np.outer(self.x_mean, self.x_mean)
+        Cyy = syy / n - np.outer(self.y_mean, self.y_mean)
+        Cxy = sxy / n - np.outer(self.x_mean, self.y_mean)
+
+        # work with z-scores, as domain_adapted_CCA does
+        self.x_std = np.sqrt(np.maximum(np.diag(Cxx), 1e-12))
+        self.y_std = np.sqrt(np.maximum(np.diag(Cyy), 1e-12))
+        Cxx /= np.outer(self.x_std, self.x_std)
+        Cyy /= np.outer(self.y_std, self.y_std)
+        Cxy /= np.outer(self.x_std, self.y_std)
+
+        Wx = self._inv_sqrt(Cxx, reg)
+        Wy = self._inv_sqrt(Cyy, reg)
+        U, S, Vt = randomized_svd(Wx @ Cxy @ Wy, self.NC, random_state=0)
+        self.x_proj = Wx @ U
+        self.y_proj = Wy @ Vt.T
+
+    @staticmethod
+    def _inv_sqrt(C, reg):
+        vals, vecs = np.linalg.eigh(C + reg * np.eye(len(C)))
+        return (vecs / np.sqrt(np.maximum(vals, reg))) @ vecs.T
+
+    def transform_general(self, X):
+        return ((X - self.x_mean) / self.x_std) @ self.x_proj
+
+    def transform_specific(self, Y):
+        return ((Y - self.y_mean) / self.y_std) @ self.y_proj
+
+
+def glove_main(cca_method='sklearn', NC=100):
+    """Train domain-specific GloVe embeddings on the parsed articles and
+    align them with the domain-general ones by CCA."""
     # Load data from nlp parsing
     with open('{}/articles-with-equations.json'.format(settings.data_dir), 'r',
               encoding='utf-8') as jf:
@@ -35,81 +114,60 @@ def glove_main():
     texts = [src_data[art]['text'] for art in src_data if
              src_data[art]['text'] is not None]
 
-    # The "unidecode" step simplifies non-ASCII chars which
-    # mess up the R GloVe engine.
-    texts_df = pd.Series(texts).apply(lambda x: unidecode(x))
-    texts_df = pd.DataFrame({'text': texts_df})
+    # The "unidecode" step simplifies non-ASCII chars so tokens match the
+    # domain-general GloVe vocabulary.
+    texts = [unidecode(x) for x in texts]
 
-    # Source all the functions contained in the 'trainEmbeddings' R file
-    r("source('{}/trainEmbeddings.R'.format('src/data'))")
-
-    # Call the main GloVe-embedding function from the R script
-    trainEmbeddings_R = r("trainEmbeddings")
-
-    # Train domain-specific GloVe embedding model and ouput as a Numpy Matrix
-    pandas2ri.activate()
-    DS_embeddings_R = trainEmbeddings_R(texts_df)
-    pandas2ri.deactivate()
-
-    DS_embeddings = numpy2ri.rpy2py(DS_embeddings_R[0])
-
-    # Get domain-specific GloVe vocabulary
-    domain_spec_vocab = list(DS_embeddings_R[1])
+    # Train domain-specific GloVe embedding model as a Numpy Matrix, along
+    # with the domain-specific GloVe vocabulary
+    DS_embeddings, domain_spec_vocab = train_embeddings(texts, verbose=True)
+    domain_spec_vocab = np.array(domain_spec_vocab, dtype=object)
 
     # Load in Stanford's 'Common Crawl' domain-general Glove Embedding Model
-    # Only pull out the words that are contained in our corpus
-    # * This can take a while (~30min) - could use some optimization *
-    DG_embeddings = loadGloveModel(
-        '{}/glove.42B.300d.txt'.format(settings.data_dir),
-        domain_spec_vocab
-    )
-
-    # Processing to ensure rows match between the domain-general and
-    # domain-specific embeddings
-    # Convert domain-general embedding from dictionary to array
-    domain_gen_vocab = np.array([DG_embeddings[i] for i in
-                                DG_embeddings.keys()])
-
-    # Find the indices of matching words
-    both = set(domain_gen_vocab).intersection(domain_spec_vocab)
-    indices_gen = [domain_gen_vocab.index(x) for x in both]
-    indices_spec = [domain_spec_vocab.index(x) for x in both]
-    indices_spec_notDG = [domain_spec_vocab.index(x) for x in
-                          domain_spec_vocab if x not in both]
-
-    # Sort and subset domain-specific array to match indices of domain-general
-    # array
-    DS_embeddings_subset = DS_embeddings[indices_spec, :].copy()
-    DG_embeddings_subset = DG_embeddings[indices_gen, :].copy()
-
-    # fit cca model
-    cca_res, DA_embeddings = domain_adapted_CCA(DG_embeddings_subset,
-                                                DS_embeddings_subset, NC=100)
-
-    DS_embeddings_notinDG = DS_embeddings[indices_spec_notDG, :]
-    DS_embeddings_notinDG_norm = zscore(DS_embeddings_notinDG)
-
-    DA_notinDG_embeddings = cca_res.y_weights_.T @ DS_embeddings_notinDG_norm.T
-    DA_embeddings_final = np.append(DA_embeddings, DA_notinDG_embeddings.T,
+    # (the text file is converted to an embedding store on first use)
+    DG_store = EmbeddingStore.open(
+        '{}/glove.42B.300d.txt'.format(settings.data_dir), verbose=True)
+
+    # Join the vocabularies through the store's hash index: the row of each
+    # domain-specific word in the domain-general matrix, or -1
+    rows_gen = DG_store.indices(domain_spec_vocab)
+    inDG = rows_gen >= 0
+    both = domain_spec_vocab[inDG]
+
+    DS_embeddings_subset = DS_embeddings[inDG]
+    DG_embeddings_subset = DG_store.vectors[rows_gen[inDG]]
+    DS_embeddings_notinDG = DS_embeddings[~inDG]
+
+    # fit cca model; retrained domain-specific vectors are in a new space, so
+    # the projection is fit anew on every run
+    adapter = DomainAdapter(NC, cca_method).fit(DG_embeddings_subset,
+                                                DS_embeddings_subset)
+
+    DA_embeddings = (adapter.transform_general(DG_embeddings_subset) +
+                     adapter.transform_specific(DS_embeddings_subset)) / 2
+    DA_notinDG_embeddings = adapter.transform_specific(DS_embeddings_notinDG)
+
+    DA_embeddings_final = np.append(DA_embeddings, DA_notinDG_embeddings,
                                     axis=0)
+    DA_vocab = list(both) + list(domain_spec_vocab[~inDG])
 
-    # write data to disk
-    np.savetxt('{}/da_embeddings.txt'.format(settings.models_dir),
-               DA_embeddings_final, fmt='%d')
+    # write data to disk, as GloVe text and as the pickle the RDF and GAN
+    # models load
+    with open('{}/da_embeddings.txt'.format(settings.models_dir), 'w',
+              encoding='utf-8') as f:
+        for word, vector in zip(DA_vocab, DA_embeddings_final):
+            f.write(word + ' ' + ' '.join('{:.6f}'.format(v) for v in vector)
+                    + '\n')
+    with open('{}/DA_glove_embeddings_{}.pkl'.format(settings.models_dir, NC),
+              'wb') as f:
+        pickle.dump({'vocab': DA_vocab,
+                     'embeddings': DA_embeddings_final.astype(np.float32)}, f)
 
 
 def loadGloveModel(gloveFile, vocab):
-    f = open(gloveFile, ' r')
-
-    model = {}
-    for line in f:
-        splitLine = line.split()
-        word = splitLine[0]
-        if word in vocab:
-            embedding = np.array([float(val) for val in splitLine[1:]])
-            model[word] = embedding
-
-    return model
+    """Return {word: vector} for the words of vocab in a GloVe file, read
+    through its memory-mapped embedding store."""
+    return EmbeddingStore.open(gloveFile, verbose=True).to_dict(vocab)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GloVe embeddings trained in-process with NumPy and scipy, in place of the
+text2vec model in trainEmbeddings.R.
+
+The steps follow that script: lowercase and tokenize, drop terms seen fewer
+than term_count_min times (keeping their positions, as quanteda's padding
+does), count co-occurrences in a window weighted by 1/distance, fit GloVe
+with AdaGrad, and return the sum of the word and context vectors.
+"""
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+TOKEN_REGEX = re.compile(r"\w+(?:[-'’]\w+)*|[^\w\s]")
+
+
+def tokenize(text):
+    return TOKEN_REGEX.findall(text.lower())
+
+
+def _count_terms(texts):
+    counts = Counter()
+    for text in texts:
+        counts.update(tokenize(text))
+    return counts
+
+
+# index of the vocabulary in each co-occurrence worker, set once by
+# _init_cooccurrence rather than sent with every chunk
+_index = None
+
+
+def _init_cooccurrence(vocab):
+    global _index
+    _index = {word: i for i, word in enumerate(vocab)}
+
+
+def _cooccurrence_chunk(args):
+    """Co-occurrence counts of one chunk of documents, as the (rows, cols,
+    weights) triplets of an upper-triangular sparse matrix."""
+    texts, window = args
+    index = _index
+    rows, cols, weights = [], [], []
+
+    for text in texts:
+        ids = np.array([index.get(token, -1) for token in tokenize(text)],
+                       dtype=np.int64)
+        for d in range(1, min(window, len(ids) - 1) + 1):
+            left, right = ids[:-d], ids[d:]
+            keep = (left >= 0) & (right >= 0)
+            rows.append(left[keep])
+            cols.append(right[keep])
+            weights.append(np.full(keep.sum(), 1.0 / d))
+
+    if not rows:
+        return (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                np.zeros(0))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    n = len(index)
+    # summed within the chunk, so only distinct pairs go back
+    upper = sparse.coo_matrix((np.concatenate(weights),
+                               (np.minimum(rows, cols),
+                                np.maximum(rows, cols))), shape=(n, n))
+    upper.sum_duplicates()
+    return (upper.row.astype(np.int32), upper.col.astype(np.int32),
+            upper.data)
+
+
+def cooccurrence_matrix(texts, term_count_min=5, window=10, workers=None,
+                        chunk_size=200):
+    """Return (vocab, X) where X is the symmetric sparse matrix of weighted
+    co-occurrence counts of the terms of vocab, counted in parallel over
+    chunks of documents and summed in one pass over all their triplets."""
+    workers = workers or os.cpu_count()
+    chunks = [texts[i:i + chunk_size]
+              for i in range(0, len(texts), chunk_size)]
+
+    with ProcessPoolExecutor(workers) as pool:
+        counts = Counter()
+        for chunk_counts in pool.map(_count_terms, chunks):
+            counts.update(chunk_counts)
+        vocab = sorted((w for w, c in counts.items() if c >= term_count_min),
+                       key=lambda w: (-counts[w], w))
+
+    with ProcessPoolExecutor(workers, initializer=_init_cooccurrence,
+                             initargs=(vocab,)) as pool:
+        triplets = list(pool.map(_cooccurrence_chunk,
+                                 [(chunk, window) for chunk in chunks]))
+
+    n = len(vocab)
+    if triplets:
+        rows, cols, weights = (np.concatenate(t) for t in zip(*triplets))
+    else:
+        rows, cols, weights = [], [], []
+    upper = sparse.coo_matrix((weights, (rows, cols)), shape=(n, n)).tocsr()
+    X = (upper + upper.T - sparse.diags(upper.diagonal())).tocoo()
+    X.eliminate_zeros()
+    return vocab, X
+
+
+def _scatter(idx, values):
+    """Sum the rows of values that share an index: returns the unique indices
+    and their summed rows."""
+    unique, inverse = np.unique(idx, return_inverse=True)
+    S = sparse.csr_matrix((np.ones(len(idx), dtype=values.dtype),
+                           (inverse, np.arange(len(idx)))),
+                          shape=(len(unique), len(idx)))
+    return unique, S @ values
+
+
+def fit_glove(X, word_vectors_size=300, x_max=100, alpha=0.75, n_iter=100,
+              convergence_tol=0.01, learning_rate=0.05, batch_size=65536,
+              seed=0, verbose=False):
+    """Fit GloVe to a sparse co-occurrence matrix with AdaGrad, updating
+    batch_size co-occurrences at a time with vectorized steps. Stops after
+    n_iter epochs or when the cost improves by less than convergence_tol
+    (relative). Returns the word plus context vectors."""
+    rng = np.random.RandomState(seed)
+    n, dim = X.shape[0], word_vectors_size
+    X = X.tocoo()
+    rows, cols = X.row, X.col
+    logs = np.log(X.data).astype(np.float32)
+    weights = np.minimum(1.0, (X.data / x_max) ** alpha).astype(np.float32)
+
+    W = ((rng.rand(n, dim) - 0.5) / dim).astype(np.float32)
+    C = ((rng.rand(n, dim) - 0.5) / dim).astype(np.float32)
+    bw = np.zeros(n, dtype=np.float32)
+    bc = np.zeros(n, dtype=np.float32)
+    # AdaGrad squared-gradient sums, started at 1 as in the reference code
+    gW = np.ones((n, dim), dtype=np.float32)
+    gC = np.ones((n, dim), dtype=np.float32)
+    gbw = np.ones(n, dtype=np.float32)
+    gbc = np.ones(n, dtype=np.float32)
+
+    prev_cost = None
+    for epoch in range(n_iter):
+        start = time.time()
+        cost = 0.0
+        order = rng.permutation(len(logs))
+        for b in range(0, len(order), batch_size):
+            batch = order[b:b + batch_size]
+            i, j = rows[batch], cols[batch]
+            diff = ((W[i] * C[j]).sum(axis=1) + bw[i] + bc[j] - logs[batch])
+            fdiff = weights[batch] * diff
+            cost += 0.5 * float((fdiff * diff).sum())
+
+            grad_w = fdiff[:, None] * C[j]
+            grad_c = fdiff[:, None] * W[i]
+
+            ui, grad_w = _scatter(i, grad_w)
+            uj, grad_c = _scatter(j, grad_c)
+            ub, grad_bw = _scatter(i, fdiff[:, None])
+            uc, grad_bc = _scatter(j, fdiff[:, None])
+
+            W[ui] -= learning_rate * grad_w / np.sqrt(gW[ui])
+            C[uj] -= learning_rate * grad_c / np.sqrt(gC[uj])
+            bw[ub] -= learning_rate * grad_bw[:, 0] / np.sqrt(gbw[ub])
+            bc[uc] -= learning_rate * grad_bc[:, 0] / np.sqrt(gbc[uc])
+            gW[ui] += grad_w ** 2
+            gC[uj] += grad_c ** 2
+            gbw[ub] += grad_bw[:, 0] ** 2
+            gbc[uc] += grad_bc[:, 0] ** 2
+
+        cost /= max(len(logs), 1)
+        if verbose:
+            print('epoch {}, cost {:.4f}, {:.1f}s'.format(
+                epoch + 1, cost, time.time() - start))
+        if prev_cost is not None and \
+                (prev_cost - cost) / max(cost, 1e-12) < convergence_tol:
+            break
+        prev_cost = cost
+
+    return W + C
+
+
+def train_embeddings(texts, term_count_min=5, skip_grams_window=10,
+                     word_vectors_size=300, x_max=100, n_iter=100,
+                     convergence_tol=0.01, learning_rate=0.05, workers=None,
+                     verbose=False):
+    """Fit GloVe embeddings on a list of texts, with the defaults of
+    trainEmbeddings.R. Returns (word vectors, vocabulary)."""
+    start = time.time()
+    vocab, X = cooccurrence_matrix(texts, term_count_min, skip_grams_window,
+                                   workers)
+    if verbose:
+        print('Co-occurrence matrix: {} terms, {} entries, {:.1f}s'.format(
+            len(vocab), X.nnz, time.time() - start))
+        print('Fitting GloVe model...')
+
+    vectors = fit_glove(X, word_vectors_size, x_max,
+                        n_iter=n_iter, convergence_tol=convergence_tol,
+                        learning_rate=learning_rate, verbose=verbose)
+    if verbose:
+        print('Done.')
+    return vectors, vocab
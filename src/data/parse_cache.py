@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-document caches for nlp_parse_main.
+
+Cleaned texts are kept by the hash of the raw text, and parse outputs
+(.dep/.input/.morph) by the hash of the cleaned text plus the parser version,
+so a rerun only cleans and parses documents that are new or changed. Entries
+are written under temporary names and renamed into place, so several runs can
+share a cache without seeing partial files.
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+from multivac import settings
+
+PARSE_EXTS = ('dep', 'input', 'morph')
+DOC_FILE = re.compile(r'^(\d{4,})\.(?:%s)$' % '|'.join(PARSE_EXTS))
+
+
+def text_hash(*parts):
+    """Return the SHA-256 hex digest of the given strings."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ParseCache(object):
+    """Cleaned texts and parse files keyed by content hash."""
+
+    def __init__(self, version, root=None):
+        self.version = version
+        self.root = str(root if root is not None
+                        else settings.interim_dir / 'parse_cache')
+        self.clean_dir = os.path.join(self.root, 'clean')
+        self.parse_dir = os.path.join(self.root, 'parse')
+        os.makedirs(self.clean_dir, exist_ok=True)
+        os.makedirs(self.parse_dir, exist_ok=True)
+
+    def get_clean(self, raw):
+        """Return the cleaned text saved for a raw text, or None."""
+        try:
+            with open(self._clean_path(raw), 'r', encoding='utf8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_clean(self, raw, clean):
+        dst = self._clean_path(raw)
+        tmp = '%s.%s.part' % (dst, os.getpid())
+        with open(tmp, 'w', encoding='utf8') as f:
+            f.write(clean)
+        os.replace(tmp, dst)
+
+    def key(self, clean):
+        """Return the parse key of a cleaned text under this parser version."""
+        return text_hash(self.version, clean)
+
+    def has(self, key):
+        return os.path.isdir(os.path.join(self.parse_dir, key))
+
+    def tempdir(self):
+        """Return a new directory, inside the cache, for workers to write
+        parse files into before they are added with put."""
+        return tempfile.mkdtemp(prefix='run.', dir=self.root) + os.sep
+
+    def put(self, key, srcDir, docNum):
+        """Move the parse files of document docNum from srcDir into the cache.
+        If another run already added the key, its entry is kept."""
+        tmp = tempfile.mkdtemp(prefix=key + '.', dir=self.parse_dir)
+        for ext in PARSE_EXTS:
+            os.replace(self._doc_path(srcDir, docNum, ext),
+                       os.path.join(tmp, ext))
+        try:
+            os.rename(tmp, os.path.join(self.parse_dir, key))
+        except OSError:
+            shutil.rmtree(tmp)
+
+    def link(self, key, dstDir, docNum):
+        """Make the cached parse files for key the outputs of document
+        docNum in dstDir."""
+        for ext in PARSE_EXTS:
+            src = os.path.join(self.parse_dir, key, ext)
+            dst = self._doc_path(dstDir, docNum, ext)
+            if os.path.exists(dst) and os.path.samefile(src, dst):
+                continue
+            tmp = '%s.%s.part' % (dst, os.getpid())
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+
+    def unlink(self, dstDir, docNum):
+        """Remove the outputs of document docNum from dstDir, if any."""
+        for ext in PARSE_EXTS:
+            try:
+                os.remove(self._doc_path(dstDir, docNum, ext))
+            except FileNotFoundError:
+                pass
+
+    def prune(self, dstDir, count):
+        """Remove the outputs in dstDir of documents numbered count or
+        above."""
+        if not os.path.isdir(str(dstDir)):
+            return
+        for fn in os.listdir(str(dstDir)):
+            m = DOC_FILE.match(fn)
+            if m and int(m.group(1)) >= count:
+                os.remove(os.path.join(str(dstDir), fn))
+
+    def _clean_path(self, raw):
+        return os.path.join(self.clean_dir, text_hash(raw))
+
+    @staticmethod
+    def _doc_path(folder, docNum, ext):
+        return os.path.join(str(folder), '{0:04d}.{1}'.format(docNum, ext))
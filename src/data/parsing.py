@@ -1,26 +1,42 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import copy
 import json
+import multiprocessing as mp
+import os
 import pickle
+import queue
 import re as reg
+import shutil
+import time
+from types import SimpleNamespace
 
 import spacy
 import stanfordnlp
-from interruptingcow import timeout
+import sympy
 
 import multivac.src.data.equationparsing as eq
 from multivac import settings
-from multivac.src.data.textparsing import clean_doc
+from multivac.src import instrument
+from multivac.src.data.parse_cache import ParseCache
+from multivac.src.data.process import JSONLRecords
+from multivac.src.data.textparsing import clean_docs
 
+SENTENCE_END = reg.compile(r'(?<=[.!?])\s+(?=[A-Z])')
 
-def create_parse_files(doc, docNum, writeFile=True, pathToFolders=''):
+# bump when create_parse_files changes, so cached parse files are redone
+PARSE_FORMAT = 1
+
+
+def create_parse_files(doc, docNum, writeFile=True, pathToFolders='',
+                       equations=None):
     """ Creates parse files and stores them in the folder passed when
         writeFile=True and pathToFolders is provided
         The following file types are created
             * dep -- for dependencies
             * input -- for POS tagging
             * morph -- lemmatized words
+        equations maps LateX equation tags in the text to their sympy string
+        representations, as returned by equationparsing.parse_equations
     """
 
     d_documentData = {
@@ -68,7 +84,8 @@ def create_parse_files(doc, docNum, writeFile=True, pathToFolders=''):
 
                 l_depTokens_latex_sub_tuples, l_posTokens_latex_sub,\
                     l_morTokens_latex_sub = eq.latexParsing(
-                         latexEquationId, int(token.index) + adjustedPosition)
+                         latexEquationId, int(token.index) + adjustedPosition,
+                         equations)
 
                 # Need to adjust position so that it we add all the new tokens,
                 # then subtract 1 for LateXEquation##
@@ -123,9 +140,6 @@ def create_parse_files(doc, docNum, writeFile=True, pathToFolders=''):
                     l_posTokens = l_posTokens + l_posTokens_latex_sub
                     l_morTokens = l_morTokens + l_morTokens_latex_sub
 
-                    # For keeping track of latex tokens and their tag IDs
-                    eq.LATEXMAPTOKENS[latexEquationId] = ' '.join(l_morTokens_latex_sub)
-
                     # Use this to replace the Ltxqtn tag when it's a head
 
                     latexInSentenceMap[token.text] = {
@@ -270,62 +284,223 @@ def get_token_governor(token, sent):
 def load_data(jsonPath, picklePath=None):
     """Load data - if picklePath is specified, load the pickle. Else, try
        json file.
-       This returns the JSON file as well as a list of document texts
+       This returns the JSON file as well as a list of document texts; the
+       records of a JSONL file are returned as a JSONLRecords, which reads
+       them again each time it is iterated instead of holding them all
     """
     if picklePath is not None:
         l_docs = pickle.load(open(picklePath, "rb"))
     else:
 
-        # Read JSON data into the datastore variable - this comes from
-        # other team members effort.
-        with open(jsonPath, 'r') as f:
-            datastore = json.load(f)
-
         # These were some bad files - nothing substantive in them, or they
         # were retrieved in bad format
         bad_files = ['1805.10677v1', '0911.5378v1']
-        datastore = {k: v for k, v in datastore.items() if k not in bad_files}
+
+        # Read JSON data into the datastore variable - this comes from
+        # other team members effort. Processing appends records to a JSONL
+        # file, which is read one record at a time.
+        if str(jsonPath).endswith('.jsonl'):
+            datastore = JSONLRecords(jsonPath, exclude=bad_files)
+        else:
+            with open(jsonPath, 'r') as f:
+                datastore = json.load(f)
+            datastore = {k: v for k, v in datastore.items()
+                         if k not in bad_files}
 
         # Extract texts
-        l_docs = [value['text'] for key, value in
-                  list(datastore.items())[0:] if value['text']]
+        l_docs = [value['text'] for value in datastore.values()
+                  if value['text']]
 
     print('# of documents: ', len(l_docs))
 
     return datastore, l_docs
 
 
+def load_pipeline():
+    """Load the stanfordnlp pipeline used to parse documents."""
+    return stanfordnlp.Pipeline(models_dir=settings.stanf_nlp_dir,
+                                treebank='en_ewt', use_gpu=False,
+                                pos_batch_size=3000)
+
+
+def parser_version():
+    """Identify the parser models and output format, for the parse cache."""
+    return 'stanfordnlp-{}-en_ewt-sympy-{}-{}'.format(
+        getattr(stanfordnlp, '__version__', ''),
+        getattr(sympy, '__version__', ''), PARSE_FORMAT)
+
+
+def parse_in_chunks(nlp, text, chunk_size=100):
+    """Parse a document chunk_size sentences at a time, so long documents are
+    batched by the pipeline without holding the whole parse in one call.
+    Returns an object with the combined sentences, for create_parse_files.
+    """
+    sentences = SENTENCE_END.split(text)
+    parsed = []
+    for i in range(0, len(sentences), chunk_size):
+        chunk = ' '.join(sentences[i:i + chunk_size])
+        if chunk.strip():
+            parsed.extend(nlp(chunk).sentences)
+    return SimpleNamespace(sentences=parsed)
+
+
+def parse_worker(wid, tasks, results, pathToFolders, chunk_size, equations):
+    """Parse documents from the tasks queue with this process's own pipeline
+    until a None task arrives. Sends (wid, docNum, error) to the results
+    queue; docNum is None once the pipeline is ready."""
+    import torch
+    # one thread per worker; the pool supplies the parallelism
+    torch.set_num_threads(1)
+    with instrument.span('parse.load_pipeline'):
+        nlp = load_pipeline()
+    results.put((wid, None, None))
+
+    for docNum, doc in iter(tasks.get, None):
+        with instrument.span('parse.document', doc=docNum, chars=len(doc)):
+            try:
+                parsed = parse_in_chunks(nlp, doc, chunk_size)
+                instrument.count('parse.sentences', len(parsed.sentences))
+                create_parse_files(parsed, docNum, True, pathToFolders,
+                                   equations)
+                error = None
+            except Exception as e:
+                error = '{}: {}'.format(type(e).__name__, e)
+        results.put((wid, docNum, error))
+
+
+def parse_documents(docs, pathToFolders, workers=None, doc_timeout=300,
+                    chunk_size=100, on_done=None, equations=None):
+    """Parse (docNum, text) pairs in a pool of worker processes, each writing
+    its documents' parse files as soon as they are done.
+
+    The parent gives each worker one document at a time and times it; a worker
+    that takes longer than doc_timeout seconds, or dies, is replaced and its
+    document skipped. on_done, if given, is called with the number of each
+    document whose files were written. Returns the numbers of the documents
+    that were skipped, including any not started because no worker could
+    load its pipeline.
+    """
+    workers = workers or os.cpu_count()
+    results = mp.Queue()
+    procs = {}
+    docs = iter(docs)
+    running = {}
+    failed = []
+
+    def start(wid):
+        tasks = mp.Queue()
+        proc = mp.Process(target=parse_worker, daemon=True,
+                          args=(wid, tasks, results, pathToFolders,
+                                chunk_size, equations))
+        proc.start()
+        procs[wid] = (proc, tasks)
+
+    def assign(wid):
+        for docNum, doc in docs:
+            print('Processing document #{}'.format(docNum))
+            procs[wid][1].put((docNum, doc))
+            running[wid] = (docNum, time.time())
+            return
+        running.pop(wid, None)
+
+    def restart(wid, reason):
+        docNum, _ = running.pop(wid)
+        print(reason.format(docNum))
+        failed.append(docNum)
+        procs[wid][0].terminate()
+        procs[wid][0].join()
+        start(wid)
+
+    for wid in range(workers):
+        start(wid)
+
+    while procs:
+        try:
+            wid, docNum, error = results.get(timeout=1)
+            if docNum is not None and running.get(wid, (None,))[0] != docNum:
+                # left over from a worker that was replaced
+                continue
+            if docNum is not None:
+                running.pop(wid, None)
+                if error is not None:
+                    print('Error parsing document #{}: {}'.format(docNum,
+                                                                  error))
+                    failed.append(docNum)
+                elif on_done is not None:
+                    on_done(docNum)
+            assign(wid)
+            if wid not in running:
+                procs[wid][1].put(None)
+                procs.pop(wid)[0].join()
+        except queue.Empty:
+            pass
+
+        now = time.time()
+        for wid, (proc, _) in list(procs.items()):
+            if wid in running and now - running[wid][1] > doc_timeout:
+                restart(wid, "Didn't finish document #{{}} within {} seconds. "
+                        "Moving to next one.".format(doc_timeout))
+            elif wid in running and not proc.is_alive():
+                restart(wid, 'Worker died parsing document #{}. Moving to '
+                        'next one.')
+            elif not proc.is_alive():
+                print('Parse worker {} failed to start.'.format(wid))
+                procs.pop(wid)
+
+    # left over if every worker failed to start
+    remaining = [docNum for docNum, _ in docs]
+    if remaining:
+        print('No parse workers left; skipping {} documents.'.format(
+            len(remaining)))
+        failed.extend(remaining)
+
+    return failed
+
+
 def nlp_parse_main(args_dict):
     ''' Main run file that orchestrates everything
     '''
 
-    # Load NLP engines
-    spacynlp = spacy.load('en_core_web_sm')
-    nlp = stanfordnlp.Pipeline(models_dir=settings.stanf_nlp_dir,
-                               treebank='en_ewt', use_gpu=False,
-                               pos_batch_size=3000)
-
     # Load documents
-    jsonObj, allDocs = load_data(settings.processed_dir / 'data.json')
-
-    # Process and Clean documents
-    try:
-        allDocsClean = pickle.load(open('allDocsClean.pkl', "rb" ))
-        print('Loaded pickle!')
-    except FileNotFoundError:
-        print('Starting from scratch')
-        allDocsClean = []
-        for i, doc in enumerate(allDocs):
-            if i % 10 == 0:
-                print(i)
-            allDocsClean.append(clean_doc(doc, spacynlp))
-
-        with open('allDocsClean.pkl', 'wb') as f:
-            pickle.dump(allDocsClean, f)
-
-    allDocs2 = [eq.extract_and_replace_latex(doc) for docNum, doc in
-                enumerate(allDocsClean)]
-    print('Number of LateX Equations parsed: {}'.format(len(eq.LATEXMAP)))
+    with instrument.span('parse.load_data'):
+        jsonObj, allDocs = load_data(settings.processed_dir / 'data' /
+                                     'data.jsonl')
+    cache = ParseCache(parser_version())
+    instrument.count('parse.documents', len(allDocs))
+
+    # Process and Clean documents, reusing texts cleaned by earlier runs
+    allDocsClean = [cache.get_clean(doc) for doc in allDocs]
+    dirty = [i for i, clean in enumerate(allDocsClean) if clean is None]
+    print('{} documents to clean'.format(len(dirty)))
+    instrument.count('parse.cleaned', len(dirty))
+
+    if dirty:
+        with instrument.span('parse.clean', docs=len(dirty)):
+            # only the vocabulary is used, so no pipeline components are
+            # needed
+            spacynlp = spacy.load('en_core_web_sm',
+                                  disable=['tagger', 'parser', 'ner'])
+            cleaned = clean_docs([allDocs[i] for i in dirty], spacynlp,
+                                 n_process=args_dict.get('nlp_workers') or
+                                 os.cpu_count())
+            for i, clean in zip(dirty, cleaned):
+                cache.put_clean(allDocs[i], clean)
+                allDocsClean[i] = clean
+
+    with instrument.span('parse.equations') as span:
+        allDocs2 = []
+        latexMap = {}
+        for doc in allDocsClean:
+            doc, docLatex = eq.extract_and_replace_latex(doc)
+            allDocs2.append(doc)
+            latexMap.update(docLatex)
+
+        memo = eq.EquationMemo(settings.interim_dir / 'equations.sqlite')
+        equations = eq.parse_equations(latexMap, memo,
+                                       workers=args_dict.get('nlp_workers'))
+        memo.close()
+        span.set(equations=len(latexMap))
+    print('Number of LateX Equations parsed: {}'.format(len(equations)))
 
     # Put equations back into text - this will be fed to glove embedding
     if args_dict['nlp_newjson']:
@@ -335,38 +510,58 @@ def nlp_parse_main(args_dict):
         for i, doc in enumerate(allDocs2[0:]):
             if i % percentCompletedMultiple == 0:
                 print('{}% completed'.format(round(i/(len(allDocs2))*100, 0)))
-            newDoc = reg.sub(r'Ltxqtn[a-z]{8}', eq.put_equation_tokens_in_text,
+            newDoc = reg.sub(r'Ltxqtn[a-z]{8}',
+                             lambda m: eq.put_equation_tokens_in_text(
+                                 m, equations),
                              doc)
             allDocs3.append(newDoc)
 
-        jsonObj2 = copy.deepcopy(jsonObj)
         allDocs3Counter = 0
 
-        for key, value in list(jsonObj2.items()):
-            if value['text']:
-                jsonObj2[key]['text'] = allDocs3[allDocs3Counter]
-                allDocs3Counter = allDocs3Counter+1
-
+        # written one record at a time as jsonObj is read, in the format
+        # json.dump would give the whole object
         with open('{}/articles-with-equations.json'.format(settings.data_dir),
                   'w', encoding='utf8') as fp:
-            json.dump(jsonObj2, fp)
-
-    # Parse files into DIM
-    startPoint = -1
-    if args_dict['nlp_bp'] is not None:
-        startPoint = args_dict['nlp_bp']
-
-    for i, doc in enumerate(allDocs2[0:]):
-        print('Processing document #{}'.format(i))
-        if i > startPoint:
+            fp.write('{')
+            for n, (key, value) in enumerate(jsonObj.items()):
+                if value['text']:
+                    value = dict(value, text=allDocs3[allDocs3Counter])
+                    allDocs3Counter = allDocs3Counter+1
+                fp.write('{}{}: {}'.format(', ' if n else '', json.dumps(key),
+                                           json.dumps(value)))
+            fp.write('}')
+
+    # Parse files into DIM, linking the outputs of unchanged documents
+    dataDir = str(settings.data_dir)
+    keys = [cache.key(doc) for doc in allDocsClean]
+    docs = []
+    for i, doc in enumerate(allDocs2):
+        if cache.has(keys[i]):
+            cache.link(keys[i], dataDir, i)
+        else:
+            docs.append((i, doc))
+    print('{} documents unchanged, {} to parse'.format(
+        len(allDocs2) - len(docs), len(docs)))
+    instrument.count('parse.cache_hits', len(allDocs2) - len(docs))
+
+    runDir = cache.tempdir()
+
+    def add_to_cache(docNum):
+        cache.put(keys[docNum], runDir, docNum)
+        cache.link(keys[docNum], dataDir, docNum)
 
-            # Use exception handling so that the process doesn't get stuck and
-            # time out because of memory errors
-            try:
-                with timeout(300, exception=RuntimeError):
-                    nlpifiedDoc = nlp(doc)
-                    create_parse_files(
-                        nlpifiedDoc, i, True, settings.data_dir
-                    )
-            except RuntimeError:
-                print("Didn't finish document #{} within five minutes. Moving to next one.".format(i))
+    try:
+        with instrument.span('parse.documents', docs=len(docs)):
+            failed = parse_documents(
+                docs, runDir, workers=args_dict.get('nlp_workers'),
+                doc_timeout=args_dict.get('nlp_timeout') or 300,
+                on_done=add_to_cache, equations=equations)
+        instrument.count('parse.failed', len(failed))
+    finally:
+        shutil.rmtree(runDir, ignore_errors=True)
+
+    # outputs are numbered by position, so files left by an earlier run for a
+    # skipped document, or past the last document, would belong to another
+    for docNum in failed:
+        cache.unlink(dataDir, docNum)
+    cache.prune(dataDir, len(allDocs2))
@@ -5,6 +5,7 @@ import json
 import os
 import pickle
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import pubmed_parser
 from bs4 import BeautifulSoup as bs
@@ -12,113 +13,229 @@ from bs4 import BeautifulSoup as bs
 import slate
 from multivac import settings
 from multivac.src import utilities
+from multivac.src.data.store import DocumentStore
 
+# process_documents writes each record as one line of json.dumps({'key': key,
+# 'value': value}) with the default separators, so every line starts with this
+# and iter_records can decode the key that follows without the value
+RECORD_PREFIX = b'{"key": '
 
-def aggregate_pubmed(srcs, verbose=False):
-    """Aggregate a set of Pubmed article text and metadata."""
-    pubmed_data = OrderedDict()
-    pubmed_metadata = OrderedDict()
-    for src in srcs:
-        if verbose:
-            print(src)
-        try:
-            temp = OrderedDict()
-            metadata, text = parse_pubmed(str(src.absolute()))
-            temp['metadata'] = metadata
-            temp['metadata']['source'] = 'pubmed'
-            temp['text'] = text
-            try:
-                k = metadata['doi']
-            except AttributeError:
-                k = src.strip('.xml')
-            if len(text) > 0:
-                pubmed_data[k] = temp
-                pubmed_metadata[k] = metadata
-            print(src)
-        except Exception:
-            if verbose:
-                print('Error: %s' % src)
-            pass
-    dst = settings.metadata_dir / 'pubmed.pkl'
-    with open(dst, 'wb') as f:
-        pickle.dump(pubmed_metadata, f)
-    return pubmed_data
 
+def collect_process_main(verbose=False, workers=None):
+    """Parse every new or changed raw document in a process pool, appending
+    the records to processed/data/data.jsonl as they finish."""
+    store = DocumentStore()
+    dst = settings.processed_dir / 'data' / 'data.jsonl'
 
-def collect_process_main():
-    output = {}
+    # without an output file, everything has to be written again
+    rebuild = not os.path.exists(dst)
+    tasks = []
     for source in settings.sources:
-        data_raw_dir = settings.raw_dir / source
-        if source in ['arxiv', 'springer']:
-            data = parse_articles_data(source, data_raw_dir)
-        elif source == 'pubmed':
-            srcs = [data_raw_dir / x for x in os.listdir(data_raw_dir)]
-            data = aggregate_pubmed(srcs)
-        if len(output) == 0:
-            output = copy.deepcopy(data)
-        else:
-            output.update(data)
+        tasks.extend(get_tasks(source, store, rebuild))
+
     arxiv_drops = [x.split()[0] for x in settings.arxiv_drops]
-    filtered_output = filter_arxiv(output, arxiv_drops)
-    save_outputs(filtered_output)
+    counts = process_documents(tasks, dst, store, arxiv_drops, workers,
+                               verbose)
+    store.close()
+    print('Processed {} documents: {} written, {} skipped, {} failed'.format(
+        len(tasks), counts['written'], counts['skipped'], counts['failed']))
     return True
 
 
-def filter_arxiv(output, arxiv_drops):
-    filtered_output = OrderedDict()
-    for k, v in output.items():
-        if v['metadata']['source'] == 'arxiv':
-            for term in v['metadata']['tags']:
-                if term['term'] not in arxiv_drops:
-                    filtered_output[copy.deepcopy(k)] = copy.deepcopy(v)
-        else:
-            filtered_output[copy.deepcopy(k)] = copy.deepcopy(v)
-    return filtered_output
+def get_tasks(source, store, rebuild=False):
+    """Return the (source, file name, content hash, path, metadata) tasks for
+    the documents of a source that need processing."""
+    data_raw_dir = settings.raw_dir / source
+    if source in ['arxiv', 'springer']:
+        with open(settings.metadata_dir / (source + '.pkl'), 'rb') as f:
+            metadata_ = pickle.load(f)
+        docs = [(md['fn'], md) for md in metadata_]
+    elif source == 'pubmed':
+        docs = [(x, None) for x in sorted(os.listdir(data_raw_dir))
+                if not x.endswith('.part')]
+    else:
+        raise ValueError('Only "arxiv", "springer" and "pubmed" supported '
+                         'as sources.')
+
+    pending = get_pending(store, source, [data_raw_dir / fn for fn, _ in docs])
+    if rebuild:
+        pending = store.documents(source)
+    return [(source, fn, pending[fn], str(data_raw_dir / fn), md)
+            for fn, md in docs if fn in pending]
+
+
+def process_documents(tasks, dst, store=None, arxiv_drops=(), workers=None,
+                      verbose=False):
+    """Parse documents in a process pool and append each record to the JSONL
+    file dst as soon as it is ready.
+
+    A document that no longer yields a record, or is now filtered out, gets a
+    line with a value of null instead. Documents that fail are logged to
+    data_errors.jsonl beside dst and left pending in the store, so the next
+    run tries them again.
+    """
+    dst = str(dst)
+    utilities.mkdir(os.path.dirname(dst))
+    errors = os.path.join(os.path.dirname(dst), 'data_errors.jsonl')
+    workers = workers or os.cpu_count()
+    counts = {'written': 0, 'skipped': 0, 'failed': 0}
+
+    with ProcessPoolExecutor(workers) as pool, \
+            open(dst, 'a', encoding='utf-8') as out, \
+            open(errors, 'w', encoding='utf-8') as err:
+        results = utilities.bounded_imap(pool, process_document, tasks,
+                                         4 * workers)
+        for source, fn, digest, key, value, error in results:
+            if error is not None:
+                print('Error: {} {}: {}'.format(source, fn, error))
+                err.write(json.dumps({'source': source, 'fn': fn,
+                                      'error': error}) + '\n')
+                counts['failed'] += 1
+                continue
+
+            if value is not None and keep_record(value, arxiv_drops):
+                counts['written'] += 1
+            else:
+                # a tombstone, so an earlier line for the key is dropped too
+                value = None
+                counts['skipped'] += 1
+            # the key comes first, after RECORD_PREFIX, for iter_records
+            out.write(json.dumps({'key': key, 'value': value},
+                                 default=str) + '\n')
+            out.flush()
+            # the record itself lives in dst; the store only keeps the hash
+            if store is not None:
+                store.set_processed(source, fn, digest, None)
+            if verbose:
+                print(fn)
+
+    return counts
+
+
+def process_document(task):
+    """Worker for process_documents: parse one document, returning (source,
+    file name, content hash, key, record, error)."""
+    source, fn, digest, src, metadata = task
+    try:
+        key, value = parse_document(source, src, metadata)
+        return source, fn, digest, key, value, None
+    except Exception as e:
+        return source, fn, digest, None, None, '{}: {}'.format(
+            type(e).__name__, e)
 
 
-def parse_articles_data(source, data_raw_dir, verbose=False):
-    """Parse Arxiv and Springer article data."""
-    # load metadata
-    fn = source + '.pkl'
-    metadata_src = settings.metadata_dir / fn
-    with open(metadata_src, 'rb') as f:
-        metadata_ = pickle.load(f)
-
-    # we'll just add the text to a new arxiv object, an ordered dict keyed on
-    # doi or other id
-    data = OrderedDict()
-    for ix, article_metadata in enumerate(metadata_):
-
-        # initialize temp dictionary
-        temp = OrderedDict()
-        temp['metadata'] = copy.deepcopy(article_metadata)
-        temp['metadata']['source'] = source
-        article_fn = article_metadata['fn']
-        if verbose:
-            print(article_fn)
-        src = data_raw_dir / article_fn
-
-        # define key and value
+def parse_document(source, src, metadata=None):
+    """Parse a raw document and return its key and record, or a record of
+    None if it has no text."""
+    temp = OrderedDict()
+    if source == 'pubmed':
+        metadata, text = parse_pubmed(src)
+        k = metadata.get('doi') or os.path.basename(src).split('.xml')[0]
+    else:
+        metadata = copy.deepcopy(metadata)
         if source == 'arxiv':
-            k = article_metadata['fn'].strip('.pdf')
-            temp['text'] = parse_pdf(src)
+            k = metadata['fn'].strip('.pdf')
+            text = parse_pdf(src)
         elif source == 'springer':
-            k = article_metadata['doi']
-            temp['text'] = parse_html(src)
-        elif source == 'pubmed':
-            raise ValueError('pubmed not supported. Only "arxiv" and "springer" supported. '
-                             'Try "parse_pubmed() function"')
+            k = metadata['doi']
+            text = parse_html(src)
         else:
-            raise ValueError('Only "arxiv" and "springer" supported as sources.')
+            raise ValueError('Only "arxiv", "springer" and "pubmed" supported '
+                             'as sources.')
+    temp['metadata'] = metadata
+    temp['metadata']['source'] = source
+    temp['text'] = text
+    if source == 'pubmed' and len(text) == 0:
+        return k, None
+    return k, temp
 
-        # populate interim dictionary
-        data[k] = temp
 
-    # save intermediate outputs
-    data_interim_dst = settings.interim_dir / fn
-    with open(data_interim_dst, 'wb') as f:
-        pickle.dump(data, f)
-    return data
+def iter_records(src):
+    """Lazily yield (key, record) from a JSONL file written by
+    process_documents.
+
+    A document that was processed again is appended again, so only the last
+    line for each key is yielded, and not at all if its value is null. The
+    first pass reads just the keys.
+    """
+    decoder = json.JSONDecoder()
+    offsets = OrderedDict()
+    with open(src, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.startswith(RECORD_PREFIX):
+                key, _ = decoder.raw_decode(
+                    line[len(RECORD_PREFIX):].decode('utf-8'))
+            elif line.strip():
+                # not written by process_documents; parse the whole line
+                key = json.loads(line.decode('utf-8'))['key']
+            else:
+                offset += len(line)
+                continue
+            offsets.pop(key, None)
+            offsets[key] = offset
+            offset += len(line)
+
+        for key, offset in offsets.items():
+            f.seek(offset)
+            value = json.loads(f.readline().decode('utf-8'))['value']
+            if value is not None:
+                yield key, value
+
+
+class JSONLRecords(object):
+    """The records of a JSONL file written by process_documents, as a
+    read-only mapping that reads them with iter_records each time it is
+    iterated, so they are never all in memory at once. Keys in exclude are
+    left out."""
+
+    def __init__(self, src, exclude=()):
+        self.src = src
+        self.exclude = set(exclude)
+
+    def items(self):
+        for key, record in iter_records(self.src):
+            if key not in self.exclude:
+                yield key, record
+
+    def keys(self):
+        for key, _ in self.items():
+            yield key
+
+    def values(self):
+        for _, record in self.items():
+            yield record
+
+    def __iter__(self):
+        return self.keys()
+
+
+def get_pending(store, source, srcs):
+    """Return {file name: content hash} for the files of a source that need
+    processing, adding any files not yet in the store; None without a store."""
+    if store is None:
+        return None
+    known = store.documents(source)
+    for src in srcs:
+        if src.name not in known and os.path.exists(src):
+            store.put_file(source, src.name, src)
+    return store.pending(source)
+
+
+def keep_record(record, arxiv_drops):
+    """Arxiv articles are dropped when all of their tags are in arxiv_drops."""
+    if record['metadata']['source'] != 'arxiv':
+        return True
+    return any(term['term'] not in arxiv_drops
+               for term in record['metadata']['tags'])
+
+
+def filter_arxiv(output, arxiv_drops):
+    filtered_output = OrderedDict()
+    for k, v in output.items():
+        if keep_record(v, arxiv_drops):
+            filtered_output[copy.deepcopy(k)] = copy.deepcopy(v)
+    return filtered_output
 
 
 def parse_html(src):
@@ -170,8 +287,8 @@ def save_outputs(output, dst_dir=None, fn_prefix=None):
     if fn_prefix is not None:
         fn = fn_prefix + '_' + fn
     dst = dst_dir / fn
-    with open(dst, 'wb') as f:
-        json.dump(output, f)
+    with open(dst, 'w') as f:
+        json.dump(output, f, default=str)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed store for raw and processed documents.
+
+Raw documents are saved once under objects/ by the SHA-256 of their content
+and indexed in SQLite by (source, source id), alongside the processed record
+last derived from each. Each document also records the version its source
+reported for it (e.g. arXiv's updated date) and the ETag and Last-Modified
+headers it was served with, so collection can skip documents that haven't been
+revised, and processing only needs to touch documents whose content changed
+since they were last processed.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from multivac import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    source TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    version TEXT,
+    validators TEXT,
+    PRIMARY KEY (source, source_id)
+);
+CREATE TABLE IF NOT EXISTS processed (
+    source TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    record TEXT,
+    PRIMARY KEY (source, source_id)
+);
+"""
+
+
+def content_hash(content):
+    """Return the SHA-256 hex digest of bytes or text."""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+class DocumentStore(object):
+    """Documents keyed by source and source id, stored by content hash."""
+
+    def __init__(self, root=None):
+        self.root = root if root is not None else settings.raw_dir
+        self.objects = os.path.join(str(self.root), 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(str(self.root), 'index.sqlite'),
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        # indexes made before versions were recorded lack their columns
+        columns = {row[1] for row in
+                   self._db.execute('PRAGMA table_info(documents)')}
+        for column in ('version', 'validators'):
+            if column not in columns:
+                self._db.execute(
+                    'ALTER TABLE documents ADD COLUMN %s TEXT' % column)
+
+    def close(self):
+        self._db.close()
+
+    def path(self, digest):
+        """Path of the object holding content with the given hash."""
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def lookup(self, source, source_id):
+        """Return the content hash stored for a document, or None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT hash FROM documents WHERE source=? AND source_id=?',
+                (source, source_id)).fetchone()
+        return row[0] if row else None
+
+    def has(self, source, source_id):
+        return self.lookup(source, source_id) is not None
+
+    def revision(self, source, source_id):
+        """Return (version, validators) recorded for a document: the version
+        its source reported, and a dict of the ETag and Last-Modified headers
+        it was served with; (None, {}) if they weren't recorded."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT version, validators FROM documents '
+                'WHERE source=? AND source_id=?',
+                (source, source_id)).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1]) if row[1] else {}
+
+    def put(self, source, source_id, content, link=None, version=None,
+            validators=None):
+        """Store a document's content; return (hash, changed).
+
+        version and validators record the revision the content came from (see
+        revision()). If link is given, the object is also made available at
+        that path (as a hard link where possible) for tools that read the raw
+        directories.
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        digest = content_hash(content)
+        dst = self.path(digest)
+
+        if not os.path.exists(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp = '%s.%s.part' % (dst, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, dst)
+
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT hash, updated FROM documents '
+                'WHERE source=? AND source_id=?',
+                (source, source_id)).fetchone()
+            changed = row is None or row[0] != digest
+            self._db.execute(
+                'INSERT OR REPLACE INTO documents (source, source_id, hash, '
+                'size, updated, version, validators) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (source, source_id, digest, len(content),
+                 time.time() if changed else row[1], version,
+                 json.dumps(validators) if validators else None))
+
+        if link is not None:
+            self.link(digest, link)
+
+        return digest, changed
+
+    def put_file(self, source, source_id, src, **revision):
+        """Store an existing file, e.g. one downloaded before the store."""
+        with open(src, 'rb') as f:
+            return self.put(source, source_id, f.read(), **revision)
+
+    def link(self, digest, dst):
+        dst = str(dst)
+        if os.path.exists(dst):
+            if os.path.samefile(dst, self.path(digest)):
+                return
+            os.remove(dst)
+        try:
+            os.link(self.path(digest), dst)
+        except OSError:
+            shutil.copyfile(self.path(digest), dst)
+
+    def read(self, source, source_id):
+        digest = self.lookup(source, source_id)
+        if digest is None:
+            return None
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+
+    def documents(self, source):
+        """Return {source_id: hash} for all documents of a source."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT source_id, hash FROM documents WHERE source=?',
+                (source,)).fetchall()
+        return dict(rows)
+
+    def pending(self, source):
+        """Return {source_id: hash} for documents that are new or changed
+        since they were last processed."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT d.source_id, d.hash FROM documents d '
+                'LEFT JOIN processed p '
+                'ON d.source = p.source AND d.source_id = p.source_id '
+                'WHERE d.source=? AND (p.hash IS NULL OR p.hash != d.hash)',
+                (source,)).fetchall()
+        return dict(rows)
+
+    def set_processed(self, source, source_id, digest, record):
+        """Mark a document's content as processed, saving the record derived
+        from it. process_documents passes None, as it keeps the records in
+        its JSONL output, so only the content hash is saved."""
+        if record is not None:
+            record = json.dumps(record, default=str)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?)',
+                (source, source_id, digest, record))
+
+    def records(self, source=None):
+        """Yield (source, source_id, record) for processed documents."""
+        query = ('SELECT source, source_id, record FROM processed '
+                 'WHERE record IS NOT NULL')
+        args = ()
+        if source is not None:
+            query += ' AND source=?'
+            args = (source,)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY rowid', args).fetchall()
+        for src, source_id, record in rows:
+            yield src, source_id, json.loads(record)
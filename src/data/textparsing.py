@@ -1,71 +1,70 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import multiprocessing as mp
 import re as reg
+import time
 
+# Regex for cleaning
+re_citationsNumeric = reg.compile(r'(\[\d+)(,\s*\d+)*]')
+re_url = reg.compile(r'((http|ftp|https):\/\/)?[-a-zA-Z0-9@:%._\+~#=]"'
+                     r'{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)')
+re_intextcite = reg.compile(r"((?:[A-Za-z][A-Za-z'`-éü-]+)(?:,? (?:(?:and |& )"
+                            r"?(?:[A-Za-z][A-Za-z'`-éü-]+)|(?:et al.?)))*(?:,* "
+                            r"*((?:19|20)[0-9][0-9][a-z]*)(\s*&\s*[0-9]*[a-z]*)"
+                            r"*(, (\d+))*(?:, p.? [0-9]+)?| *\\((?:19|20)[0-9]"
+                            r"[0-9][a-z](\s*&)(?:, p.? [0-9]+)?\\)))")
 
-def clean_doc(doc, spacynlp):
+re_emptyCite = reg.compile(r"\(([\s]*[;]+[\s]*)+\)")
+re_emptyEg = reg.compile(r'\(e.g.[\s*;\s*]*[,]*\s*\)')
+re_clickHere = reg.compile(r'Click here[^.]*\.')
+re_cid = reg.compile(r"\(cid:\d+\)")
+re_email = reg.compile(r"[\w.-]+@[\w.-]+")
+re_emptyParens = reg.compile(r"\(\s*\)")
+re_emptySee = reg.compile(r"\(see(\s)*\)")
+re_sponsors = reg.compile(r'(This work was supported).+')
+re_arxivHeader = reg.compile(r"(a r X i v).*?(?=[a-zA-Z]{2,})")
+re_vixraHeader = reg.compile(r"^(\s?.?\s)+(v i X r a)")
+re_hyphenatedWords = reg.compile(r'\S(?=\S*[-]\s)([a-zA-Z-]+)(\s)[A-za-z]+')
+
+# Patterns whose matches are blanked out, in order. Each pass can expose text
+# for a later one (an email removed from parentheses leaves empty parentheses),
+# so the passes stay separate rather than joined into one alternation.
+re_blanks = [re_emptyCite, re_emptyEg, re_clickHere, re_email, re_emptyParens,
+             re_emptySee, re_arxivHeader, re_vixraHeader]
+
+# spaCy model used by workers of clean_docs
+_spacynlp = None
+
+
+def clean_doc(doc, spacynlp, hyphenCache=None):
     '''
     Clean individual documents and remove citations, URLs, emails, other
     trivial content. Returns cleaned doc
     '''
-    # Regex for cleaning
-    re_citationsNumeric = reg.compile(r'(\[\d+)(,\s*\d+)*]')
-    re_url = reg.compile(r'((http|ftp|https):\/\/)?[-a-zA-Z0-9@:%._\+~#=]"'
-                         r'{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)')
-    re_intextcite = reg.compile(r"((?:[A-Za-z][A-Za-z'`-éü-]+)(?:,? (?:(?:and |& )"
-                                r"?(?:[A-Za-z][A-Za-z'`-éü-]+)|(?:et al.?)))*(?:,* "
-                                r"*((?:19|20)[0-9][0-9][a-z]*)(\s*&\s*[0-9]*[a-z]*)"
-                                r"*(, (\d+))*(?:, p.? [0-9]+)?| *\\((?:19|20)[0-9]"
-                                r"[0-9][a-z](\s*&)(?:, p.? [0-9]+)?\\)))")
-
-    re_emptyCite = reg.compile(r"\(([\s]*[;]+[\s]*)+\)")
-    re_emptyEg = reg.compile(r'\(e.g.[\s*;\s*]*[,]*\s*\)')
-    re_clickHere = reg.compile(r'Click here[^.]*\.')
-    re_cid = reg.compile(r"\(cid:\d+\)")
-    re_email = reg.compile(r"[\w.-]+@[\w.-]+")
-    re_emptyParens = reg.compile(r"\(\s*\)")
-    re_emptySee = reg.compile(r"\(see(\s)*\)")
-    re_sponsors = reg.compile(r'(This work was supported).+')
-    re_arxivHeader = reg.compile(r"(a r X i v).*?(?=[a-zA-Z]{2,})")
-    re_vixraHeader = reg.compile(r"^(\s?.?\s)+(v i X r a)")
-    re_hyphenatedWords = reg.compile(r'\S(?=\S*[-]\s)([a-zA-Z-]+)(\s)[A-za-z]+')
+    if hyphenCache is None:
+        hyphenCache = {}
 
     # Actual cleaning
-    doc = reg.sub(re_cid, ' ', doc)
-    doc = reg.sub(re_citationsNumeric, ' NumericCitation ', doc)
-    doc = reg.sub(re_url, ' ', doc)
-    doc = reg.sub(re_intextcite, ' Citation ', doc)
-    doc = reg.sub(re_emptyCite, ' ', doc)
-    doc = reg.sub(re_emptyEg, ' ', doc)
-    doc = reg.sub(re_clickHere, ' ', doc)
-    doc = reg.sub(re_email, ' ', doc)
-    doc = reg.sub(re_emptyParens, ' ', doc)
-    doc = reg.sub(re_emptySee, ' ', doc)
-    doc = reg.sub(re_arxivHeader, ' ', doc)
-    doc = reg.sub(re_vixraHeader, ' ', doc)
+    doc = re_cid.sub(' ', doc)
+    doc = re_citationsNumeric.sub(' NumericCitation ', doc)
+    doc = re_url.sub(' ', doc)
+    doc = re_intextcite.sub(' Citation ', doc)
+    for regex in re_blanks:
+        doc = regex.sub(' ', doc)
 
     # This work supported by --> all the way to end of document
     # Only remove this when it appears in the second half of the article
-    for m in reg.finditer(re_sponsors, doc):
-        if m.start() > (len(doc)/2):
-            doc = reg.sub(re_sponsors, ' ', doc)
+    if any(m.start() > (len(doc)/2) for m in re_sponsors.finditer(doc)):
+        doc = re_sponsors.sub(' ', doc)
 
     # Handling hyphens - 2-28-2018
-    for m in reg.finditer(re_hyphenatedWords, doc):
+    def merge_hyphenated(m):
         match = m.group(0)
+        if match not in hyphenCache:
+            hyphenCache[match] = merged_hyphenated_word(match, spacynlp)
+        return hyphenCache[match]
 
-        mergedWord = match.replace(' ', '').replace('-', '')
-        if mergedWord in spacynlp.vocab:
-
-            doc = doc.replace(match, mergedWord)
-        else:
-            allWords = True
-            for i in match.replace(' ', '').split('-'):
-                allWords = allWords and (i in spacynlp.vocab)
-            if allWords:
-                doc = doc.replace(match, (match.replace(' ', '')))
-            else:
-                doc = doc.replace(match, mergedWord)
+    doc = re_hyphenatedWords.sub(merge_hyphenated, doc)
 
     # De-dup for PUBMED articles, where the main text is sometimes duplicated
     sliceText = doc[0:500]
@@ -76,3 +75,57 @@ def clean_doc(doc, spacynlp):
         doc = doc[0:posDup-1]
 
     return doc
+
+
+def merged_hyphenated_word(match, spacynlp):
+    '''
+    Join a word broken across a line, keeping its hyphens only when the
+    pieces are words of their own and the joined word isn't
+    '''
+    mergedWord = match.replace(' ', '').replace('-', '')
+    if mergedWord in spacynlp.vocab:
+        return mergedWord
+
+    allWords = True
+    for i in match.replace(' ', '').split('-'):
+        allWords = allWords and (i in spacynlp.vocab)
+    if allWords:
+        return match.replace(' ', '')
+    return mergedWord
+
+
+def clean_docs(docs, spacynlp, n_process=1, batch_size=16, verbose=True):
+    '''
+    Clean a list of documents with clean_doc, in n_process worker processes
+    taking batch_size documents at a time. Returns the cleaned docs in order
+    and reports the cleaning rate.
+    '''
+    start = time.time()
+    if n_process > 1 and len(docs) > batch_size:
+        with mp.Pool(n_process, initializer=_init_clean_worker,
+                     initargs=(spacynlp,)) as pool:
+            cleaned = pool.map(_clean_batch, _batches(docs, batch_size))
+        cleaned = [doc for batch in cleaned for doc in batch]
+    else:
+        hyphenCache = {}
+        cleaned = [clean_doc(doc, spacynlp, hyphenCache) for doc in docs]
+
+    if verbose:
+        elapsed = max(time.time() - start, 1e-9)
+        print('Cleaned {} documents in {:.1f}s ({:.1f} docs/s)'.format(
+            len(docs), elapsed, len(docs) / elapsed))
+    return cleaned
+
+
+def _init_clean_worker(spacynlp):
+    global _spacynlp
+    _spacynlp = spacynlp
+
+
+def _clean_batch(docs):
+    hyphenCache = {}
+    return [clean_doc(doc, _spacynlp, hyphenCache) for doc in docs]
+
+
+def _batches(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -136,10 +136,11 @@ if __name__ == '__main__':
     data_dir = os.path.join(base_dir, 'data')
     multivac_dir = os.path.join(data_dir, 'multivac')
 
-    prs = StanfordParser(annots='tokenize')
+    prs = StanfordParser(annots='tokenize', cache=True)
 
     split(os.path.join(multivac_dir, 'extracted_questions_labels.txt'), multivac_dir)
     gen_tokens(os.path.join(multivac_dir, 'text.txt'), prs)
+    print(prs.cache.summary())
 
     # get vocabulary
     build_vocab(glob.glob(os.path.join(multivac_dir, '*/*.toks')),
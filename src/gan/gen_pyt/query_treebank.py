@@ -105,7 +105,7 @@ def extract_grammar(source_file, output=None, clean=False, verbose=False,
     else:
         parse_func = get_eng_tree
 
-    parser = StanfordParser(annots="tokenize ssplit parse")
+    parser = StanfordParser(annots="tokenize ssplit parse", cache=True)
 
     with open(source_file, 'r') as f:
         queries = f.readlines()
@@ -116,13 +116,17 @@ def extract_grammar(source_file, output=None, clean=False, verbose=False,
     if verbose:
         print("Performing constituency parsing of queries")
 
-    for i, q in enumerate(queries):
-        if len(q) > 0:
-            try:
-                query = stanford_parse(parser, q)
-            except Exception:
+    # parsed in batches by the parser's CoreNLP servers; empty queries and
+    # those that can't be parsed give None
+    parses = parser.get_parses(queries)
+
+    for i, (q, parse) in enumerate(zip(queries, parses)):
+        if parse is None:
+            if len(q.strip()) > 0:
                 print('Could not parse query {}: "{}"'.format(i, q))
-                continue
+            continue
+
+        query = stanford_parse(parser, parse)
 
         if check_parse(query):
             try:
@@ -136,6 +140,7 @@ def extract_grammar(source_file, output=None, clean=False, verbose=False,
 
     if verbose:
         print(("{} queries successfully parsed.".format(len(parse_trees))))
+        print(parser.cache.summary())
         print("Extracting grammar production rules.")
 
     if asdl:
@@ -21,6 +21,7 @@ from gen_pyt.components.dataset import Dataset, Example
 from gen_pyt.datasets.english.dataset import English
 from gen_pyt.model import nn_utils
 from gen_pyt.model.parser import Parser
+from multivac.src import instrument
 from multivac.src.rdf_graph.rdf_parse import StanfordParser
 
 from nltk.translate.bleu_score import SmoothingFunction, sentence_bleu
@@ -121,6 +122,7 @@ def generate_query(ents, rels, kg):
 
     return head.split() + rel.split() + tail.split()
 
+@instrument.traced('gan.generate_samples')
 def generate_samples(net, generated_num, parser, gan_args, oracle=False, 
                      writeout=False):
     samples = []
@@ -152,6 +154,8 @@ def generate_samples(net, generated_num, parser, gan_args, oracle=False,
             if samps[0].completed:
                 break
 
+            instrument.count('gan.incomplete_samples')
+
         s = samps[0]
         samples.append(s)
 
@@ -170,6 +174,7 @@ def generate_samples(net, generated_num, parser, gan_args, oracle=False,
             max_actions_len = len(example.tgt_actions)
 
         examples.append(example)
+        instrument.count('gan.samples')
         pbar.update(1)
 
     pbar.close()
@@ -342,7 +347,8 @@ def run(cfg_dict):
     if gan_args['verbose']:
         print('\nPretraining generator...\n')
     # Pre-train epochs are set in config.cfg file
-    netG.pretrain(Dataset(samples_data))
+    with instrument.span('gan.pretrain_generator'):
+        netG.pretrain(Dataset(samples_data))
     rollout = Rollout(rollout_num=rollout_num, vocab=glove_vocab)
 
     # pretrain discriminator
@@ -368,7 +374,8 @@ def run(cfg_dict):
 
     # for i in tqdm(range(k_steps), desc='Pretraining discriminator ... '):
     for epoch in range(k_steps):
-        loss = netD.train_single_code(dis_set)
+        with instrument.span('gan.pretrain_discriminator', epoch=epoch):
+            loss = netD.train_single_code(dis_set)
         print('Epoch {} pretrain discriminator training loss: {}'.format(epoch + 1, loss))
 
     save_progress(netD, netG, [], -1, [], [])
@@ -389,7 +396,8 @@ def run(cfg_dict):
             hyps, states, examples = generate_samples(netG, generated_num, parser, gan_args, oracle=True)
             step_begin = time.time()
 
-            pgloss = netG.pgtrain(hyps, states, examples, rollout, netD)
+            with instrument.span('gan.generator_step', epoch=epoch):
+                pgloss = netG.pgtrain(hyps, states, examples, rollout, netD)
             print('[Generator {}]  step elapsed {}s'.format(step,
                                                             time.time() - step_begin))
             print('Generator adversarial loss={}, epoch={}'.format(pgloss, epoch))
@@ -403,9 +411,10 @@ def run(cfg_dict):
             fake_set = DiscriminatorDataset(netG.args['sample_dir'], fake=True, vocab=glove_vocab)
         
             for k_step in range(k_steps):
-                loss_r = netD.train_single_code(real_set)
+                with instrument.span('gan.discriminator_step'):
+                    loss_r = netD.train_single_code(real_set)
+                    loss_f = netD.train_single_code(fake_set)
                 print('D_step {}, K-step {} Discriminator loss on real set: {}'.format(d_step + 1, k_step + 1, loss_r))
-                loss_f = netD.train_single_code(fake_set)
                 print('D_step {}, K-step {} Discriminator loss on fake set: {}'.format(d_step + 1, k_step + 1, loss_f))
                 discriminator_losses.append((loss_r + loss_f)/2)
                 
@@ -559,7 +568,8 @@ def continue_training(cfg_dict, gen_chk, disc_chk, epoch=0, gen_loss=None, disc_
             hyps, states, examples = generate_samples(netG, generated_num, parser, gan_args, oracle=True)
             # hyps, examples = list(zip(*samples))
             step_begin = time.time()
-            pgloss = netG.pgtrain(hyps, states, examples, rollout, netD)
+            with instrument.span('gan.generator_step', epoch=ep):
+                pgloss = netG.pgtrain(hyps, states, examples, rollout, netD)
             print('[Generator {}]  step elapsed {}s'.format(step,
                                                             time.time() - step_begin))
             print('Generator adversarial loss={}, epoch={}'.format(pgloss, epoch))
@@ -574,9 +584,10 @@ def continue_training(cfg_dict, gen_chk, disc_chk, epoch=0, gen_loss=None, disc_
                                             vocab=glove_vocab)
         
             for k_step in range(k_steps):
-                loss_r = netD.train_single_code(real_set)
+                with instrument.span('gan.discriminator_step'):
+                    loss_r = netD.train_single_code(real_set)
+                    loss_f = netD.train_single_code(fake_set)
                 print('D_step {}, K-step {} Discriminator loss on real set: {}'.format(d_step + 1, k_step + 1, loss_r))
-                loss_f = netD.train_single_code(fake_set)
                 print('D_step {}, K-step {} Discriminator loss on fake set: {}'.format(d_step + 1, k_step + 1, loss_f))
                 discriminator_losses.append((loss_r + loss_f)/2)
                 
@@ -585,6 +596,7 @@ def continue_training(cfg_dict, gen_chk, disc_chk, epoch=0, gen_loss=None, disc_
         generator_losses = []
 
 
+@instrument.traced('gan.save_progress')
 def save_progress(netD, netG, examples, epoch, discriminator_losses, generator_losses):
     # Save Generator model state and metadata
     gen_save = os.path.join(netG.args['output_dir'], "gen_checkpoint.pth")
@@ -653,6 +665,9 @@ if __name__ == '__main__':
                         help='Path to Discriminator component checkpoint file.')
     parser.add_argument('-t', '--test', default=False, action='store_true', 
                         help='Test Generator for performance.')
+    parser.add_argument('--trace', required=False,
+                        help='Write a JSONL trace of timings and memory use '
+                             'to this file.')
 
 
     all_args = parser.parse_known_args()
@@ -712,4 +727,10 @@ if __name__ == '__main__':
                     if section[carg] in ['True', 'False']:
                         section[carg] = eval(section[carg])
 
+    if args['trace']:
+        instrument.enable(args['trace'])
+
     run(cfg_dict)
+
+    if args['trace']:
+        instrument.print_summary()
@@ -37,7 +37,7 @@ class Rollout(object):
         self.vocab = vocab
         self.tokenizer = Tokenizer(Vocab(strings=list(vocab.labelToIdx.keys())))
         self.rollout_num = rollout_num
-        self.parser = StanfordParser(annots='tokenize')
+        self.parser = StanfordParser(annots='tokenize', cache=True)
 
     def hyp_to_parse(self, hyp, vocab):
         if isinstance(hyp,str):
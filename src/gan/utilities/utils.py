@@ -5,6 +5,7 @@ import math
 
 import torch
 
+from multivac.src.data.embeddings import EmbeddingStore
 from multivac.src.gan.utilities.vocab import Vocab
 
 
@@ -50,56 +51,23 @@ def deserialize_from_file(path):
     return obj
 
 # loading GLOVE word vectors
-# if .pth file is found, will load that
-# else will load from .txt file & save
+# from an existing .pth/.vocab pair, a .pkl, or else the .txt file, through
+# their memory-mapped embedding store, which is built on first use
 def load_word_vectors(path, lowercase=True):
     if os.path.isfile(path + '.pth') and os.path.isfile(path + '.vocab'):
-        print('==> File found, loading to memory')
-        vectors = torch.load(path + '.pth')
-        vocab = Vocab(filename=path + '.vocab', lower=lowercase)
-
-        return vocab, vectors
+        source = path + '.pth'
     elif path.endswith('.pkl'):
-        print('==> File found, loading to memory')
-
-        with open(path, "rb") as f:
-            glove = pickle.load(f)
-
-        vectors = torch.from_numpy(glove['embeddings']).float()
-        vocab = Vocab(data=glove['vocab'], lower=lowercase)
-
-        return vocab, vectors
-
-    # saved file not found, read from txt file
-    # and create tensors for word vectors
-    print('==> File not found, preparing, be patient')
-
-
-    count = sum(1 for line in open(path + '.txt', 'r', encoding='utf8', errors='ignore'))
-
-    with open(path + '.txt', 'r') as f:
-        contents = f.readline().rstrip('\n').split(' ')
-        dim = len(contents[1:])
-
-    words = [None] * (count)
-    vectors = torch.zeros(count, dim, dtype=torch.float, device='cpu')
-
-    with open(path + '.txt', 'r', encoding='utf8', errors='ignore') as f:
-        idx = 0
-
-        for line in f:
-            contents = line.rstrip('\n').split(' ')
-            words[idx] = contents[0]
-            values = list(map(float, contents[1:]))
-            vectors[idx] = torch.tensor(values, dtype=torch.float, device='cpu')
-            idx += 1
+        source = path
+    else:
+        source = path + '.txt'
 
-    with open(path + '.vocab', 'w', encoding='utf8', errors='ignore') as f:
-        for word in words:
-            f.write(word + '\n')
+    store = EmbeddingStore.open(source, verbose=True)
+    vectors = torch.from_numpy(store.vectors)
 
-    vocab = Vocab(filename=path + '.vocab')
-    torch.save(vectors, path + '.pth')
+    if source.endswith('.pkl'):
+        vocab = Vocab(data=store.words(), lower=lowercase)
+    else:
+        vocab = Vocab(filename=store.vocab_file, lower=lowercase)
 
     return vocab, vectors
 
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tracing and resource accounting shared by the pipeline stages.
+
+    from multivac.src import instrument
+
+    with instrument.span('parse.document', doc=docNum):
+        ...
+    instrument.count('parse.sentences', len(sentences))
+
+Tracing is off unless instrument.enable(path) is called, or the
+MULTIVAC_TRACE environment variable names a trace file, so that spawned
+workers join the trace too. While it is off, span() returns a shared no-op
+context manager and count() returns at once, so calls can stay in production
+code.
+
+While it is on, every span is appended to the trace as a JSON line with its
+duration, its parent span, the resident and peak resident memory of the
+process when it ended, and any attributes. Counters are written when a
+top-level span ends and at exit, and a background thread samples the
+resident memory. Forked processes, such as worker pools, keep writing to the
+same trace. Print a per-span summary table with print_summary(), or from a
+trace file with
+
+    python -m multivac.src.instrument trace.jsonl
+"""
+import atexit
+import contextvars
+import functools
+import itertools
+import json
+import multiprocessing.util
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+ENV_VAR = 'MULTIVAC_TRACE'
+
+_state = None
+_current = contextvars.ContextVar('multivac_span', default=None)
+
+
+class _NullSpan(object):
+    """What span() returns while tracing is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _State(object):
+
+    def __init__(self, path, sample_interval):
+        self.path = str(path)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o644)
+        self.pid = os.getpid()
+        self.ids = itertools.count(1)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.sample_interval = sample_interval
+        self.stopped = threading.Event()
+        self.sampler = None
+        # the span a forked process was started in
+        self.fork_parent = None
+        self.start_sampler()
+
+    def write(self, event):
+        event['pid'] = os.getpid()
+        # one write per line on an O_APPEND descriptor, so lines from
+        # threads and forked processes don't interleave
+        os.write(self.fd, (json.dumps(event, default=str) + '\n')
+                 .encode('utf-8'))
+
+    def new_id(self):
+        return '{}.{}'.format(os.getpid(), next(self.ids))
+
+    def start_sampler(self):
+        if not self.sample_interval:
+            return
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self._sample, daemon=True,
+                                        name='instrument-rss')
+        self.sampler.start()
+
+    def _sample(self):
+        while not self.stopped.wait(self.sample_interval):
+            self.write({'type': 'rss', 'time': time.time(),
+                        'rss_mb': rss_mb()})
+
+    def flush_counters(self):
+        with self.lock:
+            counters, self.counters = self.counters, Counter()
+        if counters:
+            self.write({'type': 'counters', 'time': time.time(),
+                        'values': dict(counters)})
+
+
+class Span(object):
+    """A timed region of a run; use span() to make one."""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """Add attributes to the span, e.g. sizes known only at the end."""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        parent = _current.get()
+        self.id = _state.new_id()
+        self.parent = parent.id if parent is not None else _state.fork_parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self._token = _current.set(self)
+        self.start = time.time()
+        self._clock = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._clock
+        _current.reset(self._token)
+        state = _state
+        if state is None:
+            return False
+        event = {'type': 'span', 'name': self.name, 'id': self.id,
+                 'parent': self.parent, 'depth': self.depth,
+                 'start': self.start, 'seconds': seconds,
+                 'rss_mb': rss_mb(), 'peak_rss_mb': peak_rss_mb()}
+        if self.attrs:
+            event['attrs'] = self.attrs
+        if exc_type is not None:
+            event['error'] = exc_type.__name__
+        state.write(event)
+        if self.depth == 0:
+            state.flush_counters()
+        return False
+
+
+def enable(path, sample_interval=1.0):
+    """Start tracing to the JSONL file path, sampling resident memory every
+    sample_interval seconds (0 to not sample). Child processes started after
+    this trace to the same file."""
+    global _state
+    disable()
+    _state = _State(path, sample_interval)
+    os.environ[ENV_VAR] = str(path)
+    return _state.path
+
+
+def disable():
+    """Stop tracing, writing out any counters."""
+    global _state
+    state, _state = _state, None
+    if state is not None:
+        state.stopped.set()
+        state.flush_counters()
+        os.close(state.fd)
+    os.environ.pop(ENV_VAR, None)
+
+
+def enabled():
+    return _state is not None
+
+
+def trace_path():
+    return _state.path if _state is not None else None
+
+
+def span(name, **attrs):
+    """Time a block: `with span('name', key=value) as s:`."""
+    if _state is None:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def traced(name=None):
+    """Decorator that runs a function in a span named after it."""
+    def decorate(fn):
+        span_name = name or '{}.{}'.format(fn.__module__.split('.')[-1],
+                                           fn.__name__)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _state is None:
+                return fn(*args, **kwargs)
+            with Span(span_name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    """Add n to a counter."""
+    state = _state
+    if state is None:
+        return
+    with state.lock:
+        state.counters[name] += n
+
+
+def rss_mb():
+    """Resident memory of this process, in MB."""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * resource.getpagesize() / 2**20, 1)
+    except (OSError, IndexError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+
+def summarize(path=None):
+    """Read a trace and return (spans, counters, peak RSS in MB), where spans
+    is {name: {'calls', 'seconds', 'max_seconds', 'peak_rss_mb'}} in order of
+    first appearance and counters are summed over processes."""
+    path = path or trace_path()
+    spans = OrderedDict()
+    counters = Counter()
+    peak = 0.0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event['type'] == 'span':
+                row = spans.setdefault(event['name'], {
+                    'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                    'peak_rss_mb': 0.0})
+                row['calls'] += 1
+                row['seconds'] += event['seconds']
+                row['max_seconds'] = max(row['max_seconds'], event['seconds'])
+                row['peak_rss_mb'] = max(row['peak_rss_mb'],
+                                         event['peak_rss_mb'])
+                peak = max(peak, event['peak_rss_mb'])
+            elif event['type'] == 'counters':
+                counters.update(event['values'])
+            elif event['type'] == 'rss':
+                peak = max(peak, event['rss_mb'])
+    return spans, counters, peak
+
+
+def print_summary(path=None):
+    """Print the per-span and counter tables of a trace (by default, the
+    current one)."""
+    if _state is not None and path is None:
+        _state.flush_counters()
+    spans, counters, peak = summarize(path)
+    width = max([len(name) for name in list(spans) + list(counters)] + [4])
+    print('{:<{w}} {:>7} {:>10} {:>10} {:>10} {:>9}'.format(
+        'span', 'calls', 'total s', 'mean s', 'max s', 'peak MB', w=width))
+    for name, row in spans.items():
+        print('{:<{w}} {:>7} {:>10.2f} {:>10.3f} {:>10.3f} {:>9.1f}'.format(
+            name, row['calls'], row['seconds'], row['seconds'] / row['calls'],
+            row['max_seconds'], row['peak_rss_mb'], w=width))
+    if counters:
+        print()
+        print('{:<{w}} {:>12}'.format('counter', 'value', w=width))
+        for name in sorted(counters):
+            print('{:<{w}} {:>12}'.format(name, counters[name], w=width))
+    print()
+    print('peak resident memory: {:.1f} MB'.format(peak))
+
+
+def _after_fork():
+    # the child's spans start at the top, under the span it was forked in; it
+    # keeps no counts of the parent's and writes its own at exit
+    if _state is not None:
+        parent = _current.get()
+        _current.set(None)
+        _state.fork_parent = parent.id if parent is not None else None
+        _state.counters = Counter()
+        _state.lock = threading.Lock()
+        multiprocessing.util.Finalize(None, _state.flush_counters,
+                                      exitpriority=10)
+
+
+def _at_exit():
+    if _state is not None and _state.pid == os.getpid():
+        disable()
+    elif _state is not None:
+        _state.flush_counters()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+atexit.register(_at_exit)
+
+if os.environ.get(ENV_VAR) and _state is None:
+    enable(os.environ[ENV_VAR])
+
+
+if __name__ == '__main__':
+    print_summary(sys.argv[1])
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A make-like runner for the stages of the MULTIVAC pipeline.
+
+Each stage names the stages it depends on, the files it reads and writes
+(glob patterns are allowed) and the parameters its outputs depend on. A stage
+is skipped when all of its outputs exist and either they are newer than its
+inputs, or its inputs and parameters hash the same as when it last ran, so a
+touched but unchanged file doesn't trigger a rerun. A stage without outputs
+always runs when it is a target, but not when a target only depends on it,
+unless forced. Stages whose dependencies
+are done run concurrently, each in its own process, and a timing report is
+printed at the end.
+"""
+import glob
+import hashlib
+import importlib
+import json
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import time
+import traceback
+
+from multivac.src import instrument
+
+
+class Stage(object):
+    """A pipeline stage: the function `module.function`, called with args.
+
+    inputs, outputs and params are functions of the run's args dict, so
+    settings are only read when the stage is checked. A stage without outputs
+    always runs when it is a target.
+    """
+
+    def __init__(self, name, module, function, deps=(), inputs=None,
+                 outputs=None, params=None, args=None):
+        self.name = name
+        self.module = module
+        self.function = function
+        self.deps = list(deps)
+        self._inputs = inputs or (lambda args_dict: [])
+        self._outputs = outputs or (lambda args_dict: [])
+        self._params = params or (lambda args_dict: {})
+        self._args = args or (lambda args_dict: (args_dict,))
+
+    def inputs(self, args_dict):
+        return expand(self._inputs(args_dict))
+
+    def outputs(self, args_dict):
+        return [str(p) for p in self._outputs(args_dict)]
+
+    def params(self, args_dict):
+        return self._params(args_dict)
+
+    def run(self, args_dict):
+        with instrument.span('stage.' + self.name):
+            stage = getattr(importlib.import_module(self.module),
+                            self.function)
+            return stage(*self._args(args_dict))
+
+
+def expand(patterns):
+    """Return the sorted files matching a list of paths and glob patterns;
+    a plain path that doesn't exist is kept, so it counts as missing."""
+    files = set()
+    for pattern in patterns:
+        pattern = str(pattern)
+        if glob.has_magic(pattern):
+            files.update(glob.glob(pattern))
+        else:
+            files.add(pattern)
+    return sorted(files)
+
+
+class Pipeline(object):
+    """Run a list of stages in dependency order, skipping those that are up
+    to date. Stamps recording the inputs each stage last ran on are kept in
+    stamp_dir."""
+
+    def __init__(self, stages, stamp_dir):
+        self.stages = {stage.name: stage for stage in stages}
+        self.order = [stage.name for stage in stages]
+        self.stamp_dir = str(stamp_dir)
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError('Stage {} depends on unknown stage {}'
+                                     .format(stage.name, dep))
+
+    def run(self, args_dict, targets=None, force=(), jobs=2):
+        """Run the targets (default: all stages) and the stages they depend
+        on; stages in force run even if they are up to date. Dependencies
+        are rerun when out of date like targets are, except that one without
+        outputs, such as collect, only runs when asked for.
+        Returns the
+        report: a list of {'stage', 'status', 'seconds'} in pipeline order,
+        with status 'ran', 'skipped', 'failed' or 'blocked'."""
+        os.makedirs(self.stamp_dir, exist_ok=True)
+        targets = set(targets or self.order)
+        selected = self._closure(targets)
+        force = set(force)
+        results = {}
+        running = {}
+        start = time.time()
+
+        while len(results) < len(selected):
+            # stages are checked in pipeline order, which needn't be
+            # dependency order, so a pass that only skips or blocks stages
+            # may leave others ready for the next pass
+            progress = False
+            for name in self.order:
+                if name not in selected or name in results or \
+                        name in running:
+                    continue
+                deps = [results.get(dep) for dep in self.stages[name].deps
+                        if dep in selected]
+                if any(r is not None and r['status'] in ('failed', 'blocked')
+                       for r in deps):
+                    results[name] = {'stage': name, 'status': 'blocked',
+                                     'seconds': 0.0}
+                    progress = True
+                    continue
+                if any(r is None for r in deps) or len(running) >= jobs:
+                    continue
+
+                stamp = self._current(name, args_dict, name in force,
+                                      name in targets)
+                if stamp is None:
+                    print('Stage {}: up to date, skipping'.format(name))
+                    results[name] = {'stage': name, 'status': 'skipped',
+                                     'seconds': 0.0}
+                    progress = True
+                    continue
+                print('Stage {}: running'.format(name))
+                running[name] = (self._start(name, args_dict, jobs),
+                                 time.time(), stamp)
+
+            if running:
+                self._wait(running, results, args_dict)
+            elif not progress and len(results) < len(selected):
+                raise ValueError('Stages have circular dependencies: {}'
+                                 .format(sorted(selected - set(results))))
+
+        report = [results[name] for name in self.order if name in selected]
+        print_report(report, time.time() - start)
+        with open(os.path.join(self.stamp_dir, 'report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    def _closure(self, targets):
+        """The targets and everything they depend on."""
+        selected = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in selected:
+                selected.add(name)
+                todo.extend(self.stages[name].deps)
+        return selected
+
+    def _start(self, name, args_dict, jobs):
+        if jobs == 1:
+            return None
+        # a forked process of its own, which may start pools of its own; an
+        # exception is printed and gives a nonzero exit code
+        process = mp.get_context('fork').Process(
+            target=self.stages[name].run, args=(args_dict,),
+            name='stage-' + name)
+        process.start()
+        return process
+
+    def _wait(self, running, results, args_dict):
+        """Wait for a running stage to finish and record its result."""
+        name, (process, started, stamp) = next(iter(running.items()))
+        if process is not None:
+            sentinels = {p.sentinel: n for n, (p, _, _) in running.items()}
+            ready = mp.connection.wait(list(sentinels))
+            name = sentinels[ready[0]]
+            process, started, stamp = running[name]
+            process.join()
+            ok = process.exitcode == 0
+        else:
+            ok = _run_stage(self.stages[name], args_dict)
+
+        del running[name]
+        seconds = time.time() - started
+        if ok:
+            self._save_stamp(name, stamp, args_dict)
+        print('Stage {}: {} in {:.1f}s'.format(
+            name, 'done' if ok else 'FAILED', seconds))
+        results[name] = {'stage': name, 'status': 'ran' if ok else 'failed',
+                         'seconds': round(seconds, 3)}
+
+    def _current(self, name, args_dict, force=False, target=True):
+        """Return None if a stage is up to date, otherwise the stamp to save
+        once it has run. A stage without outputs is only run as a target;
+        as a dependency there is nothing of it to be out of date."""
+        stage = self.stages[name]
+        outputs = stage.outputs(args_dict)
+        if not force and not target and not outputs:
+            return None
+
+        old = self._load_stamp(name)
+        stamp = {'params': stage.params(args_dict),
+                 'inputs': hash_files(stage.inputs(args_dict),
+                                      old.get('inputs', {}))}
+        if force or not outputs or not _exist(outputs):
+            return stamp
+
+        if old:
+            # inputs and parameters unchanged since the last run
+            same = (old.get('params') == json_safe(stamp['params']) and
+                    {p: d[2] for p, d in old['inputs'].items()} ==
+                    {p: d[2] for p, d in stamp['inputs'].items()})
+            return None if same else stamp
+
+        # never stamped: fall back to comparing modification times
+        inputs = [p for p in stage.inputs(args_dict) if os.path.exists(p)]
+        newest_input = max((os.path.getmtime(p) for p in inputs), default=0)
+        oldest_output = min(os.path.getmtime(p) for p in expand(outputs))
+        return None if newest_input <= oldest_output else stamp
+
+    def _stamp_path(self, name):
+        return os.path.join(self.stamp_dir, name + '.json')
+
+    def _load_stamp(self, name):
+        try:
+            with open(self._stamp_path(name), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_stamp(self, name, stamp, args_dict):
+        # inputs are hashed before the stage runs, so a stage that rewrites
+        # its inputs runs again next time
+        path = self._stamp_path(name)
+        with open(path + '.part', 'w') as f:
+            json.dump({'params': json_safe(stamp['params']),
+                       'inputs': stamp['inputs']}, f, indent=2)
+        os.replace(path + '.part', path)
+
+
+def _exist(outputs):
+    """Whether every output path exists and every pattern matches a file;
+    true for no outputs."""
+    return all(os.path.exists(p) for p in expand(outputs)) and \
+        not any(glob.has_magic(p) and not glob.glob(p) for p in outputs)
+
+
+def _run_stage(stage, args_dict):
+    try:
+        stage.run(args_dict)
+        return True
+    except Exception:
+        traceback.print_exc()
+        return False
+
+
+def hash_files(paths, known=None):
+    """Return {path: [size, mtime_ns, sha256]} for the existing paths,
+    reusing the digests in known for files whose size and mtime match."""
+    known = known or {}
+    hashes = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        old = known.get(path)
+        if old and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+            hashes[path] = old
+            continue
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        hashes[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return hashes
+
+
+def json_safe(value):
+    return json.loads(json.dumps(value, default=str))
+
+
+def print_report(report, total):
+    print('{:<10} {:<8} {:>10}'.format('stage', 'status', 'seconds'))
+    for row in report:
+        print('{:<10} {:<8} {:>10.1f}'.format(row['stage'], row['status'],
+                                             row['seconds']))
+    print('{:<10} {:<8} {:>10.1f}'.format('total', '', total))
@@ -12,7 +12,7 @@ def run(args_dict):
     timestamp = datetime.now().strftime('%d%b%Y-%H:%M:%S')
 
     # instantiate class
-    knowledge_graph = RDFGraph()
+    knowledge_graph = RDFGraph(endpoints=args_dict.get('endpoints'))
 
     # Associate a JSON file of source documents from which to induce
     # the knowledge graph.
@@ -23,7 +23,8 @@ def run(args_dict):
 
     # pre-process extracted tuples
     print('\nPreprocessing raw relation triples')
-    knowledge_graph.preprocess_raw_tuples()
+    knowledge_graph.preprocess_raw_tuples(
+        n_process=args_dict.get('n_process') or 1)
 
     # cluster all entities using fast
     # agglomerative clustering and cosine distance of averaged word embeddings
@@ -45,6 +46,11 @@ if __name__ == '__main__':
                         help='Select a source for article retrieval.')
     parser.add_argument('-g', '--glove', required=True,
                         help='Path to pickle file containing glove embeddings')
+    parser.add_argument('-e', '--endpoints', nargs='+',
+                        help='URLs of running CoreNLP servers to parse with; '
+                        'defaults to those in multivac.cfg, or a local server.')
+    parser.add_argument('-np', '--n_process', type=int, default=1,
+                        help='Number of processes to preprocess triples with.')
     args_dict = vars(parser.parse_args())
 
     run(args_dict)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Threshold clustering of embeddings by cosine distance without a full distance
+matrix.
+
+Agglomerative clustering cut at distance t only ever joins vectors that are
+linked through pairs closer than t: with average (or complete) linkage, two
+clusters are merged at distance <= t only if some pair between them is at
+least that close. So the vectors are first split into the connected
+components of the graph of their close pairs, found with blocked matrix
+products over the normalized vectors, and each component is then clustered
+on its own with fastcluster. When every close pair is kept, this gives the
+same clusters as clustering the full pdist matrix, in memory linear in the
+number of vectors plus the size of the largest component.
+
+To bound memory, only each vector's `neighbors` nearest neighbors are kept.
+Components larger than max_component are clustered over the graph itself
+with the nearest-neighbor chain algorithm, considering only clusters joined
+by an edge: a cluster with no neighbor within t can take no further part in
+merges below t. For unit vectors the average cosine distance between two
+clusters is 1 - (sum of A).(sum of B) / (|A| |B|), so average linkage needs
+only each cluster's summed vector; complete linkage compares the members of
+neighboring clusters directly.
+"""
+import fastcluster
+import numpy as np
+from scipy.cluster.hierarchy import fcluster
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import pdist
+
+# linkages graph_linkage can compute for components too large for pdist
+GRAPH_LINKAGES = ('average', 'complete')
+
+
+def normalize(embeddings):
+    """Return the embeddings scaled to unit length as float32, and a mask of
+    those that weren't zero."""
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1)
+    valid = norms > 0
+    return vectors / np.where(valid, norms, 1)[:, None], valid
+
+
+def neighbor_graph(embeddings, threshold, neighbors=50, block_mb=256):
+    """Return the sparse n x n graph linking each vector to those of its
+    `neighbors` nearest by cosine distance that are within threshold; zero
+    vectors have no neighbors. neighbors=None keeps every close pair.
+    Distances are computed for blocks of rows at a time, sized so that a
+    block's distances and the neighbor indices picked from them (4 and 8
+    bytes per pair) take about block_mb megabytes."""
+    vectors, valid = normalize(embeddings)
+    n = len(vectors)
+
+    block = max(1, int(block_mb * 2 ** 20) // (12 * max(n, 1)))
+    k = n if neighbors is None else min(neighbors + 1, n)
+    rows, cols = [], []
+
+    for start in range(0, n, block):
+        dist = vectors[start:start + block] @ vectors.T
+        np.subtract(1, dist, out=dist)
+        if k < n:
+            idx = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.broadcast_to(np.arange(n), dist.shape)
+        near = np.take_along_axis(dist, idx, axis=1)
+        own = np.arange(start, start + len(dist))[:, None]
+        keep = ((near <= threshold) & (idx != own) &
+                valid[own] & valid[idx])
+        rows.append(np.broadcast_to(own, idx.shape)[keep])
+        cols.append(idx[keep])
+
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=int)
+    return coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                      shape=(n, n))
+
+
+def graph_linkage(vectors, graph, threshold, link_method='average'):
+    """Cluster unit vectors, cutting at threshold, merging only clusters
+    joined by an edge of graph (a sparse matrix over the vectors), and
+    return a label from 1 up for each. With every pair within threshold in
+    the graph, this gives the clusters fcluster would for the full linkage.
+    """
+    if link_method not in GRAPH_LINKAGES:
+        raise ValueError('Components too large for pdist can only be '
+                         'clustered with {} linkage, not {}'.format(
+                             ' or '.join(GRAPH_LINKAGES), link_method))
+    vectors = np.asarray(vectors, dtype=np.float64)
+    n = len(vectors)
+    graph = graph.tocsr()
+    graph = graph + graph.T
+    members = {i: [i] for i in range(n)}
+    sums = {i: vectors[i] for i in range(n)}
+    adjacent = {i: set(graph.indices[graph.indptr[i]:graph.indptr[i + 1]])
+                for i in range(n)}
+    active = set(range(n))
+    done = []
+    next_id = n
+
+    def distances(a, others):
+        if link_method == 'average':
+            stacked = np.array([sums[b] for b in others])
+            sizes = np.array([len(members[b]) for b in others])
+            return 1 - stacked @ sums[a] / (sizes * len(members[a]))
+        mine = vectors[members[a]]
+        return np.array([1 - (mine @ vectors[members[b]].T).min()
+                         for b in others])
+
+    # nearest-neighbor chain: follow nearest neighbors until two clusters
+    # are each other's nearest, and merge them
+    chain = []
+    while active:
+        if not chain:
+            chain.append(next(iter(active)))
+        a = chain[-1]
+        adjacent[a] &= active
+        others = sorted(adjacent[a])
+        if others:
+            dist = distances(a, others)
+            nearest = int(np.argmin(dist))
+            # on ties, prefer the cluster before a in the chain
+            if len(chain) > 1 and chain[-2] in adjacent[a] and \
+                    dist[others.index(chain[-2])] <= dist[nearest]:
+                nearest = others.index(chain[-2])
+        if not others or dist[nearest] > threshold:
+            # nothing within threshold, now or after any merge
+            active.discard(a)
+            done.append(members.pop(a))
+            chain.pop()
+            continue
+        b = others[nearest]
+        if len(chain) > 1 and chain[-2] == b:
+            chain.pop()
+            chain.pop()
+            active -= {a, b}
+            members[next_id] = members.pop(a) + members.pop(b)
+            sums[next_id] = sums.pop(a) + sums.pop(b)
+            adjacent[next_id] = (adjacent.pop(a) | adjacent.pop(b)) & active
+            for c in adjacent[next_id]:
+                adjacent[c].add(next_id)
+            active.add(next_id)
+            next_id += 1
+        else:
+            chain.append(b)
+
+    labels = np.zeros(n, dtype=int)
+    for label, cluster in enumerate(done, start=1):
+        labels[cluster] = label
+    return labels
+
+
+def cluster_labels(embeddings, threshold, link_method='average',
+                   neighbors=50, max_component=5000, block_mb=256):
+    """Cluster embeddings by cosine distance, cutting at threshold, and
+    return a label from 1 up for each, as fcluster does.
+
+    neighbors=None clusters the full pdist matrix in one go, as before, which
+    is exact but needs memory quadratic in the number of embeddings.
+    link_method='single' keeps the components of the neighbor graph as
+    clusters. Components of more than max_component embeddings are clustered
+    with graph_linkage, which supports average and complete linkage.
+    """
+    embeddings = np.asarray(embeddings)
+    n = len(embeddings)
+    if n < 2:
+        return np.ones(n, dtype=int)
+
+    if neighbors is None:
+        Z = fastcluster.linkage(pdist(embeddings, 'cosine'),
+                                method=link_method)
+        return fcluster(Z, t=threshold, criterion='distance')
+
+    graph = neighbor_graph(embeddings, threshold, neighbors, block_mb).tocsr()
+    _, components = connected_components(graph, directed=False)
+
+    labels = np.zeros(n, dtype=int)
+    order = np.argsort(components, kind='stable')
+    bounds = np.flatnonzero(np.diff(components[order])) + 1
+    next_label = 1
+
+    for members in np.split(order, bounds):
+        if len(members) == 1 or link_method == 'single':
+            labels[members] = next_label
+            next_label += 1
+            continue
+        if len(members) > max_component:
+            vectors, _ = normalize(embeddings[members])
+            sub = graph_linkage(vectors, graph[members][:, members],
+                                threshold, link_method)
+        else:
+            Z = fastcluster.linkage(pdist(embeddings[members], 'cosine'),
+                                    method=link_method)
+            sub = fcluster(Z, t=threshold, criterion='distance')
+        labels[members] = next_label + sub - 1
+        next_label += sub.max()
+
+    return labels
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A pool of CoreNLP servers that annotates texts and sentences concurrently.
+
+    pool = CoreNLPPool(['http://host1:9000', 'http://host2:9000'],
+                       annotators='tokenize ssplit pos depparse')
+    sentences = pool.annotate_sentences(list_of_sentences)
+
+Sentences are sent in batches of at most batch_size sentences and
+batch_chars characters, one per line with ssplit.eolonly, so each comes back
+as one sentence of the response. Batches go to whichever server is free, with
+at most `concurrency` requests in flight per server. A batch that times out or
+fails is split in two and the halves are sent again, down to single
+sentences, which give None if they still fail; a batch whose server can't be
+reached is sent again to another. Whole texts can be annotated concurrently
+with annotate_texts().
+
+Without endpoints, the endpoints listed in the [CORENLP] section of
+multivac.cfg are used, or else n_servers local servers are started on ports
+9000 and up, as a single CoreNLPClient would.
+"""
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from corenlp import CoreNLPClient
+from corenlp.client import AnnotationException, PermanentlyFailedException
+
+from multivac import settings
+from multivac.src import instrument
+
+LOCAL_ENDPOINT = 'http://localhost:{}'
+LOCAL_PORT = 9000
+
+# failures worth sending the same batch to another server
+UNREACHABLE = (requests.exceptions.ConnectionError, PermanentlyFailedException)
+# failures worth splitting the batch for
+FAILED = (AnnotationException, requests.exceptions.Timeout,
+          requests.exceptions.HTTPError)
+
+
+class CoreNLPPool(object):
+    """Clients of one or more CoreNLP servers, shared by a thread pool.
+
+    clients may be given directly, as any objects with CoreNLPClient's
+    annotate(), e.g. for testing; otherwise one CoreNLPClient is made per
+    endpoint, starting the server if start_server is True (by default, only
+    when no endpoints are given or configured). Other keyword arguments,
+    such as memory or threads, go to CoreNLPClient.
+    """
+
+    def __init__(self, endpoints=None, annotators=None, properties=None,
+                 n_servers=1, start_server=None, timeout=45000, concurrency=1,
+                 batch_size=64, batch_chars=20000, retries=2, clients=None,
+                 **client_args):
+        if isinstance(annotators, (list, tuple)):
+            annotators = ' '.join(annotators)
+        self.annotators = annotators
+        self.default_properties = dict(properties or {})
+        self.batch_size = batch_size
+        self.batch_chars = batch_chars
+        self.retries = retries
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+        if clients is None:
+            endpoints = endpoints or settings.corenlp_endpoints
+            if start_server is None:
+                start_server = not endpoints
+            if not endpoints:
+                endpoints = [LOCAL_ENDPOINT.format(LOCAL_PORT + i)
+                             for i in range(n_servers)]
+            clients = [CoreNLPClient(start_server=start_server,
+                                     endpoint=endpoint, timeout=timeout,
+                                     annotators=annotators,
+                                     output_format='json', properties={},
+                                     **client_args)
+                       for endpoint in endpoints]
+        self.clients = list(clients)
+        self.workers = len(self.clients) * concurrency
+
+        # each client is in the queue once per request it may have in flight
+        self._free = queue.Queue()
+        for _ in range(concurrency):
+            for client in self.clients:
+                self._free.put(client)
+        self._executor = None
+        # consecutive failures to reach each client; one that stays
+        # unreachable is taken out of the queue, unless it is the last
+        self._unreachable = Counter()
+        self._dropped = set()
+
+    def annotate(self, text, properties=None):
+        """Annotate one text with the next free server; returns CoreNLP's
+        JSON output as a dict."""
+        props = dict(self.default_properties, **(properties or {}))
+        client = self._free.get()
+        reached = True
+        try:
+            return self._annotate(client, text, props)
+        except UNREACHABLE:
+            reached = False
+            raise
+        finally:
+            self._release(client, reached)
+
+    def annotate_texts(self, texts, properties=None):
+        """Annotate each of texts whole, concurrently, returning their
+        annotations in order, with None for those that failed."""
+        def annotate_text(text):
+            if not text or not text.strip():
+                return None
+            try:
+                return self.annotate(text, properties)
+            except UNREACHABLE + FAILED as e:
+                self._count('failed')
+                print('Could not annotate text: {}'.format(e))
+                return None
+
+        return list(self.executor.map(annotate_text, texts))
+
+    def annotate_sentences(self, sentences, properties=None):
+        """Annotate sentences in batches, returning the annotation of each
+        sentence (a member of the 'sentences' of CoreNLP's output) in order,
+        with None for empty sentences and those that failed."""
+        props = dict(self.default_properties, **(properties or {}))
+        props['ssplit.eolonly'] = 'true'
+        # newlines end sentences, so each must be on one line
+        lines = [' '.join(s.split()) if s else '' for s in sentences]
+        results = [None] * len(lines)
+
+        pending = set()
+        for batch in self.batches(lines):
+            pending.add(self.executor.submit(self._annotate_batch, batch,
+                                             lines, props))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch, parsed, attempt = future.result()
+                if parsed is not None:
+                    for i, sentence in zip(batch, parsed):
+                        results[i] = sentence
+                    continue
+                for retry in self._retries(batch, lines, attempt):
+                    pending.add(self.executor.submit(
+                        self._annotate_batch, retry, lines, props,
+                        attempt if retry is batch else 0))
+        return results
+
+    def batches(self, lines):
+        """Group the indices of the non-empty lines into batches of at most
+        batch_size lines and batch_chars characters; longer lines go
+        alone."""
+        batch, chars = [], 0
+        for i, line in enumerate(lines):
+            if not line:
+                continue
+            if batch and (len(batch) >= self.batch_size or
+                          chars + len(line) > self.batch_chars):
+                yield batch
+                batch, chars = [], 0
+            batch.append(i)
+            chars += len(line) + 1
+        if batch:
+            yield batch
+
+    def _annotate_batch(self, batch, lines, props, attempt=0):
+        """Returns (batch, sentence annotations or None on failure, attempt);
+        attempt counts the times the batch couldn't reach a server."""
+        text = '\n'.join(lines[i] for i in batch)
+        client = self._free.get()
+        try:
+            parsed = self._annotate(client, text, props)['sentences']
+        except UNREACHABLE as e:
+            print('CoreNLP server unreachable: {}'.format(e))
+            self._release(client, False)
+            return batch, None, attempt + 1
+        except FAILED:
+            self._release(client, True)
+            return batch, None, 0
+        self._release(client, True)
+        if len(parsed) != len(batch):
+            # a line wasn't one sentence; splitting finds it
+            return batch, None, 0
+        self._count('sentences', len(batch))
+        return batch, parsed, attempt
+
+    def _retries(self, batch, lines, attempt):
+        """The batches to send again for a failed batch: the batch itself if
+        its server was unreachable, its halves if it failed, or none if it
+        is a single line or its servers stayed unreachable."""
+        if 0 < attempt <= self.retries:
+            return [batch]
+        if len(batch) > 1 and not attempt:
+            self._count('splits')
+            half = len(batch) // 2
+            return [batch[:half], batch[half:]]
+        self._count('failed', len(batch))
+        for i in batch:
+            print('Could not annotate sentence: {}'.format(lines[i]))
+        return []
+
+    def _release(self, client, reached):
+        """Put a client back in the queue after a request, unless it has
+        been unreachable more than retries times in a row and others are
+        left."""
+        with self._lock:
+            if reached:
+                self._unreachable[id(client)] = 0
+            else:
+                self._unreachable[id(client)] += 1
+                live = len(self.clients) - len(self._dropped)
+                if self._unreachable[id(client)] > self.retries and live > 1:
+                    if id(client) not in self._dropped:
+                        print('Dropping unreachable CoreNLP server {}'.format(
+                            getattr(client, 'endpoint', client)))
+                        self._dropped.add(id(client))
+                    return
+                if id(client) in self._dropped:
+                    return
+        self._free.put(client)
+
+    def _annotate(self, client, text, props):
+        self._count('requests')
+        # CoreNLPClient.annotate joins a list of annotators with commas
+        annotators = self.annotators.split() if self.annotators else None
+        return client.annotate(text, annotators=annotators,
+                               output_format='json', properties=dict(props))
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+        instrument.count('corenlp.' + name, n)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers)
+        return self._executor
+
+    def close(self):
+        """Shut down the threads and any servers the pool started."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for client in self.clients:
+            if hasattr(client, 'stop'):
+                client.stop()
@@ -21,6 +21,7 @@ from multivac.settings import models_dir
 from numpy import array
 from OpenKE import config, models
 
+from multivac.src.data.embeddings import EmbeddingStore
 from multivac.src.gan.utilities.vocab import Vocab
 from multivac.src.gan.utilities.utils import load_word_vectors
 from multivac.src.rdf_graph.rdf_parse import StanfordParser, stanford_parse
@@ -47,30 +48,8 @@ def loadGloveModel(gloveFile=None, verbose=False):
     if gloveFile is None:
         gloveFile = os.path.join(models_dir, "glove.42B.300d.txt")
 
-    model = {}
-
-    with open(gloveFile,'r') as f:
-        if verbose:
-            print("Reading GloVe embeddings...")
-        lines = f.readlines()
-        if verbose:
-            print("Done.")
-            print("Indexing embeddings...")
-
-    indices = [x[:x.index(' ')] for x in lines]
-    deciles = set([x/10 for x in range(1, 10)])
-
-    for i, word in enumerate(indices):
-        if verbose and round(i/len(indices), 2) in deciles:
-            deciles.remove(round(i/len(indices), 2))
-            print("\r{}% done".format(round(i/len(indices)*100)), end=' ')
-
-        model[word] = np.fromstring(lines[i][lines[i].index(' '):], sep=' ')
-
-    if verbose:
-        print("\rDone.             ")
-
-    return model
+    # a read-only {word: vector} mapping over the memory-mapped store
+    return EmbeddingStore.open(gloveFile, verbose)
 
 def avg_embed(x, glove_vocab, glove_emb):
     if isinstance(x, str):
@@ -446,7 +425,7 @@ def run(args_dict):
             props  = {"openie.triple.strict": "true",
                       "openie.openie.resolve_coref": "true"}
 
-            parser = StanfordParser(annots=annots, props=props)
+            parser = StanfordParser(annots=annots, props=props, cache=True)
 
             # glove = loadGloveModel(args_dict['glove'], verbose)
             glove_vocab, glove_emb = load_word_vectors(args_dict['glove'])
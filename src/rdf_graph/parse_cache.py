@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of CoreNLP annotations, so text that has been annotated
+before doesn't go back to a server.
+
+Annotations are kept in SQLite, zlib-compressed JSON keyed by a hash of the
+annotators, the request properties and the text, so the same text annotated
+differently is cached separately. Each entry records when it was last used;
+once the cache grows past max_mb, the least recently used entries are dropped
+until it is back under 90% of the limit. Several processes may share a cache
+file.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+
+from multivac import settings
+from multivac.src import instrument
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    key TEXT PRIMARY KEY,
+    annotation BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS annotations_used ON annotations (used);
+"""
+
+
+def cache_key(text, annotators=None, properties=None):
+    """Return the key of a text's annotation with the given annotators and
+    properties."""
+    if isinstance(annotators, (list, tuple)):
+        annotators = ' '.join(annotators)
+    request = json.dumps([annotators, properties or {}], sort_keys=True)
+    h = hashlib.sha256(request.encode('utf-8'))
+    h.update(b'\0')
+    h.update(text.encode('utf-8'))
+    return h.hexdigest()
+
+
+class ParseCache(object):
+    """CoreNLP annotations by cache_key(), in an SQLite file at path
+    (default: corenlp_cache.sqlite in the interim directory) holding at most
+    about max_mb megabytes of annotations."""
+
+    def __init__(self, path=None, max_mb=1024):
+        if path is None:
+            path = settings.interim_dir / 'corenlp_cache.sqlite'
+        self.path = str(path)
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=60,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._bytes = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM annotations').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, key):
+        """Return the cached annotation for a key, or None."""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Return {key: annotation} for the keys that are cached, marking
+        them as used."""
+        keys = list(set(keys))
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                found.update(self._db.execute(
+                    'SELECT key, annotation FROM annotations '
+                    'WHERE key IN ({})'.format(', '.join('?' * len(chunk))),
+                    chunk).fetchall())
+            if found:
+                now = time.time()
+                with self._db:
+                    self._db.executemany(
+                        'UPDATE annotations SET used=? WHERE key=?',
+                        [(now, key) for key in found])
+        self._count('hits', len(found))
+        self._count('misses', len(keys) - len(found))
+        return {key: json.loads(zlib.decompress(blob).decode('utf-8'))
+                for key, blob in found.items()}
+
+    def put(self, key, annotation):
+        self.put_many([(key, annotation)])
+
+    def put_many(self, items):
+        """Cache (key, annotation) pairs, dropping the least recently used
+        entries if the cache is over its limit; None annotations are
+        skipped."""
+        rows = []
+        now = time.time()
+        for key, annotation in items:
+            if annotation is None:
+                continue
+            blob = zlib.compress(json.dumps(annotation).encode('utf-8'))
+            rows.append((key, blob, len(blob), now))
+        if not rows:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)',
+                    rows)
+            self._bytes += sum(row[2] for row in rows)
+            evicted = self._evict() if self._bytes > self.max_bytes else 0
+        self._count('puts', len(rows))
+        self._count('evictions', evicted)
+
+    def _evict(self):
+        # other processes may have written to the file too, so the size is
+        # counted again before deciding what to drop
+        self._bytes = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM annotations').fetchone()[0]
+        excess = self._bytes - int(0.9 * self.max_bytes)
+        if excess <= 0:
+            return 0
+        drop = []
+        for key, size in self._db.execute(
+                'SELECT key, size FROM annotations ORDER BY used').fetchall():
+            if excess <= 0:
+                break
+            drop.append((key,))
+            excess -= size
+            self._bytes -= size
+        with self._db:
+            self._db.executemany('DELETE FROM annotations WHERE key=?', drop)
+        return len(drop)
+
+    def _count(self, name, n=1):
+        if n:
+            with self._lock:
+                self.stats[name] += n
+            instrument.count('parse_cache.' + name, n)
+
+    def hit_rate(self):
+        """The share of lookups found in the cache so far."""
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    def summary(self):
+        return ('Parse cache: {} hits, {} misses ({:.1%} hit rate), '
+                '{} added, {} evicted'.format(
+                    self.stats['hits'], self.stats['misses'], self.hit_rate(),
+                    self.stats['puts'], self.stats['evictions']))
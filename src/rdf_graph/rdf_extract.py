@@ -3,23 +3,25 @@ Extract RDF triples from documents.
 """
 import argparse
 import json
+import multiprocessing as mp
 import os
-import pickle
 import re
 from collections import defaultdict
 from string import ascii_lowercase
 
-import fastcluster
 import numpy as np
 import spacy
 from bs4 import UnicodeDammit
-from corenlp import CoreNLPClient
 from nltk.tokenize.treebank import TreebankWordDetokenizer
-from scipy.cluster.hierarchy import fcluster
-from scipy.spatial.distance import pdist
 from textacy.extract import subject_verb_object_triples
 from tqdm import tqdm
 
+from multivac.src.data.embeddings import EmbeddingStore
+from multivac.src import utilities
+from multivac.src.rdf_graph import clustering
+from multivac.src.rdf_graph.corenlp_pool import CoreNLPPool
+from multivac.src.rdf_graph.parse_cache import ParseCache, cache_key
+
 OBJECTS_TO_REPLACE = ['that', 'which']
 
 NORM_REGEX_CHARS1 = re.compile(r'[\(\)\"\‘\,\.\%\{\}\`\\\:\[\]\“\•]+')
@@ -38,6 +40,15 @@ DOC_REGEX_PARENTS = re.compile(r'\(\)[\s,]*')
 DOC_REGEX_BRACKET = re.compile(r'\[\][\s,]*')
 DOC_REGEX_ELIPSES = re.compile(r'\.\s\.\s\.')
 
+REGEX_SENT_END = re.compile(r'(?<=[.!?])\s+')
+
+# the pipeline components triple extraction needs: tags, lemmas and the
+# dependency parse, which also gives sentences and noun chunks
+EXTRACTION_PIPES = ('tagger', 'parser')
+
+# extractor used by workers of RDFExtractor.extract_all
+_extractor = None
+
 
 def preprocess_abstract(abstract, nlp):
     """
@@ -82,6 +93,53 @@ def preprocess_full_document(doc, nlp=None):
     return doc
 
 
+def chunk_document(doc, max_chars=100000):
+    """
+    Split a document into chunks of at most `max_chars` characters,
+    at paragraph breaks where possible, then at sentence ends, and only
+    then between words.
+
+    Parameters
+    ----------
+    doc : str
+        The text of the document
+    max_chars : int, optional
+        The maximum number of characters in a chunk.
+        Defaults to 100000.
+
+    Returns
+    -------
+    chunks : list of str
+        The chunks, in order.
+    """
+    if len(doc) <= max_chars:
+        return [doc]
+
+    pieces = []
+    for paragraph in re.split(REGEX_BREAK, doc):
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sent in re.split(REGEX_SENT_END, paragraph):
+            while len(sent) > max_chars:
+                cut = sent.rfind(' ', 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                pieces.append(sent[:cut])
+                sent = sent[cut:].lstrip()
+            pieces.append(sent)
+
+    chunks, current = [], ''
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = current + '\n' + piece if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 def postprocess_triples(extractor,
                         embeddings_path=None,
                         cluster_entities=False,
@@ -151,8 +209,8 @@ class Clusterer:
     def load_embeddings(self, embedding_path, entities):
         """
         Load the embeddings (`DA_glove_embeddings_300.pkl`)
-        from a pickle file and compute the average embedding
-        for each entity.
+        through their memory-mapped embedding store and
+        compute the average embedding for each entity.
 
         Parameters
         ----------
@@ -161,27 +219,8 @@ class Clusterer:
         entities : list
             The list of unique entities
         """
-        with open(embedding_path, 'rb') as fb:
-            embed = pickle.load(fb)
-
-        # create the embeddings dictionary
-        embed_dict = {token: vector for token, vector in zip(embed['vocab'],
-                                                             embed['embeddings'])}
-
-        # compute the average embedding for each entity
-        entity_embed = {}
-        for entity in tqdm(entities):
-
-            entity_split = entity.split()
-            entity_split_embed = [embed_dict[token] for token in entity_split
-                                  if token in embed_dict]
-
-            if len(entity_split_embed) == 1:
-                entity_embed.update({entity: np.squeeze(np.array(entity_split_embed))})
-            elif len(entity_split_embed) > 1:
-                entity_embed.update({entity: np.mean(np.array(entity_split_embed), axis=0)})
-
-        return entity_embed
+        store = EmbeddingStore.open(embedding_path, self.verbose)
+        return store.mean_vectors(tqdm(entities))
 
     @staticmethod
     def get_representatives(cluster_members, char_limit=100):
@@ -211,7 +250,8 @@ class Clusterer:
     def cluster(self,
                 embedding_path,
                 entities,
-                link_method='average'):
+                link_method='average',
+                neighbors=50):
         """
         Cluster the entities using agglomerative clustering.
 
@@ -224,17 +264,22 @@ class Clusterer:
         link_method : str, optional
             The link method used by `fastcluster`
             Defaults to 'average'
+        neighbors : int or None, optional
+            The number of nearest neighbors of each entity
+            compared with it, so memory grows linearly
+            with the number of entities. None compares all
+            pairs with a full distance matrix.
+            Defaults to 50.
         """
         embedding_dict = self.load_embeddings(embedding_path, entities)
         embeddings = np.array([embedding for embedding in embedding_dict.values()])
         entities_list = np.array([entity for entity in embedding_dict.keys()])
 
-        # create distance matrix using cosine similarity between all entity strings
-        dist_vec = pdist(embeddings, 'cosine')
-
-        # cluster distance matrix to find co-referring entities
-        linkage_matrix = fastcluster.linkage(dist_vec, method=link_method)
-        cluster_labels = fcluster(linkage_matrix, t=self.clust_dist_thres, criterion='distance')
+        # cluster entities by cosine distance to find co-referring entities
+        cluster_labels = clustering.cluster_labels(embeddings,
+                                                   self.clust_dist_thres,
+                                                   link_method=link_method,
+                                                   neighbors=neighbors)
         cluster_members_all = []
         for clus_label in tqdm(np.unique(cluster_labels)):
             clus_indx = cluster_labels == clus_label
@@ -250,25 +295,51 @@ class StanfordCoreferenceResolution:
     """
     Stanford CoreNLP co-reference.
 
+    Documents are resolved concurrently by a pool of CoreNLP
+    servers, with at most `concurrency` documents in flight
+    per server.
+
     Parameters
     ----------
     timeout : int
-        The timeout for the parser
+        The timeout for the parser, for each document
         Defaults to 30000
     memory : str
         The memory allocation.
         Defaults to '6G'
+    endpoints : list of str, optional
+        The CoreNLP servers to use. By default, those
+        in multivac.cfg, or else a local server.
+        Defaults to None.
+    concurrency : int, optional
+        The number of documents sent to each server at once.
+        Defaults to 1.
+    cache : bool, str or ParseCache, optional
+        Where to cache resolved documents, by a hash of their
+        text: True for the default cache file, a path, or a
+        `ParseCache` to share. None does not cache.
+        Defaults to None.
 
     """
 
-    def __init__(self, timeout=30000, memory='6G'):
+    ANNOTATORS = 'tokenize ssplit dcoref'
+
+    def __init__(self, timeout=30000, memory='6G', endpoints=None,
+                 concurrency=1, cache=None):
 
         self.detok = TreebankWordDetokenizer()
 
-        self.client = CoreNLPClient(annotators=['tokenize', 'ssplit', 'dcoref'],
-                                    output_format='json',
-                                    timeout=timeout,
-                                    memory=memory)
+        self.client = CoreNLPPool(endpoints,
+                                  annotators=self.ANNOTATORS,
+                                  properties={'timeout': timeout},
+                                  timeout=timeout,
+                                  concurrency=concurrency,
+                                  memory=memory)
+
+        if cache is None or cache is False or isinstance(cache, ParseCache):
+            self.cache = cache or None
+        else:
+            self.cache = ParseCache(None if cache is True else cache)
 
     def resolve(self, doc, raise_errors=True):
         """
@@ -291,34 +362,78 @@ class StanfordCoreferenceResolution:
         """
         try:
             parsed = self.client.annotate(doc)
+            return self.replace_coreferences(parsed)
         except Exception as error:
             if raise_errors:
                 raise error
             return
-        return self.replace_coreferences(parsed)
 
     def resolve_all(self, docs, raise_errors=True):
         """
-        Resolve co-references for all the documents.
+        Resolve co-references for all the documents, concurrently.
+
+        Each document is resolved on its own, so one that fails
+        or times out does not affect the others. Documents found
+        in the cache are not sent to the servers again.
 
         Parameters
         ----------
         docs : list of str
             A list of documents
         raise_errors : bool, optional
-            Whether to raise errors.
-            Defaults to False.
+            Whether to raise errors. If False, documents that
+            could not be resolved are None.
+            Defaults to True.
 
         Returns
         -------
         resolved_docs : list of str
             A list of documents, with co-references resolved.
         """
-        resolved_docs = []
-        for doc in tqdm(docs):
-            resolved_docs.append(self.resolve(doc, raise_errors))
+        keys = [self._cache_key(doc) for doc in docs]
+        resolved_docs = [None] * len(docs)
+        if self.cache is not None:
+            cached = self.cache.get_many(keys)
+            resolved_docs = [cached.get(key) for key in keys]
+        todo = [i for i, resolved in enumerate(resolved_docs)
+                if resolved is None]
+
+        def resolve(doc):
+            try:
+                return self.resolve(doc, raise_errors=True), None
+            except Exception as error:
+                return None, error
+
+        results = utilities.bounded_map(self.client.executor, resolve,
+                                        (docs[i] for i in todo),
+                                        2 * self.client.workers)
+        failed = 0
+        for i, (resolved, error) in zip(todo, tqdm(results, total=len(todo))):
+            if error is not None:
+                if raise_errors:
+                    raise error
+                failed += 1
+                continue
+            resolved_docs[i] = resolved
+            if self.cache is not None:
+                self.cache.put(keys[i], resolved)
+
+        if failed:
+            print('Could not resolve co-references in {} documents'
+                  .format(failed))
         return resolved_docs
 
+    def close(self):
+        """
+        Stop the CoreNLP servers this started.
+        """
+        self.client.close()
+
+    def _cache_key(self, doc):
+        return cache_key(doc or '', self.ANNOTATORS,
+                         dict(self.client.default_properties,
+                              output='resolved'))
+
     @staticmethod
     def restructure_coreference_dict(corefs_dict):
         """
@@ -500,6 +615,7 @@ class RDFExtractor:
         self._is_extracted = False
         self._entity_to_id = None
         self._relation_to_id = None
+        self._sentencizer = None
 
     @property
     def triples(self):
@@ -832,10 +948,21 @@ class RDFExtractor:
 
         return results
 
-    def extract_all(self, docs, raw=False, verbose=True):
+    def extract_all(self,
+                    docs,
+                    raw=False,
+                    verbose=True,
+                    preprocess=None,
+                    batch_size=32,
+                    n_process=1,
+                    max_chars=100000):
         """
         Extract all triples from a list of documents.
 
+        Documents are split by paragraph into chunks of at most
+        `max_chars` characters, preprocessed and parsed as a stream
+        with `nlp.pipe()`, with only the tagger and parser enabled.
+
         Parameters
         ----------
         docs : list of str
@@ -849,29 +976,148 @@ class RDFExtractor:
         verbose : bool, optional
             Whether to print progress.
             Defaults to True.
+        preprocess : str, optional
+            How to preprocess the documents ::
+            - 'abstract' = `preprocess_abstract()`, with a rule-based
+              sentence splitter
+            - 'document' = `preprocess_full_document()`
+            - None = no preprocessing
+            Defaults to None.
+        batch_size : int, optional
+            The number of chunks parsed at a time.
+            Defaults to 32.
+        n_process : int, optional
+            The number of worker processes.
+            Defaults to 1.
+        max_chars : int, optional
+            The maximum number of characters parsed at once.
+            Defaults to 100000.
+
+        Whatever `n_process` is, the 'NOUNS' and 'VERBS' (and 'SENT')
+        of the results are their text rather than SpaCy objects, so
+        the parsed chunks need not be kept. The number of documents
+        with a chunk that could not be parsed or extracted from is
+        printed as the number failed.
         """
         self._results = []
         self._triples = set()
         self._entity_to_id, self._relation_to_id = None, None
 
-        # make sure the `max_length` is greater than the max doc
-        self.nlp.max_length = max([len(doc) for doc in docs]) + 1
+        max_chars = min(max_chars, self.nlp.max_length - 1)
+        # each chunk goes with the number of its document, so failures
+        # are counted by document
+        chunks = ((n, chunk)
+                  for n, doc in enumerate(tqdm(docs) if verbose else docs)
+                  for chunk in chunk_document(doc, max_chars))
+        batches = ((batch, raw, preprocess)
+                   for batch in _batches(chunks, batch_size))
+
+        failed = set()
+        if n_process > 1:
+            with mp.Pool(n_process, initializer=_init_extract_worker,
+                         initargs=(self,)) as pool:
+                for results, batch_failed in pool.imap(_extract_batch,
+                                                       batches):
+                    self._add_results(results)
+                    failed.update(batch_failed)
+        else:
+            for batch in batches:
+                results, batch_failed = _extract_chunks(self, batch)
+                self._add_results(results)
+                failed.update(batch_failed)
+
+        if verbose:
+            print('Number failed: ', len(failed))
 
-        failed = 0
-        for doc in tqdm(docs) if verbose else docs:
+        self._is_extracted = True
+
+    def extract_texts(self, texts, raw=False, preprocess=None,
+                      portable=False):
+        """
+        Preprocess and parse a batch of texts with `nlp.pipe()` and
+        extract their triples.
+
+        Parameters
+        ----------
+        texts : list of str
+            The texts to extract triples from.
+        raw : bool, optional
+            As in `extract()`.
+            Defaults to False.
+        preprocess : str, optional
+            As in `extract_all()`.
+            Defaults to None.
+        portable : bool, optional
+            Whether to replace the SpaCy objects in the
+            results by their text, so they can be pickled.
+            Defaults to False.
+
+        Returns
+        -------
+        results : list of dict
+            The results of `extract()` for all the texts.
+        failed : list of int
+            The positions in `texts` of the texts that could
+            not be parsed or extracted from.
+        """
+        if preprocess == 'abstract':
+            texts = [preprocess_abstract(text, self.sentencizer)
+                     for text in texts]
+        elif preprocess == 'document':
+            texts = [preprocess_full_document(text) for text in texts]
+        positions = [i for i, text in enumerate(texts) if text.strip()]
+        texts = [texts[i] for i in positions]
+
+        disable = [name for name in self.nlp.pipe_names
+                   if name not in EXTRACTION_PIPES]
+        try:
+            parsed = list(self.nlp.pipe(texts, batch_size=len(texts) or 1,
+                                        disable=disable))
+        except Exception:
+            # parse one at a time, to lose only the texts that fail
+            parsed = []
+            for text in texts:
+                try:
+                    parsed.append(self.nlp(text, disable=disable))
+                except Exception:
+                    parsed.append(None)
+
+        results = []
+        failed = []
+        for i, doc in zip(positions, parsed):
+            if doc is None:
+                failed.append(i)
+                continue
             try:
-                doc = self.nlp(doc)
-                results = self.extract(doc, raw=raw)
-                self._results.extend(results)
-                self._triples.update([r['RDF'] for r in results])
+                results.extend(self.extract(doc, raw=raw))
             except Exception:
-                failed += 1
-                continue
+                failed.append(i)
 
-        if verbose:
-            print('Number failed: ', failed)
+        if portable:
+            for result in results:
+                for key in ('SENT', 'NOUNS', 'VERBS'):
+                    if key in result:
+                        value = result[key]
+                        result[key] = (value.text if key == 'SENT'
+                                       else [v.text for v in value])
+        return results, failed
 
-        self._is_extracted = True
+    @property
+    def sentencizer(self):
+        """
+        A rule-based sentence splitter for `preprocess_abstract()`,
+        much faster than the dependency parse.
+        """
+        if self._sentencizer is None:
+            self._sentencizer = spacy.blank(self.nlp.lang)
+            self._sentencizer.add_pipe(
+                self._sentencizer.create_pipe('sentencizer'))
+            self._sentencizer.max_length = self.nlp.max_length
+        return self._sentencizer
+
+    def _add_results(self, results):
+        self._results.extend(results)
+        self._triples.update([r['RDF'] for r in results])
 
     @staticmethod
     def _create_type_constraint(train2id):
@@ -937,6 +1183,37 @@ class RDFExtractor:
                 rel_right)
 
 
+def _init_extract_worker(extractor):
+    global _extractor
+    _extractor = extractor
+
+
+def _extract_batch(batch):
+    return _extract_chunks(_extractor, batch)
+
+
+def _extract_chunks(extractor, batch):
+    """Extract from a batch of (document number, chunk); returns the results,
+    with text in place of SpaCy objects, and the numbers of the documents of
+    the chunks that failed."""
+    chunks, raw, preprocess = batch
+    results, failed = extractor.extract_texts(
+        [chunk for _, chunk in chunks], raw=raw, preprocess=preprocess,
+        portable=True)
+    return results, [chunks[i][0] for i in failed]
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def main():
 
     def bool_or_str(value):
@@ -979,11 +1256,24 @@ def main():
                         action='store_true',
                         help="Resolve the co-references.")
 
+    parser.add_argument('-rw', '--coref_concurrency', default=1, type=int,
+                        help="The number of documents resolved at once by "
+                             "each CoreNLP server.")
+
+    parser.add_argument('-rk', '--coref_cache', action='store_true',
+                        help="Cache resolved documents between runs.")
+
     parser.add_argument('-pp', '--preprocess',
                         default='abstract',
                         choices=['abstract', 'document', 'none'],
                         help="Preprocess the document or abstract.")
 
+    parser.add_argument('-bs', '--batch_size', default=32, type=int,
+                        help="The number of chunks of text parsed at a time.")
+
+    parser.add_argument('-np', '--n_process', default=1, type=int,
+                        help="The number of processes to parse with.")
+
     parser.add_argument('-pe', '--package_entities',
                         action='store_true',
                         help="Package the entities.")
@@ -1007,16 +1297,26 @@ def main():
     with open(args.json_input) as fb:
         docs = json.load(fb)
 
-    if args.preprocess == 'abstract':
-        docs = [preprocess_abstract(doc, nlp) for doc in docs]
-    elif args.preprocess == 'document':
-        docs = [preprocess_full_document(doc, nlp) for doc in docs]
+    # documents are preprocessed as they are parsed, unless co-references
+    # have to be resolved in the preprocessed text first
+    preprocess = None if args.preprocess == 'none' else args.preprocess
 
     if args.stanford_dir is not None and args.resolve_coreferences:
+        if preprocess == 'abstract':
+            docs = [preprocess_abstract(doc, nlp) for doc in docs]
+        elif preprocess == 'document':
+            docs = [preprocess_full_document(doc, nlp) for doc in docs]
+        preprocess = None
+
         print("Resolving co-references...")
         os.environ['CORENLP_HOME'] = args.stanford_dir
-        resolver = StanfordCoreferenceResolution()
-        docs = resolver.resolve_all(docs)
+        resolver = StanfordCoreferenceResolution(
+            concurrency=args.coref_concurrency,
+            cache=args.coref_cache)
+        # documents that could not be resolved are kept as they were
+        resolved = resolver.resolve_all(docs, raise_errors=False)
+        docs = [doc if res is None else res
+                for doc, res in zip(docs, resolved)]
 
     print("Extracting triples...")
     extractor = RDFExtractor(nlp,
@@ -1024,10 +1324,13 @@ def main():
                              min_obj_char_len=args.min_obj_char_len,
                              lemmatize=args.lemmatize,
                              remove_numeric=args.remove_numeric)
-    extractor.extract_all(docs)
+    extractor.extract_all(docs,
+                          preprocess=preprocess,
+                          batch_size=args.batch_size,
+                          n_process=args.n_process)
 
     if args.stanford_dir is not None and args.resolve_coreferences:
-        resolver.client.stop()
+        resolver.close()
 
     extractor = postprocess_triples(extractor,
                                     args.embeddings_path,
@@ -1,29 +1,73 @@
-import fastcluster
 import json
+import multiprocessing as mp
 import numpy as np
 import os
 import re
 import string
 import pickle
-import multiprocessing as mp
 
 # import xmltodict
 
 from collections import Counter
-from corenlp import CoreNLPClient
 from datetime import datetime
-from nltk import pos_tag, word_tokenize, sent_tokenize
+from functools import lru_cache
+from nltk import pos_tag_sents, word_tokenize, sent_tokenize
 from nltk.stem import WordNetLemmatizer
 from rdf_parse import StanfordParser, stanford_parse
-from scipy.spatial.distance import pdist
-from scipy.cluster.hierarchy import fcluster
+
+from multivac.src import instrument
+from multivac.src.data.embeddings import EmbeddingStore
+from multivac.src.rdf_graph import clustering
+
+LEMMATIZER = WordNetLemmatizer()
+
+
+@lru_cache(maxsize=None)
+def lemmatize_verb(word):
+    return LEMMATIZER.lemmatize(word, 'v')
+
+
+def clean_elements(elements):
+    # Clean a list of (is_relation, lower-cased text) tuple elements,
+    # returning the cleaned text of each, or None if the tuple should be
+    # dropped. Relations are lemmatized, without 'be' if they have more than
+    # one word, and may have at most 4 words; single-word entities must be
+    # nouns. Those are POS tagged all at once, each on its own.
+    tokens = [[word for word in word_tokenize(text)
+               if word not in string.punctuation if word is not None]
+              for _, text in elements]
+
+    single = sorted({words[0] for (is_relation, _), words
+                     in zip(elements, tokens)
+                     if not is_relation and len(words) == 1})
+    nouns = {tagged[0][0] for tagged in pos_tag_sents([[w] for w in single])
+             if 'NN' in tagged[0][1]}
+
+    cleaned = []
+    for (is_relation, _), words in zip(elements, tokens):
+        if is_relation:
+            words = [lemmatize_verb(word) for word in words]
+            # Don't allow relations longer than 4 tokens
+            if len(words) > 4:
+                words = []
+            if len(words) > 1:
+                # convert 'be running' to 'running' - i.e. remove 'is' verb
+                # from multi-word relations
+                words = [word for word in words if word != 'be']
+        elif len(words) == 1 and words[0] not in nouns:
+            # If the entity is a single word token, only allow nouns and
+            # proper nouns
+            words = []
+        cleaned.append(' '.join(words) if words else None)
+
+    return cleaned
 
 
 class RDFGraph:
     def __init__(self, top_tfidf=20000, top_n_rel=50,
                  top_n_ent=50000, clust_dist_thres=0.2, coref_opt=False,
                  openke_output_folder=os.curdir,
-                 verbose=False):
+                 verbose=False, endpoints=None, **pool_args):
         '''Inputs:
         a) top_tfidf = number of top TF-IDF triples to use. To extract novel
                knowledge statements, we sort tuples by their mean TF-IDF scores and
@@ -41,6 +85,10 @@ class RDFGraph:
                threshold, which provides a more conservative clustering approach.
         e) openke_output_folder = the output folder to output text files for
                OpenKE input
+        f) endpoints = the CoreNLP servers to parse with, by default those
+               in multivac.cfg or a local server. Other keyword arguments,
+               such as batch_size or concurrency, configure the CoreNLPPool
+               that shares the sentences among them.
          '''
 
         # Define Inputs
@@ -55,15 +103,16 @@ class RDFGraph:
         self.source_path = None
         self.verbose = verbose
 
-        annots =  "tokenize ssplit pos depparse natlog openie",
+        annots =  "tokenize ssplit pos depparse natlog openie"
         props  = {"timeout": 45000,
                   "openie.triple.strict": "true"}
 
         if coref_opt:
-            annots += "ner coref"
+            annots += " ner coref"
             props["openie.openie.resolve_coref"] = "true"
 
-        self.parser = StanfordParser(annots=annots, props=props)
+        self.parser = StanfordParser(annots=annots, props=props,
+                                     endpoints=endpoints, **pool_args)
 
     @staticmethod
     def clean_out_html_tags(texts):
@@ -83,19 +132,22 @@ class RDFGraph:
         del(self.all_texts)
         self.all_texts = []
 
-    def cluster_entities(self, embeddings_path, link_method='average'):
+    @instrument.traced('rdf.cluster_entities')
+    def cluster_entities(self, embeddings_path, link_method='average',
+                         neighbors=50):
+        # Cluster entities by the cosine distance of their averaged word
+        # embeddings. Only pairs among each entity's nearest neighbors are
+        # compared, so memory grows linearly with the number of entities;
+        # neighbors=None compares all pairs at once, as before.
         embeddings_dict = self.load_embeddings(embeddings_path,
                                                self.unique_entities)
-        # Create distance matrix (vector) using cosine similarity
-        # between all entity strings
         embeddings_array = np.array([embedding for embedding in embeddings_dict.values()])
 
-        dist_vec = pdist(embeddings_array, 'cosine')
-
-        # Cluster distance matrix to find co-referring entities
-        Z = fastcluster.linkage(dist_vec, method=link_method)
-        cluster_labels = fcluster(Z, t=self.clust_dist_thres,
-                                  criterion='distance')
+        # Cluster close entities to find co-referring ones
+        cluster_labels = clustering.cluster_labels(embeddings_array,
+                                                   self.clust_dist_thres,
+                                                   link_method=link_method,
+                                                   neighbors=neighbors)
         cluster_members_all = []
 
         entity_list = np.array([entity for entity in embeddings_dict.keys()])
@@ -110,24 +162,46 @@ class RDFGraph:
 
         self.entity_cluster_results = output
 
+    @instrument.traced('rdf.extract_raw_tuples')
     def extract_raw_tuples(self, parallel=False, n_cores=5):
+        # Articles are split into sentences, which are parsed in batches
+        # shared among the parser's CoreNLP servers; with coreference, which
+        # needs the whole article, articles are parsed whole, concurrently.
+        # The pool's concurrency replaces parallel and n_cores, which are
+        # kept for compatibility.
         if len(self.all_texts) == 0:
             self.load_texts()
 
-        # temp
-        # self.all_texts = {key: self.all_texts[key] for key in list(self.all_texts)}
-
         if self.verbose: print("{} documents to parse".format(len(self.all_texts)))
 
-        # Loop through articles or article batches:
-        # for Id, text in self.all_texts.items():
-        if parallel:
-            if self.verbose: print("Processing in parallel.")
-            pool = mp.Pool(n_cores)
-            all_tuples = pool.map(self.extract_article_tuples, self.all_texts.values())
+        texts = list(self.all_texts.values())
+
+        if self.coref_opt:
+            parses = self.parser.get_text_parses([text['text'] for text in texts])
+            all_tuples = []
+
+            for text, parse in zip(texts, parses):
+                if parse is None:
+                    instrument.count('rdf.sentence_fallbacks')
+                    parse = self.parse_by_sentence(text)
+
+                all_tuples.append(None if parse is None else
+                                  self.extract_article_tuples(text, parse))
         else:
-            if self.verbose: print("Processing in serial.")
-            all_tuples = list(map(self.extract_article_tuples, self.all_texts.values()))
+            all_tuples = []
+
+            for chunk in self.sentence_chunks(texts):
+                parses = iter(self.parser.get_parses(
+                    [s for _, sentences in chunk if sentences is not None
+                     for s in sentences]))
+
+                for text, sentences in chunk:
+                    if sentences is None:
+                        all_tuples.append(None)
+                        continue
+
+                    all_tuples.append(self.extract_article_tuples(
+                        text, {'sentences': [next(parses) for _ in sentences]}))
 
         self.all_tuples = {Id: art_tuples for Id, art_tuples in
                            zip(self.all_texts.keys(), all_tuples)}
@@ -138,7 +212,43 @@ class RDFGraph:
 
         if self.verbose: print("Dumped intermediate file to all_tuples.pickle")
 
-    def extract_article_tuples(self, text):
+    @staticmethod
+    def split_sentences(text):
+        try:
+            return sent_tokenize(text['text'])
+        except TypeError:
+            return None
+
+    def sentence_chunks(self, texts, chunk_sentences=5000):
+        # Yield lists of (text, sentences) of about chunk_sentences sentences
+        # in all, so only that many parses are held at once.
+        chunk, n = [], 0
+
+        for text in texts:
+            sentences = self.split_sentences(text)
+            chunk.append((text, sentences))
+            n += len(sentences or [])
+
+            if n >= chunk_sentences:
+                yield chunk
+                chunk, n = [], 0
+
+        if chunk:
+            yield chunk
+
+    def parse_by_sentence(self, text):
+        sentences = self.split_sentences(text)
+
+        if sentences is None:
+            return None
+
+        return {'sentences': self.parser.get_parses(sentences)}
+
+    @instrument.traced('rdf.extract_article_tuples')
+    def extract_article_tuples(self, text, parse=None):
+        # parse is the article's CoreNLP parse, with None in place of any
+        # sentence that couldn't be parsed; without it, the article is
+        # parsed here.
         if self.verbose: 
             if 'meta' in text:
                 print("PARSING: " + text['meta']['title'])
@@ -148,22 +258,31 @@ class RDFGraph:
 
         tuples = []
 
-        try:
-            sentences = self.parser.get_parse(text['text'])['sentences']
-        except:
-            if self.verbose: print("Could not parse whole document; parsing by sentence.")
+        if parse is None:
             try:
-                sentences = sent_tokenize(text['text'])
-            except TypeError:
-                return None
+                parse = self.parser.get_parse(text['text'])
+            except:
+                if self.verbose: print("Could not parse whole document; parsing by sentence.")
+                instrument.count('rdf.sentence_fallbacks')
+                parse = self.parse_by_sentence(text)
+                if parse is None:
+                    return None
+
+        sentences = parse['sentences']
+        instrument.count('rdf.sentences', len(sentences))
         for sentence in sentences:
+            if sentence is None:
+                instrument.count('rdf.parse_errors')
+                continue
             try:
                 s = stanford_parse(self.parser, sentence, noop=True)
             except:
-                print("Parse error: " + sentence)
+                print("Parse error: " + str(sentence))
+                instrument.count('rdf.parse_errors')
                 continue
 
             tuples.append(s.rdfs)
+            instrument.count('rdf.tuples', len(s.rdfs))
 
         if self.verbose:
             print("ELAPSED: {}".format(datetime.now() - start))
@@ -274,24 +393,11 @@ class RDFGraph:
 
     @staticmethod
     def load_embeddings(embeddings_path, entity_list):
-        embeddings = pickle.load(open(embeddings_path, 'rb'))
-        embeddings_dict = {token: vector for token, vector in
-                           zip(embeddings['vocab'], embeddings['embeddings'])}
         # Compute avg embeddings for each entity
-        entity_embeddings = {}
-        for entity in entity_list:
-            entity_split = entity.split()
-            entity_split_embeddings = [embeddings_dict[token] for token in entity_split if token in embeddings_dict]
-            if len(entity_split_embeddings) == 1:
-                entity_embeddings.update({
-                    entity: np.squeeze(np.array(entity_split_embeddings))
-                })
-            elif len(entity_split_embeddings) > 1:
-                entity_embeddings.update({
-                    entity: np.mean(np.array(entity_split_embeddings), axis=0)
-                })
-        return entity_embeddings
+        store = EmbeddingStore.open(embeddings_path)
+        return store.mean_vectors(entity_list)
 
+    @instrument.traced('rdf.output_to_openke')
     def output_to_openke(self, timestamp=datetime.now()):
         final_tuples = self.filter_tuples(self.tuples_preprocessed,
                                           self.entity_cluster_results['cluster_rep'],
@@ -337,7 +443,8 @@ class RDFGraph:
                 line = "{}\t{} \n".format(ls[0], ls[1])
                 f.write(line)
 
-    def preprocess_raw_tuples(self):
+    @instrument.traced('rdf.preprocess_raw_tuples')
+    def preprocess_raw_tuples(self, n_process=1, batch_size=5000):
         # Temp - Remove tuples missing subject, predicate or object
         tuples = [self.all_tuples[key] for key in self.all_tuples.keys()
                   if self.all_tuples[key] is not None]
@@ -348,48 +455,44 @@ class RDFGraph:
                           if all([token != '' for token in tuple_x])]
         self.all_tuples = tuples_cleared
 
-        # Initialize NLTK Lemmatizer
-        lemmatizer = WordNetLemmatizer()
-        # 1. Get tf-idf scores for each tuple
+        # The same subjects, relations and objects recur across tuples, so
+        # each distinct (lower-cased) one is cleaned once, in batches of
+        # batch_size spread over n_process worker processes
+        elements = {}
+        for tuple_x in self.all_tuples:
+            for num, element in enumerate(tuple_x):
+                if element is not None:
+                    elements.setdefault((num == 1, element.lower()))
+        elements = list(elements)
+        batches = [elements[i:i + batch_size]
+                   for i in range(0, len(elements), batch_size)]
+
+        if n_process > 1 and len(batches) > 1:
+            with mp.Pool(n_process) as pool:
+                cleaned = [clean for batch in pool.imap(clean_elements, batches)
+                           for clean in batch]
+        else:
+            cleaned = [clean for batch in batches
+                       for clean in clean_elements(batch)]
+        cleaned = dict(zip(elements, cleaned))
+        instrument.count('rdf.distinct_elements', len(elements))
+
         preprocessed_tuples = []
 
-        for num_tuple, tuple_x in enumerate(self.all_tuples):
+        for tuple_x in self.all_tuples:
             tuple_x_clean = []
 
             for num, element in enumerate(tuple_x):
                 # ensure the tuple_x is not empty
                 if element is None:
                     continue
-                word_tokens = word_tokenize(element.lower())
-                # If relationship/verb, lemmatize and clean
-                if num == 1:
-                    word_tokens_clean = [lemmatizer.lemmatize(word, 'v') for
-                                         word in word_tokens if word not in
-                                         string.punctuation if word is not None]
-                    # Don't allow relations longer than 4 tokens, if longer, break for-loop
-                    if len(word_tokens_clean) > 4:
-                        break
-                    if len(word_tokens_clean) > 1:
-                        # convert 'be running' to 'running' - i.e. remove 'is' verb from multi-word relations
-                        word_tokens_clean = [word for word in word_tokens_clean
-                                             if word != 'be']
-                else:
-                    word_tokens_temp = [word for word in word_tokens
-                                        if word not in string.punctuation
-                                        if word is not None]
-                    # If the entity is a single word token, only allow nouns and proper nouns
-                    if len(word_tokens_temp) == 1:
-                        word_token_pos = pos_tag(word_tokens_temp)
-                        word_tokens_clean = [pos_tuple[0] for pos_tuple in word_token_pos
-                                             if 'NN' in pos_tuple[1]]
-                    else:
-                        word_tokens_clean = word_tokens_temp
+                element_clean = cleaned[(num == 1, element.lower())]
 
                 # If preprocessed element is empty, skip tuple
-                if not word_tokens_clean:
+                if not element_clean:
                     break
                 else:
-                    tuple_x_clean.append(' '.join(word_tokens_clean))
+                    tuple_x_clean.append(element_clean)
             # If subject, relation and object fields exist, append to final
             # output
             if len(tuple_x_clean) == 3:
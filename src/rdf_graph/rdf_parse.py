@@ -2,11 +2,13 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import argparse
-from corenlp import CoreNLPClient
 from itertools import chain
 import pandas as pd
 import re
 
+from multivac.src.rdf_graph.corenlp_pool import CoreNLPPool
+from multivac.src.rdf_graph.parse_cache import ParseCache, cache_key
+
 def tokenize_text(text, parser=None):
     if parser is None:
         parser = StanfordParser(annots="tokenize")
@@ -61,24 +63,86 @@ def clean_queries(queries, verbose=False):
     return clean
 
 class StanfordParser(object):
-    def __init__(self, nlp=None, annots=None, props=None):
+    def __init__(self, nlp=None, annots=None, props=None, endpoints=None,
+                 cache=None, cache_mb=1024, **pool_args):
+        # Requests go through a CoreNLPPool of the given (or configured)
+        # server endpoints; pool_args such as batch_size and concurrency are
+        # passed on to it. A client passed as nlp is used as a pool of one.
+        # With a cache (True for the default file, a path, or a ParseCache
+        # to share), annotations are kept on disk and text seen before isn't
+        # sent to a server again.
         if annots is None:
             annots = "tokenize pos lemma depparse"
 
-        if nlp is None:       
-            self.nlp_client = CoreNLPClient(annotators=annots,
-                                            output_format='json')
-        else:
+        if nlp is None:
+            self.nlp_client = CoreNLPPool(endpoints, annotators=annots,
+                                          **pool_args)
+        elif isinstance(nlp, CoreNLPPool):
             self.nlp_client = nlp
+        else:
+            self.nlp_client = CoreNLPPool(clients=[nlp], **pool_args)
 
         if props is not None:
             self.nlp_client.default_properties.update(props)
 
+        if cache is None or cache is False or isinstance(cache, ParseCache):
+            self.cache = cache or None
+        else:
+            self.cache = ParseCache(None if cache is True else cache,
+                                    max_mb=cache_mb)
+
         _ = self.nlp_client.annotate("Let's get this party started!")
         del(_)
 
     def get_parse(self, sentence):
-        return self.nlp_client.annotate(sentence)
+        if self.cache is None:
+            return self.nlp_client.annotate(sentence)
+
+        key = self._cache_key(sentence)
+        parse = self.cache.get(key)
+
+        if parse is None:
+            parse = self.nlp_client.annotate(sentence)
+            self.cache.put(key, parse)
+
+        return parse
+
+    def get_parses(self, sentences):
+        # Parse each of a list of sentences as one sentence, sending them to
+        # the servers in batches; a sentence that can't be parsed gives None.
+        return self._cached(sentences, self.nlp_client.annotate_sentences,
+                            {'ssplit.eolonly': 'true'})
+
+    def get_text_parses(self, texts):
+        # Parse each of a list of texts whole, concurrently; a text that
+        # can't be parsed gives None.
+        return self._cached(texts, self.nlp_client.annotate_texts)
+
+    def _cache_key(self, text, properties=None):
+        props = dict(self.nlp_client.default_properties, **(properties or {}))
+        return cache_key(text, self.nlp_client.annotators, props)
+
+    def _cached(self, texts, annotate, properties=None):
+        # Look texts up in the cache, annotate those that aren't there (each
+        # distinct text once) and cache the new annotations.
+        if self.cache is None:
+            return annotate(texts)
+
+        texts = list(texts)
+        keys = [self._cache_key(t, properties) if t else None for t in texts]
+        parses = self.cache.get_many(k for k in keys if k is not None)
+        todo = {}
+
+        for text, key in zip(texts, keys):
+            if key is not None and key not in parses:
+                todo.setdefault(key, text)
+
+        if todo:
+            new = annotate(list(todo.values()))
+            self.cache.put_many(zip(todo.keys(), new))
+            parses.update(zip(todo.keys(), new))
+
+        return [parses.get(k) if k is not None else None for k in keys]
 
     def get_deps(self, sentence, deptype='basicDependencies', ret='asis'):
         if isinstance(sentence, str):
@@ -404,10 +468,16 @@ def process_texts(parser, texts, clean=False, verbose=False, form='longest', sub
     if clean:
         texts = clean_queries(texts, verbose)
 
-    sentences = [stanford_parse(parser, text, sub_rdfs=sub_rdfs) for text in texts]
+    parses = parser.get_parses(texts)
     processed = []
 
-    for sentence in sentences:
+    for parse in parses:
+        if parse is None:
+            processed.append([])
+            continue
+
+        sentence = stanford_parse(parser, parse, sub_rdfs=sub_rdfs)
+
         if len(sentence.rdfs) > 0:
             processed.append(sentence.get_rdfs(use_tokens=False, how=form))
         else:
@@ -21,3 +21,36 @@ def dict_str(my_dict, results=''):
     results += '}'
 
     return results
+
+
+def bounded_imap(executor, fn, items, window):
+    """Yield fn(item) for each item, as results complete, keeping at most
+    `window` calls in flight so large inputs are never all queued at once."""
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    items = iter(items)
+    pending = set()
+    for item in items:
+        pending.add(executor.submit(fn, item))
+        if len(pending) >= window:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def bounded_map(executor, fn, items, window):
+    """Yield fn(item) for each item in input order, keeping at most `window`
+    calls in flight, so results can be streamed out deterministically."""
+    from collections import deque
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()